@@ -0,0 +1,31 @@
+import glob
+import os
+
+import ev_functions as evc
+from conftest import FUEL_DIST, ROUTE_DIST, THROUGHPUT
+
+## End to end ----
+## route_process over --trips trips with a fixed seed, reported as trips/second
+## at the end of the run. route_process writes its outcome pickle to the working
+## directory, so each benchmark runs in a temporary one.
+
+def _route_process(backend, network, n_sim):
+    evc.route_process(
+        network['roads'], network['chargers'], ROUTE_DIST, FUEL_DIST, network['crs'], len(network['chargers']),
+        n_sim = n_sim, backend = backend, seed = 0, sampler = network['sampler']
+    )
+    for f in glob.glob("outcomes_*.pkl"):
+        os.remove(f)
+
+def bench_route_process(benchmark, osrm, network, request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    n_sim = request.config.getoption("trips")
+
+    _route_process(osrm['record'], network, n_sim)
+    benchmark.pedantic(_route_process, args = (osrm['replay'], network, n_sim), rounds = 3, iterations = 1)
+
+    ## No timings are kept under --benchmark-disable
+    benchmark.extra_info['trips'] = n_sim
+    if benchmark.stats is not None:
+        benchmark.extra_info['trips_per_s'] = n_sim / benchmark.stats.stats.mean
+        THROUGHPUT.append((request.node.name, n_sim, benchmark.stats.stats.mean))
@@ -0,0 +1,84 @@
+from itertools import cycle
+
+import numpy as np
+
+import ev_functions as evc
+from conftest import FUEL_DIST, ROUTE_DIST
+
+## Per stage latency ----
+## One benchmark per step of a simulated trip. The *_scan benchmarks time the
+## original GeoDataFrame code paths kept as fallbacks, for comparison.
+
+def bench_sample_point(benchmark, network):
+    roads = network['roads']
+    minor = roads[roads['level'] == 3].reset_index(drop = True)
+    benchmark(evc.sample_point, minor, network['crs'])
+
+def bench_get_start_point(benchmark, network):
+    rng = np.random.default_rng(0)
+    benchmark(evc.get_start_point, network['roads'], network['crs'], sampler = network['sampler'], rng = rng)
+
+def bench_get_end_point(benchmark, network, trips):
+    rng = np.random.default_rng(0)
+    starts = cycle([start_pos for start_pos, _ in trips])
+    benchmark(lambda: evc.get_end_point(network['roads'], next(starts), ROUTE_DIST, network['crs'], sampler = network['sampler'], rng = rng))
+
+def bench_get_end_point_scan(benchmark, network, trips):
+    benchmark.pedantic(evc.get_end_point, args = (network['roads'], trips[0][0], ROUTE_DIST, network['crs']), rounds = 5, iterations = 1)
+
+def bench_nearest_chg_pt(benchmark, network, trips):
+    points = cycle([end_pos['point'].geometry.iloc[0] for _, end_pos in trips])
+    benchmark(lambda: evc.nearest_chg_pt(next(points), network['chargers'], chg_index = network['chg_index']))
+
+def bench_calculate_route(benchmark, osrm, network, trips):
+    for start_pos, end_pos in trips:
+        evc.calculate_route(start_pos, end_pos, network['crs'], return_trip = True, backend = osrm['record'])
+
+    pairs = cycle(trips)
+    benchmark(lambda: evc.calculate_route(*next(pairs), network['crs'], return_trip = True, backend = osrm['replay']))
+
+def bench_parse_osrm(benchmark, osrm, network, trips):
+    from ev_routing import parse_osrm_text
+
+    for start_pos, end_pos in trips:
+        evc.calculate_route(start_pos, end_pos, network['crs'], return_trip = True, backend = osrm['record'])
+
+    bodies = cycle([p.read_text() for p in sorted(osrm['server'].fixture_dir.glob("*.json"))])
+    benchmark(lambda: parse_osrm_text(next(bodies)))
+
+def bench_simulate_trip(benchmark, osrm, network, trips):
+    routes = [evc.calculate_route(start_pos, end_pos, network['crs'], return_trip = True, backend = osrm['record']) for start_pos, end_pos in trips]
+
+    ## Each trip draws occupancy from its own seed, so replaying a trip repeats its requests
+    def run(i, backend):
+        start_pos, end_pos = trips[i]
+        return evc.simulate_trip(
+            routes[i], start_pos, end_pos, None, ROUTE_DIST, FUEL_DIST, network['crs'],
+            chg_index = network['chg_index'], backend = backend, random_state = np.random.default_rng(i)
+        )
+
+    for i in range(len(trips)):
+        run(i, osrm['record'])
+
+    ids = cycle(range(len(trips)))
+    benchmark(lambda: run(next(ids), osrm['replay']))
+
+def bench_event_scheduler(benchmark, osrm, network, trips):
+    from ev_events import EventScheduler, PoissonPolicy
+    from ev_fleet import simulate_fleet
+
+    routes = [evc.calculate_route(start_pos, end_pos, network['crs'], return_trip = True, backend = osrm['record']) for start_pos, end_pos in trips]
+    sched = EventScheduler(routes, network['chargers'], chg_index = network['chg_index'])
+
+    ## With PoissonPolicy the scheduler is the fleet model: one vehicle on the same
+    ## seed and route ends the same way, at the same vertex, after the same refuels
+    for route_dist in (ROUTE_DIST, ROUTE_DIST / 2):
+        for i, route in enumerate(routes):
+            sched.policy = PoissonPolicy(random_state = i)
+            event = sched.run([i], route_dist, route_dist * .25)
+            fleet = simulate_fleet(route, network['chargers'], route_dist, route_dist * .25, n_vehicles = 1, chg_index = network['chg_index'], random_state = i)
+            for col in ('outcome', 'fail_index', 'refuels'):
+                assert event[col].tolist() == fleet[col].tolist(), (route_dist, i, col)
+
+    sched.policy = PoissonPolicy(random_state = 0)
+    benchmark(sched.run, list(range(len(routes))) * 10, ROUTE_DIST, FUEL_DIST)
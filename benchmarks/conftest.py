@@ -0,0 +1,161 @@
+import sys
+from hashlib import sha1
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import synthetic
+from ev_index import ChargerIndex
+from ev_osrm import ReplayServer
+from ev_routing import LocalBackend, OSRMBackend
+from ev_sampler import VertexSampler
+
+## Benchmark setup ----
+## Every benchmark runs against synthetic layers at each --scale given (default
+## 1x), and all routing goes over HTTP to a ReplayServer answering from recorded
+## OSRM JSON fixtures, so nothing leaves the machine. Fixtures live under
+## benchmarks/.fixtures/x<scale>-<generator hash> and are recorded on first use by a second server
+## that falls back to the local router over the same synthetic roads. Workloads
+## are seeded, so a recording pass followed by timed replay passes makes exactly
+## the same requests.
+
+FIXTURE_DIR = Path(__file__).resolve().parent / ".fixtures"
+
+## Route and fuel distance as in points.py
+ROUTE_DIST = 402336
+FUEL_DIST = ROUTE_DIST * .25
+
+## Trips/second results printed at the end of the session
+THROUGHPUT = []
+
+def pytest_addoption(parser):
+    parser.addoption("--scale", action = "append", type = int, default = None,
+                     help = "Synthetic network scale relative to Colorado (1, 10, 100), may be repeated")
+    parser.addoption("--trips", action = "store", type = int, default = 50,
+                     help = "Trips per end to end route_process round")
+
+def pytest_generate_tests(metafunc):
+    if "scale" in metafunc.fixturenames:
+        scales = metafunc.config.getoption("scale") or [1]
+        metafunc.parametrize("scale", scales, ids = ["x{}".format(s) for s in scales], scope = "session")
+
+def pytest_terminal_summary(terminalreporter):
+    if THROUGHPUT:
+        terminalreporter.section("end to end throughput")
+        for name, trips, seconds in THROUGHPUT:
+            terminalreporter.write_line("{:<48} {:>6} trips {:>10.2f} trips/s".format(name, trips, trips / seconds))
+
+@pytest.fixture(scope = "session")
+def network(scale):
+    roads = synthetic.roads(scale)
+    chgs = synthetic.chargers(roads, scale)
+    return {
+        'scale': scale,
+        'roads': roads,
+        'chargers': chgs,
+        'crs': chgs.crs,
+        'sampler': VertexSampler(roads, rng = np.random.default_rng(0)),
+        'chg_index': ChargerIndex(chgs)
+    }
+
+## Correctness tests ----
+## test_*.py check that each optimised path gives the same outcomes as the path it
+## replaces. They route over the local router on a small synthetic network (1/20th
+## of the 1x grid) with a shorter range, so trips refuel and fail often enough
+## to exercise every branch, in well under a minute.
+
+SMALL_SCALE = 0.05
+SMALL_ROUTE_DIST = 150000
+
+@pytest.fixture(scope = "session")
+def small():
+    roads = synthetic.roads(SMALL_SCALE)
+    chgs = synthetic.chargers(roads, SMALL_SCALE)
+    return {
+        'roads': roads,
+        'chargers': chgs,
+        'crs': chgs.crs,
+        'backend': LocalBackend(roads, crs = chgs.crs)
+    }
+
+## prepare() cache of the small network, read back from shapefiles as ev_process does
+@pytest.fixture(scope = "session")
+def small_cache(small, tmp_path_factory):
+    from ev_prepare import prepare
+
+    path = tmp_path_factory.mktemp("small")
+    small['roads'].to_file(path / "roads.shp")
+    small['chargers'].to_file(path / "stations.shp")
+    return prepare(path / "roads.shp", path / "stations.shp", path / "cache")
+
+## Seeded route_process over the small network, run in `directory` (it writes its
+## outcome pickle to the working directory), returning the chargers and outcomes
+def run_small(small, directory, n_sim = 20, **kwargs):
+    import os
+    import pickle
+    import ev_functions as evc
+
+    kwargs.setdefault('backend', small['backend'])
+    kwargs.setdefault('seed', 0)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        evc.route_process(small['roads'], small['chargers'], SMALL_ROUTE_DIST, SMALL_ROUTE_DIST * .25, small['crs'],
+                          0 if small['chargers'] is None else len(small['chargers']), n_sim = n_sim, **kwargs)
+        path, = Path(directory).glob("outcomes_*.pkl")
+        with open(path, 'rb') as f:
+            chgs, res = pickle.load(f)
+        path.unlink()
+    finally:
+        os.chdir(cwd)
+    return chgs, res
+
+## Local router built only if a fixture has to be recorded
+class _Recorder:
+
+    def __init__(self, road_data, crs):
+        self.road_data = road_data
+        self.crs = crs
+        self._backend = None
+
+    def route(self, *coords):
+        if self._backend is None:
+            self._backend = LocalBackend(self.road_data, crs = self.crs)
+        return self._backend.route(*coords)
+
+@pytest.fixture(scope = "session")
+def osrm(network):
+    ## Keyed on the generator source too, so changing the layers records fresh fixtures
+    version = sha1(Path(synthetic.__file__).read_bytes()).hexdigest()[:8]
+    fixture_dir = FIXTURE_DIR / "x{}-{}".format(network['scale'], version)
+    recorder = ReplayServer(fixture_dir, fallback = _Recorder(network['roads'], network['crs'])).start()
+    replay = ReplayServer(fixture_dir).start()
+
+    ## A single attempt, so a missing fixture fails fast instead of sleeping through retries
+    yield {
+        'record': OSRMBackend(recorder.url, retries = 1),
+        'replay': OSRMBackend(replay.url, retries = 1),
+        'server': replay
+    }
+
+    recorder.stop()
+    replay.stop()
+
+## Seeded start and end positions of accepted candidate trips
+@pytest.fixture(scope = "session")
+def trips(network):
+    import ev_functions as evc
+
+    rng = np.random.default_rng(42)
+    sampler = network['sampler']
+    out = []
+    while len(out) < 20:
+        start_pos = evc.get_start_point(network['roads'], network['crs'], sampler = sampler, rng = rng)
+        end_pos = evc.get_end_point(network['roads'], start_pos, ROUTE_DIST, network['crs'], sampler = sampler, rng = rng)
+        if end_pos is not None:
+            out.append((start_pos, end_pos))
+    return out
@@ -0,0 +1,88 @@
+import numpy as np
+from geopandas import GeoDataFrame, points_from_xy
+
+## Synthetic layers ----
+## Road and charger layers in the schema of all_roads.shp and alt_fuel_stations.shp,
+## covering Colorado in EPSG:32613. Roads are a jittered grid of polylines that
+## share a vertex wherever they cross, so the network is connected for the local
+## router. `scale` multiplies the number of roads, vertices and stations relative
+## to the 1x (Colorado sized) layers by making the grid denser.
+
+## Colorado in UTM zone 13N (metres)
+X_MIN, X_MAX = 140000, 760000
+Y_MIN, Y_MAX = 4090000, 4550000
+
+## 1x grid: a road every SPACING metres, a vertex every SPACING / STEPS metres,
+## and each road runs for SPAN grid cells before the next one starts
+SPACING = 4000
+STEPS = 4
+SPAN = 4
+
+## 1x station count
+STATIONS = 2000
+
+def _linestrings(coords):
+    try:
+        from shapely import linestrings
+        return linestrings(coords)
+    except ImportError:
+        from shapely.geometry import LineString
+        return [LineString(c) for c in coords]
+
+## Polylines along one axis: each row of `across` gets roads of SPAN cells along `along`
+def _lines(across, along, step, rng, jitter):
+    n_vert = SPAN * STEPS + 1
+    starts = along[:-1:SPAN * STEPS]
+    starts = starts[starts + (n_vert - 1) * step <= along[-1]]
+
+    shape = (len(across), len(starts), n_vert)
+    a = np.broadcast_to(starts[None, :, None] + step * np.arange(n_vert)[None, None, :], shape)
+    b = np.broadcast_to(across[:, None, None], shape).astype(float)
+
+    ## Jitter vertices off the grid lines so roads are not perfectly straight,
+    ## keeping the ones on crossings fixed so crossing roads share them
+    on_grid = (np.arange(n_vert) % STEPS) == 0
+    b = b + np.where(on_grid, 0, rng.normal(0, jitter, a.shape))
+    return a.reshape(-1, n_vert), b.reshape(-1, n_vert)
+
+def roads(scale = 1, seed = 0):
+    rng = np.random.default_rng(seed)
+    spacing = SPACING / np.sqrt(scale)
+    step = spacing / STEPS
+
+    xs = np.arange(X_MIN, X_MAX + 1, spacing)
+    ys = np.arange(Y_MIN, Y_MAX + 1, spacing)
+    x_steps = np.arange(X_MIN, X_MAX + 1, step)
+    y_steps = np.arange(Y_MIN, Y_MAX + 1, step)
+
+    ## North-south roads hold x fixed, east-west roads hold y fixed
+    ns_y, ns_x = _lines(xs, y_steps, step, rng, step / 10)
+    ew_x, ew_y = _lines(ys, x_steps, step, rng, step / 10)
+    coords = np.concatenate([np.stack([ns_x, ns_y], axis = -1), np.stack([ew_x, ew_y], axis = -1)])
+
+    ## Every 8th grid line is an interstate (1), every other 4th a highway (2), the rest minor roads (3)
+    line_id = np.concatenate([np.arange(len(ns_x)) // (len(ns_x) // len(xs)), np.arange(len(ew_x)) // (len(ew_x) // len(ys))])
+    level = np.where(line_id % 8 == 0, 1, np.where(line_id % 4 == 0, 2, 3))
+
+    return GeoDataFrame({
+        'record': np.arange(1, len(coords) + 1),
+        'level': level,
+        'geometry': _linestrings(coords)
+    }, crs = "EPSG:32613")
+
+## Stations near road vertices, in WGS84 as the charger layer is read
+def chargers(road_data, scale = 1, seed = 1, crs = "GCS_WGS84"):
+    rng = np.random.default_rng(seed)
+    n = int(STATIONS * scale)
+
+    coords = np.concatenate([np.asarray(g.coords) for g in road_data['geometry'].iloc[rng.integers(len(road_data), size = n)]])
+    pick = coords[rng.integers(len(coords), size = n)] + rng.normal(0, 100, (n, 2))
+
+    ## Mostly small stations, a few large ones
+    nm_chrg = np.minimum(rng.geometric(0.4, n), 20)
+
+    return GeoDataFrame({
+        'fll_ddr': ["{} Station Rd".format(i) for i in range(n)],
+        'nm_chrg': nm_chrg,
+        'geometry': points_from_xy(pick[:, 0], pick[:, 1])
+    }, crs = "EPSG:32613").to_crs(crs)
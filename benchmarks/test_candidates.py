@@ -0,0 +1,30 @@
+import numpy as np
+
+import ev_functions as evc
+from conftest import SMALL_ROUTE_DIST
+from ev_candidates import CandidateGenerator
+from ev_sampler import VertexSampler
+
+## Trip candidates ----
+## The generator proposes exactly the pairs the start and end point helpers draw
+## from the same generator state, and every proposal is accounted for.
+
+def test_candidates_follow_sampler(small):
+    sampler = VertexSampler(small['roads'])
+    candidates = CandidateGenerator(sampler, SMALL_ROUTE_DIST, small['crs'])
+
+    a, b = np.random.default_rng(5), np.random.default_rng(5)
+    for _ in range(30):
+        pair = candidates.propose(rng = a)
+        start_pos = evc.get_start_point(small['roads'], small['crs'], sampler = sampler, rng = b)
+        end_pos = evc.get_end_point(small['roads'], start_pos, SMALL_ROUTE_DIST, small['crs'], sampler = sampler, rng = b)
+        if end_pos is None:
+            assert pair is None
+            continue
+        assert pair[0]['vertex'] == start_pos['vertex'] and pair[1]['vertex'] == end_pos['vertex']
+
+        route = evc.calculate_route(pair[0], pair[1], small['crs'], return_trip = True, backend = small['backend'])
+        assert candidates.record(route) == ((route is not None) and (route.total_dist > SMALL_ROUTE_DIST))
+
+    stats = candidates.stats()
+    assert stats['proposed'] == 30 == stats['no_end_point'] + stats['routing_calls']
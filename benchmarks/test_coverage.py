@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from conftest import run_small
+from ev_coverage import CoverageMap
+from ev_index import ChargerIndex
+from ev_routing import OSRMBackend
+
+## Coverage map ----
+## Stations added one at a time leave the map a full rebuild would give, distances
+## are shortest path distances over the graph, and the map reaches disk on close.
+
+def test_coverage_add_matches_build(small, tmp_path):
+    graph = small['backend']
+    coords = ChargerIndex(small['chargers']).coords
+
+    built = CoverageMap(graph)
+    built.build(coords)
+
+    grown = CoverageMap(graph, tmp_path / "coverage", save_every = 1000)
+    grown.build(coords[:50])
+    for i in range(50, len(coords)):
+        grown.add(i, *coords[i])
+
+    assert np.allclose(grown.dist, built.dist)
+    assert np.array_equal(grown.station >= 0, built.station >= 0)
+
+    rng = np.random.default_rng(0)
+    for node in rng.choice(np.flatnonzero(built.station >= 0), size = 20):
+        station = built.station[node]
+        found = graph.shortest_path(int(node), int(built.nodes[station]))
+        assert found[1] == pytest.approx(built.dist[node])
+
+def test_coverage_saved_on_close(small, tmp_path):
+    chg_index = ChargerIndex(small['chargers'])
+    coverage = CoverageMap(small['backend'], tmp_path / "coverage", save_every = 1000)
+    coverage.sync(chg_index)
+
+    chg_index.insert(small['chargers'].iloc[:3])
+    coverage.sync(chg_index)
+    assert len(CoverageMap(small['backend'], tmp_path / "coverage")) == len(chg_index) - 3
+
+    coverage.close()
+    reloaded = CoverageMap(small['backend'], tmp_path / "coverage")
+    assert len(reloaded) == len(chg_index)
+    assert np.array_equal(reloaded.dist, coverage.dist)
+
+def test_coverage_needs_its_graph(small, tmp_path):
+    coverage = CoverageMap(small['backend'])
+    with pytest.raises(ValueError):
+        run_small(small, tmp_path, n_sim = 1, coverage = coverage, backend = OSRMBackend("http://127.0.0.1:9"))
+
+def test_coverage_run_saves_added(small, tmp_path):
+    coverage = CoverageMap(small['backend'], tmp_path / "coverage", save_every = 1000)
+    chgs, res = run_small(small, tmp_path, n_sim = 10, coverage = coverage)
+    assert len(CoverageMap(small['backend'], tmp_path / "coverage")) == len(chgs)
@@ -0,0 +1,35 @@
+from ev_estimate import FailureEstimate
+
+## Failure rate estimate ----
+## A stratified estimate counts regions with no trips yet as unknown: their share
+## is reported and widens the interval, so it only converges once every region
+## that can start trips has some. Regions with no weight never hold it back.
+
+def _fill(estimate, h, n, failures):
+    for i in range(n):
+        estimate.propose(h)
+        estimate.add(h, i < failures)
+
+def test_unobserved_regions_widen_the_interval():
+    estimate = FailureEstimate([1, 1, 2], stratify = True)
+    _fill(estimate, 0, 2000, 200)
+    _fill(estimate, 1, 2000, 200)
+
+    u = estimate.unobserved()
+    lo, hi = estimate.interval()
+    assert 0.3 < u < 0.4
+    assert abs(estimate.rate() - 0.1) < 1e-9
+    assert lo < 0.1 * (1 - u) and hi > u
+    assert not estimate.converged(0.05)
+
+    _fill(estimate, 2, 4000, 400)
+    assert estimate.unobserved() == 0
+    assert estimate.converged(0.05)
+
+def test_regions_without_weight_are_ignored():
+    estimate = FailureEstimate([1, 1, 0], stratify = True)
+    _fill(estimate, 0, 2000, 200)
+    _fill(estimate, 1, 2000, 200)
+
+    assert estimate.unobserved() == 0
+    assert estimate.converged(0.05)
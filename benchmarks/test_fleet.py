@@ -0,0 +1,67 @@
+import numpy as np
+
+import ev_functions as evc
+from conftest import SMALL_ROUTE_DIST
+from ev_events import EventScheduler, PoissonPolicy, PortPolicy
+from ev_fleet import simulate_fleet
+from ev_index import ChargerIndex
+from ev_sampler import VertexSampler
+
+## Trip, fleet and event simulation ----
+## With every station always free (alpha = 0) there is nothing random left, so
+## the fleet and the event scheduler must agree vehicle for vehicle. A vehicle
+## with range for the whole trip never stops, and with every station busy the
+## only way to fail is running dry looking for one.
+
+def _routes(small, n, seed = 0):
+    sampler = VertexSampler(small['roads'], rng = np.random.default_rng(seed))
+    routes = []
+    while len(routes) < n:
+        start_pos = sampler.draw(small['crs'], level = 3)
+        end_pos = sampler.draw(small['crs'], level = 3)
+        route = evc.calculate_route(start_pos, end_pos, small['crs'], return_trip = True, backend = small['backend'])
+        if (route is not None) and (route.total_dist > SMALL_ROUTE_DIST):
+            routes.append((route, start_pos, end_pos))
+    return routes
+
+def test_fleet_matches_events_when_stations_are_free(small):
+    index = ChargerIndex(small['chargers'])
+    ranges = np.linspace(SMALL_ROUTE_DIST * .3, SMALL_ROUTE_DIST * 2, 40)
+    for route, _, _ in _routes(small, 3):
+        fleet = simulate_fleet(route, small['chargers'], ranges, ranges * .25, alpha = 0, chg_index = index, random_state = 0)
+        sched = EventScheduler([route], small['chargers'], policy = PoissonPolicy(alpha = 0, random_state = 0), chg_index = index)
+        events = sched.run([0] * len(ranges), ranges, ranges * .25)
+
+        assert fleet['outcome'].tolist() == events['outcome'].tolist()
+        assert fleet['fal_typ'].tolist() == events['fal_typ'].tolist()
+        assert fleet['refuels'].tolist() == events['refuels'].tolist()
+
+def test_long_range_never_stops(small):
+    index = ChargerIndex(small['chargers'])
+    for route, start_pos, end_pos in _routes(small, 3, seed = 1):
+        long_range = route.total_dist * 2
+        fleet = simulate_fleet(route, small['chargers'], long_range, long_range * .25, n_vehicles = 10, chg_index = index, random_state = 0)
+        assert (fleet['outcome'] == 0).all() and (fleet['refuels'] == 0).all()
+        assert evc.simulate_trip(route, start_pos, end_pos, small['chargers'], long_range, long_range * .25, small['crs'],
+                                 chg_index = index, backend = small['backend'], random_state = np.random.default_rng(0)) is None
+
+def test_busy_stations_fail_unavailable(small):
+    index = ChargerIndex(small['chargers'])
+    for route, start_pos, end_pos in _routes(small, 3, seed = 2):
+        fleet = simulate_fleet(route, small['chargers'], SMALL_ROUTE_DIST, SMALL_ROUTE_DIST * .25, alpha = 1e9, n_vehicles = 10,
+                               chg_index = index, random_state = 0)
+        assert (fleet['fal_typ'] == "Chargers unavailable").all()
+
+        outcome = evc.simulate_trip(route, start_pos, end_pos, small['chargers'], SMALL_ROUTE_DIST, SMALL_ROUTE_DIST * .25, small['crs'],
+                                    alpha = 1e9, chg_index = index, backend = small['backend'], random_state = np.random.default_rng(0))
+        assert outcome['fal_typ'].iloc[0] == "Chargers unavailable"
+
+def test_ports_queue_vehicles(small):
+    index = ChargerIndex(small['chargers'])
+    route = _routes(small, 1, seed = 3)[0][0]
+    n = 200
+    sched = EventScheduler([route], small['chargers'], policy = PortPolicy(queue = True), chg_index = index)
+    events = sched.run([0] * n, SMALL_ROUTE_DIST, SMALL_ROUTE_DIST * .25)
+    busy = sched.policy.peak.max()
+    assert busy <= sched.group_ports.max()
+    assert (events['wait_time'] > 0).any()
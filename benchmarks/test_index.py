@@ -0,0 +1,55 @@
+import numpy as np
+from shapely.geometry import Point
+
+from ev_index import ChargerIndex
+from ev_transform import PROJ, transform
+
+## Charger index ----
+## Nearest station lookups match a brute force search over every station, before
+## and after chargers are added, whether they sit in the pending buffer or have
+## been folded into the tree.
+
+def _brute(index, x, y):
+    px, py = transform(np.asarray(x, dtype = float), np.asarray(y, dtype = float), index.crs, PROJ)
+    d = np.hypot(index.coords[:, 0] - np.atleast_1d(px)[:, None], index.coords[:, 1] - np.atleast_1d(py)[:, None])
+    return d.min(axis = 1)
+
+def test_nearest_matches_brute_force(small):
+    chgs = small['chargers']
+    rng = np.random.default_rng(0)
+    bounds = chgs.total_bounds
+    x = rng.uniform(bounds[0], bounds[2], 50)
+    y = rng.uniform(bounds[1], bounds[3], 50)
+
+    for rebuild_size in (1000, 4):
+        index = ChargerIndex(chgs, rebuild_size = rebuild_size)
+        for i in range(10):
+            index.insert(chgs.iloc[[0]].assign(geometry = [Point(x[i], y[i])]))
+
+        ids, dist = index.nearest_many(x, y)
+        assert np.allclose(dist, _brute(index, x, y))
+        for i in range(len(x)):
+            _, d = index.query(Point(x[i], y[i]))
+            assert np.isclose(d[0], dist[i])
+        assert len(index) == len(index.data) == len(chgs) + 10
+
+def test_truncate_restores_earlier_index(small):
+    chgs = small['chargers']
+    bounds = chgs.total_bounds
+    rng = np.random.default_rng(1)
+    x = rng.uniform(bounds[0], bounds[2], 30)
+    y = rng.uniform(bounds[1], bounds[3], 30)
+    new = [chgs.iloc[[0]].assign(geometry = [Point(x[i], y[i])]) for i in range(10)]
+
+    ## Truncated back past a rebuild and within the pending buffer
+    for keep in (2, 9):
+        index, expected = ChargerIndex(chgs, rebuild_size = 4), ChargerIndex(chgs, rebuild_size = 4)
+        for i, rows in enumerate(new):
+            index.insert(rows)
+            if i < keep:
+                expected.insert(rows)
+        index.truncate(len(chgs) + keep)
+
+        assert len(index) == len(index.data) == len(expected)
+        assert np.array_equal(index.coords, expected.coords)
+        assert np.array_equal(index.nearest_many(x, y)[0], expected.nearest_many(x, y)[0])
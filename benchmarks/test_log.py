@@ -0,0 +1,56 @@
+from conftest import run_small
+from ev_log import OutcomeLog
+
+## LocalBackend with the prefetch hook route_process looks for, so pairs are
+## drawn ahead of the trip being simulated as they are with AsyncOSRMClient
+class Prefetching:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.symmetric = backend.symmetric
+        self.prefetched = 0
+
+    def prefetch(self, pairs):
+        self.prefetched += len(pairs)
+
+    def route(self, *coords):
+        return self.backend.route(*coords)
+
+## Added chargers' locations, which depend on which trips were simulated
+def _added(chgs, small):
+    return [(round(p.x, 6), round(p.y, 6)) for p in chgs.geometry.iloc[len(small['chargers']):]]
+
+def test_resume_with_prefetch_matches_full_run(small, tmp_path):
+    backend = Prefetching(small['backend'])
+    full_chgs, full = run_small(small, tmp_path, n_sim = 12, backend = backend, prefetch = 3, log_dir = tmp_path / "full")
+    assert backend.prefetched > 0
+
+    run_small(small, tmp_path, n_sim = 5, backend = backend, prefetch = 3, log_dir = tmp_path / "cut")
+    chgs, resumed = run_small(small, tmp_path, n_sim = 12, backend = backend, prefetch = 3, log_dir = tmp_path / "cut", resume = True)
+
+    ## The pickle keeps the unlogged format, the log holds every trip
+    assert isinstance(resumed, list) and resumed == full
+    assert OutcomeLog(tmp_path / "cut").outcomes().column('trip').to_pylist() == list(range(1, 13))
+    assert _added(chgs, small) == _added(full_chgs, small)
+
+def test_resume_without_prefetch_matches_full_run(small, tmp_path):
+    full_chgs, full = run_small(small, tmp_path, n_sim = 12, log_dir = tmp_path / "full")
+    run_small(small, tmp_path, n_sim = 5, log_dir = tmp_path / "cut")
+    chgs, resumed = run_small(small, tmp_path, n_sim = 12, log_dir = tmp_path / "cut", resume = True)
+
+    assert resumed == full
+    assert _added(chgs, small) == _added(full_chgs, small)
+
+## Stratified allocation depends on the proposals made in each region, so a resumed
+## run only starts trips in the same regions if those counts are restored
+def test_stratified_resume_matches_full_run(small, tmp_path):
+    options = dict(stratify = True, regions = 200000)
+    full_chgs, full = run_small(small, tmp_path, n_sim = 12, log_dir = tmp_path / "full", **options)
+    run_small(small, tmp_path, n_sim = 5, log_dir = tmp_path / "cut", **options)
+    chgs, resumed = run_small(small, tmp_path, n_sim = 12, log_dir = tmp_path / "cut", resume = True, **options)
+
+    full_trips, cut_trips = OutcomeLog(tmp_path / "full").trips(), OutcomeLog(tmp_path / "cut").trips()
+    assert list(cut_trips['region']) == list(full_trips['region'])
+    assert list(cut_trips['proposed'].iloc[-1]) == list(full_trips['proposed'].iloc[-1])
+    assert resumed == full
+    assert _added(chgs, small) == _added(full_chgs, small)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from conftest import run_small
+from ev_matrix import ChargerMatrix
+from ev_metrics import Metrics
+from ev_routing import OSRMBackend
+
+## Distance matrix ----
+## Reroutes the matrix skips are ones the route would have found in range, so a run
+## with the matrix ends every trip the way the run without it does.
+
+def _chargers(res):
+    return np.column_stack([res.geometry.x, res.geometry.y])
+
+def test_matrix_keeps_outcomes(small, tmp_path):
+    base = run_small(small, tmp_path, n_sim = 30)
+
+    metrics = Metrics()
+    matrix = ChargerMatrix(small['backend'], tmp_path / "matrix", cell_size = 20000)
+    fast = run_small(small, tmp_path, n_sim = 30, chg_matrix = matrix, metrics = metrics)
+
+    assert fast[1] == base[1]
+    assert np.allclose(_chargers(fast[0]), _chargers(base[0]))
+    assert metrics.counters.get('reroutes_skipped', 0) > 0
+
+def test_matrix_bounds_hold(small, tmp_path):
+    from ev_index import ChargerIndex
+
+    graph = small['backend']
+    matrix = ChargerMatrix(graph, tmp_path / "matrix", cell_size = 20000, max_bytes = 2**20)
+    matrix.sync(ChargerIndex(small['chargers']))
+    assert matrix.batch < len(matrix)
+
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        station = int(rng.integers(len(matrix)))
+        x, y = rng.uniform(graph.x.min(), graph.x.max()), rng.uniform(graph.y.min(), graph.y.max())
+        lo, hi = matrix.bounds(station, x, y)
+        found = graph.shortest_path(int(matrix.nodes[station]), int(graph._tree.query([x, y])[1]))
+        if found is not None:
+            assert lo * (1 - 1e-6) <= found[1] <= hi
+
+def test_matrix_needs_its_graph(small, tmp_path):
+    matrix = ChargerMatrix(small['backend'], tmp_path / "matrix", cell_size = 20000)
+    with pytest.raises(ValueError):
+        run_small(small, tmp_path, n_sim = 1, chg_matrix = matrix, backend = OSRMBackend("http://127.0.0.1:9"))
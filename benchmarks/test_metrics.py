@@ -0,0 +1,29 @@
+from conftest import run_small
+from ev_metrics import Metrics, get_metrics, set_metrics
+
+## Metrics ----
+## Gauge series stay within their history however long the run, spread evenly
+## from the first call to the latest, and a registry passed to route_process is
+## only installed for that run.
+
+def test_series_are_downsampled():
+    metrics = Metrics(history = 100)
+    for k in range(10000):
+        metrics.gauge('rate', k, at = k)
+
+    series = metrics.series['rate']
+    at = [p[0] for p in series]
+    assert 50 <= len(series) < 100
+    assert at[0] == 0 and at[-1] >= 10000 - 10000 // len(series)
+    assert len({b - a for a, b in zip(at, at[1:])}) == 1
+    assert metrics.gauges['rate'] == 9999
+
+def test_run_metrics_are_restored(small, tmp_path):
+    outer, run = Metrics(), Metrics()
+    previous = set_metrics(outer)
+    try:
+        run_small(small, tmp_path, n_sim = 3, metrics = run)
+        assert get_metrics() is outer
+        assert run.counters['trips'] == 3 and 'trips' not in outer.counters
+    finally:
+        set_metrics(previous)
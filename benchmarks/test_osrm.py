@@ -0,0 +1,71 @@
+import numpy as np
+
+from ev_metrics import Metrics, set_metrics
+from ev_osrm import AsyncOSRMClient, ReplayServer, osrm_loc
+from ev_routing import CachedBackend
+
+## OSRM client ----
+## Every request the replay server answers, retries of failed ones included, is
+## counted once in the metrics registry, prefetched routes never asked for are
+## cancelled rather than kept, and concurrent fallbacks are served one at a time.
+
+def _pairs(small, n):
+    rng = np.random.default_rng(0)
+    chgs = small['chargers']
+    x, y = chgs.geometry.x.values, chgs.geometry.y.values
+    ids = rng.choice(len(chgs), size = (n, 2))
+    return [(x[a], y[a], x[b], y[b]) for a, b in ids]
+
+def test_requests_are_counted(small, tmp_path):
+    pairs = _pairs(small, 12)
+
+    ## Record with one request at a time, the local router is not shared across threads
+    with ReplayServer(tmp_path, fallback = small['backend']) as recorder:
+        with AsyncOSRMClient(recorder.url, concurrency = 1, retries = 1) as client:
+            expected = client.route_many(pairs)
+
+    metrics = Metrics()
+    previous = set_metrics(metrics)
+    try:
+        with ReplayServer(tmp_path, fail_rate = 0.3, seed = 0) as replay:
+            with AsyncOSRMClient(replay.url, concurrency = 8, retries = 20, backoff = 0.001) as client:
+                routes = client.route_many(pairs)
+                client.prefetch(pairs[:4])
+                routes[:4] = [client.route(*p) for p in pairs[:4]]
+    finally:
+        set_metrics(previous)
+
+    assert replay.requests == metrics.counters['http_requests'] > len(pairs) + 4
+    assert metrics.counters['http_retries'] == replay.requests - len(pairs) - 4
+    assert sum(metrics.histograms['http_seconds'][0]) == replay.requests
+    for a, b in zip(routes, expected):
+        assert (a is None) == (b is None)
+        if a is not None:
+            assert a.keys() == b.keys() and all(np.array_equal(a[k], b[k]) for k in a)
+
+def test_stale_prefetches_are_cancelled(small, tmp_path):
+    pairs = _pairs(small, 8)
+
+    with ReplayServer(tmp_path, fallback = small['backend']) as server:
+        with AsyncOSRMClient(server.url, concurrency = 1, retries = 1, max_pending = 3) as client:
+            client.prefetch(pairs[:4])
+            client.prefetch(pairs[4:])
+            assert list(client._pending) == [osrm_loc(*p) for p in pairs[-3:]]
+
+            ## A cancelled prefetch is fetched again when asked for
+            assert (client.route(*pairs[0]) is None) == (client.route_many(pairs[:1])[0] is None)
+            client.route(*pairs[-1])
+            assert len(client._pending) == 2
+        assert client._pending == {}
+
+def test_concurrent_cached_fallback(small, tmp_path):
+    pairs = _pairs(small, 8)
+    cache = CachedBackend(small['backend'], path = tmp_path / "routes.sqlite")
+
+    with ReplayServer(tmp_path / "fixtures", fallback = cache) as server:
+        with AsyncOSRMClient(server.url, concurrency = 8, retries = 1) as client:
+            routes = client.route_many(pairs)
+    cache.close()
+
+    for p, res in zip(pairs, routes):
+        assert (res is None) == (small['backend'].route(*p) is None)
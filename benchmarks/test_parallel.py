@@ -0,0 +1,58 @@
+import pickle
+from functools import partial
+from pathlib import Path
+
+import pytest
+
+from conftest import SMALL_ROUTE_DIST
+from ev_parallel import parallel_route_process
+from ev_routing import LocalBackend
+
+## Parallel route process ----
+## Runs depend only on the seed and the worker and epoch sizes: repeating one, or
+## sharing the chargers through shared memory instead of epoch files, gives the
+## same outcomes and chargers. The merged outcomes are returned as well as pickled,
+## as route_process does, and tiled runs read the stations from the tiles. A
+## backend that raises stops the run with the error reported instead of taking
+## down the pool.
+
+class Failing:
+
+    symmetric = True
+
+    def route(self, *coords):
+        raise RuntimeError("routing failed")
+
+def _run(small, directory, **kwargs):
+    kwargs.setdefault('backend_factory', partial(LocalBackend, small['roads'], crs = small['crs']))
+    evc_data = kwargs.pop('chargers', small['chargers'])
+    returned = parallel_route_process(small['roads'], evc_data, SMALL_ROUTE_DIST, SMALL_ROUTE_DIST * .25, small['crs'],
+                                      len(small['chargers']), n_sim = 12, n_workers = 2, sync_every = 2, seed = 0, **kwargs)
+    path, = Path(directory).glob("outcomes_*.pkl")
+    with open(path, 'rb') as f:
+        chgs, res = pickle.load(f)
+    path.unlink()
+    assert returned == res
+    return [(round(p.x, 6), round(p.y, 6)) for p in chgs.geometry], res
+
+def test_runs_repeat_and_modes_agree(small, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = _run(small, tmp_path)
+    assert len(first[1]) == 12 and sum(first[1]) > 0
+    assert _run(small, tmp_path) == first
+    assert _run(small, tmp_path, shared = True) == first
+
+def test_trip_errors_do_not_kill_the_pool(small, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    chgs, res = _run(small, tmp_path, backend_factory = Failing)
+    assert res == [] and len(chgs) == len(small['chargers'])
+    assert "Worker failed: RuntimeError('routing failed')" in capsys.readouterr().out
+
+def test_tiled_runs_read_stations_from_tiles(small, small_cache, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    chgs, res = _run(small, tmp_path, chargers = None, cache_dir = small_cache, tile_budget = 2**20)
+    assert len(res) == 12
+    assert len(chgs) == len(small['chargers']) + sum(res)
+
+    with pytest.raises(ValueError):
+        _run(small, tmp_path, cache_dir = small_cache, tile_budget = 2**20)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from ev_placement import FAIL_TYPES, recommend_sites
+from ev_transform import PROJ, transform
+
+## Charger placement ----
+## Dense groups of failures become the top ranked sites, near their centres and
+## with their failure counts as demand, while scattered failures stay noise. The
+## result does not depend on how the points are chunked.
+
+CENTRES = [(450000, 4400000, 400), (600000, 4300000, 250), (520000, 4200000, 100)]
+
+def _failures(seed = 0):
+    rng = np.random.default_rng(seed)
+    x, y = [], []
+    for cx, cy, n in CENTRES:
+        x.append(rng.normal(cx, 1500, n))
+        y.append(rng.normal(cy, 1500, n))
+    x.append(rng.uniform(300000, 700000, 30))
+    y.append(rng.uniform(4100000, 4500000, 30))
+    lon, lat = transform(np.concatenate(x), np.concatenate(y), PROJ, "EPSG:4326")
+    fal_typ = np.where(rng.random(len(lon)) < .5, FAIL_TYPES[0], FAIL_TYPES[1])
+    return pd.DataFrame({'lon': lon, 'lat': lat, 'fal_typ': fal_typ})
+
+def test_dense_failures_become_sites():
+    frame = _failures()
+    sites = recommend_sites(frame, eps = 5000, min_pts = 20)
+
+    assert len(sites) >= len(CENTRES)
+    top = sites.iloc[:len(CENTRES)]
+    x, y = transform(top.geometry.x.values, top.geometry.y.values, "EPSG:4326", PROJ)
+    for (cx, cy, n), sx, sy, demand in zip(CENTRES, x, y, top['demand']):
+        assert np.hypot(sx - cx, sy - cy) < 1000
+        assert n <= demand <= n + 5
+    assert (top['chargers_out_of_range'] + top['chargers_unavailable'] == top['demand']).all()
+    assert sites['demand'].sum() < len(frame)
+
+def test_chunks_give_the_same_sites():
+    frame = _failures(1)
+    whole = recommend_sites(frame, eps = 5000, min_pts = 20)
+    chunks = [(frame['lon'].values[i:i + 100], frame['lat'].values[i:i + 100], frame['fal_typ'].values[i:i + 100]) for i in range(0, len(frame), 100)]
+    chunked = recommend_sites(chunks, eps = 5000, min_pts = 20)
+
+    assert whole['demand'].tolist() == chunked['demand'].tolist()
+    assert np.allclose(whole.geometry.x, chunked.geometry.x) and np.allclose(whole.geometry.y, chunked.geometry.y)
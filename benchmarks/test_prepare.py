@@ -0,0 +1,50 @@
+import numpy as np
+
+from conftest import run_small
+from ev_prepare import load_layer, open_arrays, open_sampler, prepare, read_manifest
+from ev_sampler import VertexSampler
+
+## Dataset cache ----
+## The cache holds the layers as prepared, is reused while the sources are
+## unchanged, and a run started the way ev_process starts one (charger layer and
+## memory mapped vertex arrays only, no road geometry) simulates the same trips
+## as one over the road layer. String columns are cached without pickling.
+
+def test_cache_is_reused(small_cache):
+    manifest = read_manifest(small_cache)
+    stamp = (small_cache / "roads.parquet").stat().st_mtime_ns
+    roads, stations = (next(s for s in manifest['sources'] if s.endswith(name)) for name in ("roads.shp", "stations.shp"))
+    assert prepare(roads, stations, small_cache) == small_cache
+    assert (small_cache / "roads.parquet").stat().st_mtime_ns == stamp
+
+def test_cache_holds_string_columns(small, tmp_path):
+    roads = small['roads'].copy()
+    roads['record'] = ["R" + str(r) for r in roads['record']]
+    roads.to_file(tmp_path / "roads.shp")
+    small['chargers'].to_file(tmp_path / "stations.shp")
+    cache = prepare(tmp_path / "roads.shp", tmp_path / "stations.shp", tmp_path / "cache")
+
+    record = open_arrays(cache)['road_record']
+    assert record.dtype.kind == "U" and list(record) == list(roads['record'])
+    assert open_sampler(cache).point(0, small['crs'])['road_row_num'] == roads['record'].iloc[0]
+
+def test_sampler_arrays_match_roads(small, small_cache):
+    cached = open_sampler(small_cache)
+    direct = VertexSampler(small['roads'])
+    assert cached.crs == read_manifest(small_cache)['proj']
+    for name in ('offsets', 'record', 'level'):
+        assert np.array_equal(getattr(cached, name), getattr(direct, name))
+
+    ## Cached vertices went through the shapefile and back to the projected CRS
+    assert np.allclose(cached.x, direct.x, rtol = 0, atol = 1e-3) and np.allclose(cached.y, direct.y, rtol = 0, atol = 1e-3)
+
+def test_run_without_road_layer(small, small_cache, tmp_path):
+    chgs = load_layer(small_cache, 'stations')
+    crs = read_manifest(small_cache)['crs']
+    assert len(chgs) == len(small['chargers'])
+
+    cached_chgs, cached = run_small(dict(small, roads = None, chargers = chgs, crs = crs), tmp_path, n_sim = 5,
+                                    sampler = open_sampler(small_cache))
+    _, direct = run_small(small, tmp_path, n_sim = 5)
+    assert cached == direct
+    assert len(cached_chgs) == len(chgs) + sum(cached)
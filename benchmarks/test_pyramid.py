@@ -0,0 +1,73 @@
+import json
+
+import numpy as np
+
+from ev_pyramid import TrafficGrid, mercator_pixels, write_pyramid
+
+## Tile pyramid ----
+## A route counts once in every pixel it crosses however densely it is sampled,
+## grids saved and merged add up, and every zoom of the pyramid is written as
+## PNG tiles whose busiest pixel is recorded in meta.json. A viewer given a local
+## Leaflet copy refers to nothing off the machine.
+
+LON = np.array([-106.0, -105.0, -105.0])
+LAT = np.array([39.0, 39.0, 40.0])
+
+def _pixels(grid, layer = "routes"):
+    return sum(int((t > 0).sum()) for t in grid.tiles[layer].values()), max(int(t.max()) for t in grid.tiles[layer].values())
+
+def test_route_counts_once_per_pixel():
+    sparse, dense = TrafficGrid(max_zoom = 8), TrafficGrid(max_zoom = 8)
+    sparse.add_route(LON, LAT)
+    t = np.linspace(0, 1, 500)
+    dense.add_route(np.concatenate([LON[0] + t * (LON[1] - LON[0]), LON[1] + t * (LON[2] - LON[1])]),
+                    np.concatenate([LAT[0] + t * (LAT[1] - LAT[0]), LAT[1] + t * (LAT[2] - LAT[1])]))
+
+    assert _pixels(sparse) == _pixels(dense)
+    n, top = _pixels(sparse)
+    px, py = mercator_pixels(LON, LAT, 8)
+    assert top == 1
+    assert n >= abs(px[1] - px[0]) + abs(py[2] - py[1])
+
+def test_saved_grids_merge(tmp_path):
+    grid = TrafficGrid(max_zoom = 8)
+    grid.add_route(LON, LAT)
+    grid.add_failures(LON, LAT)
+    grid.save(tmp_path / "grid.npz")
+
+    merged = TrafficGrid.load(tmp_path / "grid.npz")
+    merged.merge(grid)
+    assert merged.n_routes == 2 and merged.n_failures == 2 * len(LON)
+    assert _pixels(merged)[1] == 2
+    assert sum(int(t.sum()) for t in merged.tiles["failures"].values()) == 2 * len(LON)
+
+def test_pyramid_has_every_zoom(tmp_path):
+    grid = TrafficGrid(max_zoom = 8)
+    grid.add_route(LON, LAT)
+
+    ## Two failures in different pixels at zoom 8 that share one at zoom 4
+    grid.add_failures([-106.05, -106.02], [39.0, 39.0])
+    write_pyramid(grid, tmp_path, min_zoom = 4)
+
+    meta = json.loads((tmp_path / "meta.json").read_text())
+    for layer in ("routes", "failures"):
+        for z in range(4, 9):
+            tiles = list((tmp_path / layer / str(z)).glob("*/*.png"))
+            assert tiles and all(p.read_bytes()[:8] == b"\x89PNG\r\n\x1a\n" for p in tiles)
+    assert meta['layers']['routes']['max_count']['8'] == 1
+    assert meta['layers']['failures']['max_count']['8'] == 1
+    assert meta['layers']['failures']['max_count']['4'] == 2
+
+def test_offline_viewer(tmp_path):
+    grid = TrafficGrid(max_zoom = 8)
+    grid.add_route(LON, LAT)
+
+    vendor = tmp_path / "vendor"
+    vendor.mkdir()
+    for name in ("leaflet.js", "leaflet.css"):
+        (vendor / name).write_text("/* " + name + " */")
+    write_pyramid(grid, tmp_path / "pyramid", leaflet = vendor)
+
+    html = (tmp_path / "pyramid" / "index.html").read_text()
+    assert "http" not in html
+    assert 'src="leaflet/leaflet.js"' in html and (tmp_path / "pyramid" / "leaflet" / "leaflet.js").exists()
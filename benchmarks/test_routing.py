@@ -0,0 +1,143 @@
+import json
+
+import numpy as np
+import polyline
+
+import ev_functions as evc
+from ev_osrm import osrm_response
+from ev_routing import CachedBackend, decode_polyline, parse_osrm, parse_osrm_text
+from ev_sampler import VertexSampler
+
+## Routing ----
+## The local router finds shortest paths (checked against scipy's Dijkstra over
+## the same graph), responses decode as the reference polyline and json parsers
+## decode them, Route arrays add up as the old route detail frame did, and the
+## route cache answers repeat and reversed requests without the backend.
+
+class Counting:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.symmetric = backend.symmetric
+        self.calls = 0
+
+    def route(self, *coords):
+        self.calls += 1
+        return self.backend.route(*coords)
+
+def _pairs(small, n, seed = 0):
+    rng = np.random.default_rng(seed)
+    bounds = small['chargers'].total_bounds
+    lon = rng.uniform(bounds[0], bounds[2], (n, 2))
+    lat = rng.uniform(bounds[1], bounds[3], (n, 2))
+    return [(lon[i, 0], lat[i, 0], lon[i, 1], lat[i, 1]) for i in range(n)]
+
+def test_local_routes_are_shortest(small):
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+
+    g = small['backend']
+    csr = csr_matrix((g.weights, g.indices, g.indptr), shape = (len(g), len(g)))
+    for lon1, lat1, lon2, lat2 in _pairs(small, 10):
+        s, t = g.snap(lon1, lat1), g.snap(lon2, lat2)
+        expected = dijkstra(csr, indices = s)[t]
+        res = g.route(lon1, lat1, lon2, lat2)
+        if np.isinf(expected):
+            assert res is None
+            continue
+        assert np.isclose(res['distance'], expected)
+        assert np.isclose(sum(res['distances']), expected)
+
+def test_decoding_matches_reference(small):
+    for pair in _pairs(small, 5):
+        res = small['backend'].route(*pair)
+        if res is None:
+            continue
+        text = json.dumps(osrm_response(res))
+        body = json.loads(text)
+        geometry = body['routes'][0]['geometry']
+
+        assert np.array_equal(decode_polyline(geometry), np.array([(lon, lat) for lat, lon in polyline.decode(geometry)]))
+        fast, slow = parse_osrm_text(text), parse_osrm(body)
+        assert np.array_equal(fast['distances'], slow['distances'])
+        assert np.array_equal(fast['coords'], slow['coords'])
+        assert fast['start'] == slow['start'] and fast['distance'] == slow['distance']
+
+def test_route_arrays_match_frame(small):
+    sampler = VertexSampler(small['roads'], rng = np.random.default_rng(0))
+    for _ in range(5):
+        start_pos = sampler.draw(small['crs'], level = 3)
+        end_pos = sampler.draw(small['crs'], level = 3)
+        route = evc.calculate_route(start_pos, end_pos, small['crs'], return_trip = True, backend = small['backend'])
+        if route is None:
+            continue
+        frame = route['route_detail']
+        assert len(frame) == 2 * len(route) - 1
+        assert route.total_dist == frame['total_dist'].iloc[-1]
+        assert np.isclose(route.total_dist, route.cum_dist[-1] + route.return_dist.sum())
+
+def test_cache_serves_repeats(small, tmp_path):
+    backend = Counting(small['backend'])
+    pairs = [p for p in _pairs(small, 6, seed = 1) if small['backend'].route(*p) is not None]
+
+    cache = CachedBackend(backend, path = tmp_path / "routes.sqlite", max_memory = 2)
+    first = [cache.route(*p) for p in pairs]
+    assert backend.calls == len(pairs)
+    again = [cache.route(*p) for p in pairs]
+    reversed_ = [cache.route(p[2], p[3], p[0], p[1]) for p in pairs]
+    assert backend.calls == len(pairs)
+    cache.close()
+
+    ## A new cache over the same file reads the routes back from disk
+    cache = CachedBackend(backend, path = tmp_path / "routes.sqlite")
+    for p, res, rev in zip(pairs, first, reversed_):
+        from_disk = cache.route(*p)
+        assert from_disk['distance'] == res['distance']
+        assert np.array_equal(np.asarray(rev['coords']), np.asarray(res['coords'])[::-1])
+    assert backend.calls == len(pairs)
+    assert cache.stats()['disk_hits'] == len(pairs)
+    assert [r['distance'] for r in again] == [r['distance'] for r in first]
+    cache.close()
+
+def test_cache_stays_within_disk_budget(small, tmp_path):
+    pairs = [p for p in _pairs(small, 8, seed = 2) if small['backend'].route(*p) is not None]
+    cache = CachedBackend(small['backend'], path = tmp_path / "routes.sqlite", max_disk = 3)
+    for p in pairs:
+        cache.route(*p)
+    assert cache.db.execute("SELECT COUNT(*) FROM routes").fetchone()[0] == min(3, len(pairs))
+    cache.close()
+
+def test_shared_cache_file_stays_within_budget(small, tmp_path):
+    pairs = [p for p in _pairs(small, 8, seed = 3) if small['backend'].route(*p) is not None]
+    a = CachedBackend(small['backend'], path = tmp_path / "routes.sqlite", max_disk = 3)
+    b = CachedBackend(small['backend'], path = tmp_path / "routes.sqlite", max_disk = 3)
+    for i, p in enumerate(pairs):
+        (a if i % 2 else b).route(*p)
+    assert a.db.execute("SELECT COUNT(*) FROM routes").fetchone()[0] == min(3, len(pairs))
+    assert a.db.execute("SELECT n FROM route_count").fetchone()[0] == min(3, len(pairs))
+    a.close()
+    b.close()
+
+def test_disk_hits_hold_no_write_lock(small, tmp_path):
+    import sqlite3
+
+    pairs = [p for p in _pairs(small, 6, seed = 4) if small['backend'].route(*p) is not None]
+    writer = CachedBackend(small['backend'], path = tmp_path / "routes.sqlite")
+    writer.route(*pairs[0])
+    writer.close()
+
+    reader = CachedBackend(small['backend'], path = tmp_path / "routes.sqlite", max_memory = 0)
+    writer = CachedBackend(small['backend'], path = tmp_path / "routes.sqlite")
+    writer.db.execute("PRAGMA busy_timeout = 100")
+    reader.route(*pairs[0])
+    assert reader.stats()['disk_hits'] == 1
+    try:
+        writer.route(*pairs[1])
+    except sqlite3.OperationalError as e:
+        raise AssertionError("disk hit kept the database locked") from e
+
+    ## The use time is written on close
+    reader.close()
+    used = dict(writer.db.execute("SELECT key, used FROM routes").fetchall())
+    assert used[reader._key(*pairs[0])] > 1
+    writer.close()
@@ -0,0 +1,29 @@
+import numpy as np
+
+from ev_sampler import VertexSampler
+
+## Vertex sampler ----
+## Start points come from level 3 roads only, and the annulus query returns the
+## same vertices as a distance scan over every vertex, with draws inside the ring.
+
+def test_start_draws_keep_level(small):
+    sampler = VertexSampler(small['roads'], rng = np.random.default_rng(0))
+    for weighted in (False, True):
+        ids = sampler.sample(500, level = 3, weighted = weighted)
+        assert (sampler.vertex_level[ids] == 3).all()
+
+def test_annulus_matches_scan(small):
+    sampler = VertexSampler(small['roads'], rng = np.random.default_rng(0))
+    rng = np.random.default_rng(1)
+    for vertex in sampler.sample(10):
+        x, y = sampler.x[vertex], sampler.y[vertex]
+        d = np.hypot(sampler.x - x, sampler.y - y)
+        for r_min, r_max in ((20000, None), (20000, 60000), (0, 15000)):
+            expected = np.flatnonzero((d >= r_min) & ((r_max is None) or (d <= r_max)))
+            assert np.array_equal(np.sort(sampler.grid.annulus(x, y, r_min, r_max)), expected)
+
+            drawn = sampler.sample_annulus(x, y, r_min, r_max, rng = rng)
+            if len(expected):
+                assert drawn in expected
+            else:
+                assert drawn is None
@@ -0,0 +1,66 @@
+import multiprocessing as mp
+
+import numpy as np
+
+from ev_sampler import VertexSampler
+from ev_shared import SharedArrays, SharedChargers, share_roads, shared_sampler
+
+## Shared memory ----
+## A worker process attaching to published road and charger arrays reads the
+## same values, sees chargers the owner appends after it attached, and a sampler
+## over shared arrays draws what one over the road layer draws.
+
+def _attach_sum(handle):
+    with SharedArrays(handle) as shared:
+        return {name: float(shared[name].sum()) for name in handle}
+
+def _attach_chargers(handle, queue, go):
+    chargers = SharedChargers.attach(handle)
+    queue.put(chargers.rows()[0])
+    go.wait()
+    added = chargers.added()
+    queue.put(None if added is None else [(p.x, p.y) for p in added.geometry])
+    chargers.close()
+
+def test_worker_reads_shared_roads(small):
+    ctx = mp.get_context("spawn")
+    with share_roads(small['roads']) as roads:
+        with ctx.Pool(1) as pool:
+            sums = pool.apply(_attach_sum, (roads.handle,))
+        assert sums == {name: float(roads[name].sum()) for name in roads.handle}
+
+        a = shared_sampler(roads, small['roads'].crs, rng = np.random.default_rng(0))
+        b = VertexSampler(small['roads'], rng = np.random.default_rng(0))
+        assert np.array_equal(a.sample(100, level = 3), b.sample(100, level = 3))
+
+def test_worker_sees_appended_chargers(small):
+    ctx = mp.get_context("spawn")
+    chgs = small['chargers']
+    shared = SharedChargers.publish(chgs, capacity = 10)
+    queue, go = ctx.Queue(), ctx.Event()
+    worker = ctx.Process(target = _attach_chargers, args = (shared.handle, queue, go))
+    worker.start()
+    try:
+        assert queue.get(timeout = 60) == len(chgs)
+        shared.append(chgs.iloc[:3])
+        go.set()
+        assert queue.get(timeout = 60) == [(p.x, p.y) for p in chgs.geometry.iloc[:3]]
+    finally:
+        worker.join(60)
+        shared.close()
+    assert worker.exitcode == 0
+
+## A separate interpreter has its own resource tracker, which must not unlink the
+## blocks when it exits
+def test_attaching_process_leaves_blocks(small):
+    import subprocess
+    import sys
+    from pathlib import Path
+
+    src = str(Path(__file__).resolve().parent.parent / "src")
+    code = "import sys; sys.path.insert(0, {!r}); from ev_shared import SharedArrays; SharedArrays({!r}).close()"
+    with share_roads(small['roads']) as roads:
+        done = subprocess.run([sys.executable, "-c", code.format(src, roads.handle)], capture_output = True, text = True, timeout = 60)
+        assert done.returncode == 0 and "leaked" not in done.stderr
+        with SharedArrays(roads.handle) as again:
+            assert np.array_equal(again['road_x'], roads['road_x'])
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+import ev_functions as evc
+from conftest import SMALL_ROUTE_DIST
+from ev_candidates import CandidateGenerator
+from ev_index import ChargerIndex
+from ev_sampler import VertexSampler
+
+## Trip simulation ----
+## simulate_trip jumps along each route to the next vertex where a decision is
+## made. Stepping vertex by vertex instead, as it used to, must give the same
+## outcome, failure point and occupancy draws for every trip, seed and alpha.
+
+## The per vertex loop simulate_trip replaced, over the same routes and index
+def _stepwise(route, start_pos, end_pos, route_dist, fuel_dist, crs, chg_index, alpha, backend, random_state):
+    sim_route = route
+    rng = route_dist
+    route_index = 0
+    trip_direction = 1
+
+    while rng > 0 & trip_direction < 3:
+        rng -= sim_route.dist[route_index]
+
+        if rng < fuel_dist:
+            current_location = sim_route.point(route_index)
+            nearest_stations = chg_index.nearest(current_location)
+            nearest_charger = nearest_stations['geometry'].iloc[0]
+            for row in nearest_stations.index:
+                charger_available = not (random_state.poisson(alpha, 1) >= nearest_stations['nm_chrg'].iloc[0])
+                if charger_available:
+                    break
+
+            if charger_available:
+                re_route = evc.calculate_route(evc.format_coord(current_location, crs), evc.format_coord(nearest_charger, crs), crs,
+                                               return_trip = False, backend = backend)
+                for i in range(len(re_route)):
+                    rng -= re_route.dist[i]
+                    if rng <= 0:
+                        return "Chargers out of range", re_route.point(i)
+
+                rng = route_dist
+                target = end_pos if (route_index < len(sim_route) - 1) & (trip_direction == 1) else start_pos
+                sim_route = evc.calculate_route(evc.format_coord(nearest_charger, crs), target, crs, return_trip = False, backend = backend)
+                route_index = 0
+            elif rng <= 0:
+                return "Chargers unavailable", current_location
+
+        if (route_index == len(sim_route) - 1) & (trip_direction == 1):
+            sim_route = evc.calculate_route(evc.format_coord(sim_route.point(route_index), crs), start_pos, crs, return_trip = False, backend = backend)
+            route_index = 0
+            trip_direction = 2
+        elif (route_index == len(sim_route) - 1) & (trip_direction == 2):
+            return None
+
+        route_index += 1
+
+    return None
+
+@pytest.fixture(scope = "module")
+def small_trips(small):
+    candidates = CandidateGenerator(VertexSampler(small['roads']), SMALL_ROUTE_DIST, small['crs'])
+    rng = np.random.default_rng(0)
+    trips = []
+    while len(trips) < 15:
+        pair = candidates.propose(rng = rng)
+        if pair is None:
+            continue
+        route = evc.route_pair(pair, candidates, small['crs'], backend = small['backend'])
+        if route is not None:
+            trips.append((route, *pair))
+    return trips
+
+@pytest.mark.parametrize("alpha", [0.5, 2, 6])
+@pytest.mark.parametrize("fuel_share", [.25, .05])
+def test_simulate_trip_matches_stepwise(small, small_trips, alpha, fuel_share):
+    chg_index = ChargerIndex(small['chargers'])
+    fuel_dist = SMALL_ROUTE_DIST * fuel_share
+
+    for seed, (route, start_pos, end_pos) in enumerate(small_trips):
+        a, b = np.random.default_rng(seed), np.random.default_rng(seed)
+        outcome = evc.simulate_trip(route, start_pos, end_pos, small['chargers'], SMALL_ROUTE_DIST, fuel_dist, small['crs'], alpha = alpha,
+                                    chg_index = chg_index, backend = small['backend'], random_state = a)
+        expected = _stepwise(route, start_pos, end_pos, SMALL_ROUTE_DIST, fuel_dist, small['crs'], chg_index, alpha, small['backend'], b)
+
+        if expected is None:
+            assert outcome is None
+        else:
+            assert outcome['fal_typ'].iloc[0] == expected[0]
+            assert outcome['geometry'].iloc[0].equals(expected[1])
+        assert a.bit_generator.state == b.bit_generator.state
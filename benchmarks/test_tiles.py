@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from geopandas import GeoSeries
+from shapely.geometry import Point
+
+from conftest import run_small
+from ev_estimate import grid_regions
+from ev_index import ChargerIndex
+from ev_prepare import load_layers, open_sampler
+from ev_tiles import TiledChargers, open_tiled_sampler
+
+## Tiled layout ----
+## Tiles hold every vertex and station once, stratified draws from tiles follow the
+## in-memory sampler's strata, and corridor charger lookups match a full index.
+
+def test_tiles_hold_every_vertex(small_cache):
+    sampler = open_sampler(small_cache)
+    tiled = open_tiled_sampler(small_cache, tile_size = 100000, budget = 2**20)
+    assert len(tiled) == len(sampler)
+    assert tiled.store.station_count.sum() == len(load_layers(small_cache)[2])
+    assert np.allclose(tiled.road_midpoints(), sampler.road_midpoints())
+
+def test_tiles_stratified_draws(small_cache):
+    sampler = open_sampler(small_cache)
+    tiled = open_tiled_sampler(small_cache, tile_size = 100000, budget = 2**20, rng = np.random.default_rng(0))
+
+    codes, names = grid_regions(sampler, 200000)
+    tiled_codes, tiled_names = grid_regions(tiled, 200000)
+    assert np.array_equal(codes, tiled_codes) and np.array_equal(names, tiled_names)
+
+    sampler.set_strata(codes)
+    tiled.set_strata(codes)
+    for h in range(len(names)):
+        for weighted in (False, True):
+            assert np.isclose(tiled.pool_weight(3, weighted, h), sampler.pool_weight(3, weighted, h))
+
+    h = int(np.argmax([sampler.pool_weight(3, False, h) for h in range(len(names))]))
+    for _ in range(50):
+        vertex = tiled.sample(level = 3, stratum = h)
+        assert codes[tiled.road[vertex]] == h
+
+def test_tiled_chargers_match_index(small, small_cache):
+    chgs = load_layers(small_cache)[2]
+    store = open_tiled_sampler(small_cache, tile_size = 50000, budget = 2**16).store
+    tiled = TiledChargers(store, buffer = 10000)
+    full = ChargerIndex(chgs)
+
+    added = chgs.iloc[[3, 7]].copy()
+    tiled.insert(added)
+    full.insert(added)
+
+    rng = np.random.default_rng(0)
+    lon = rng.uniform(chgs.geometry.x.min() - 1, chgs.geometry.x.max() + 1, 100)
+    lat = rng.uniform(chgs.geometry.y.min() - 1, chgs.geometry.y.max() + 1, 100)
+    tiled.focus(lon[:2], lat[:2], chgs.crs)
+    for point in GeoSeries.from_xy(lon, lat, crs = chgs.crs):
+        a, b = tiled.nearest(point), full.nearest(point)
+        assert a['geometry'].iloc[0].equals(b['geometry'].iloc[0])
+        assert list(a['nm_chrg']) == list(b['nm_chrg'])
+    assert len(tiled.data) == len(full.data) == len(tiled)
+
+def test_tiled_chargers_empty(small_cache):
+    store = open_tiled_sampler(small_cache, tile_size = 50000, budget = 2**16).store
+    store.station_count = np.zeros_like(store.station_count)
+    tiled = TiledChargers(store)
+    with pytest.raises(ValueError):
+        tiled.nearest(Point(-105, 40))
+
+def test_tiled_route_process(small, small_cache, tmp_path):
+    chgs, res = run_small(dict(small, chargers = None), tmp_path, n_sim = 10, cache_dir = small_cache, tile_budget = 2**20, stratify = True, regions = 200000)
+    assert len(res) == 10
+    assert len(chgs) == len(small['chargers']) + sum(res)
+
+    ## The tiles hold the stations, a charger layer given as well would be ignored
+    with pytest.raises(ValueError):
+        run_small(small, tmp_path, n_sim = 1, cache_dir = small_cache, tile_budget = 2**20)
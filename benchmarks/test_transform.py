@@ -0,0 +1,22 @@
+import numpy as np
+from geopandas import GeoDataFrame, points_from_xy
+
+from ev_transform import PROJ, position, position_xy, transformer
+
+## Coordinate transforms ----
+## Cached transforms give the coordinates GeoDataFrame.to_crs gives, and a
+## position's lazy 'point' frame holds the same point as its floats.
+
+def test_positions_match_to_crs(small):
+    for x, y in (g.coords[0] for g in small['roads'].geometry.iloc[:20]):
+        pos = position(x, y, PROJ)
+        expected = GeoDataFrame(geometry = points_from_xy([x], [y]), crs = PROJ).to_crs(small['crs']).geometry.iloc[0]
+        lon, lat = position_xy(pos, small['crs'])
+        assert np.isclose(lon, expected.x, rtol = 0, atol = 1e-9) and np.isclose(lat, expected.y, rtol = 0, atol = 1e-9)
+
+        ## The frame built on demand holds the same point
+        pos['point']
+        del pos['xy']
+        assert np.allclose(position_xy(pos, PROJ), (x, y))
+
+    assert transformer(PROJ, small['crs']) is transformer(PROJ, small['crs'])
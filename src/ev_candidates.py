@@ -0,0 +1,66 @@
+from ev_metrics import get_metrics
+
+## Trip candidates ----
+## Proposes start / end pairs for route_process and keeps count of what happens
+## to them. The sampling distribution is the one route_process has always used:
+##
+##   start  a level 3 road vertex (road uniformly or by length, then a vertex)
+##   end    a vertex drawn the same way from the roads between route_dist / 2 and
+##          max_dist metres (straight line, projected) from the start
+##   accept the pair if it routes and the round trip is longer than route_dist
+##
+## so accepted trips follow that distribution conditioned on acceptance. Every
+## proposal with an end point is routed: the end point is already at least
+## route_dist / 2 from the start in a straight line, so only snapping to the road
+## network can bring a round trip in under route_dist and there is nothing cheaper
+## to tell such pairs apart by. The generator counts proposals, routing calls and
+## acceptances, and stats() reports them as rates.
+
+class CandidateGenerator:
+
+    def __init__(self, sampler, route_dist, crs, max_dist = None, weighted = False):
+        self.sampler = sampler
+        self.route_dist = route_dist
+        self.crs = crs
+        self.max_dist = max_dist
+        self.weighted = weighted
+
+        self.counts = dict.fromkeys(['proposed', 'no_end_point', 'no_route', 'short_route', 'accepted'], 0)
+
+    def _count(self, key):
+        self.counts[key] += 1
+        get_metrics().count('candidates_' + key)
+
+    ## Next start and end pair to route, or None if the end point draw failed. With
+    ## a stratum the start point is drawn from that stratum's roads (see
+    ## VertexSampler.set_strata)
+    def propose(self, rng = None, stratum = None):
+        self._count('proposed')
+        start_pos = self.sampler.draw(self.crs, level = 3, weighted = self.weighted, rng = rng, stratum = stratum)
+        sx, sy = self.sampler.x[start_pos['vertex']], self.sampler.y[start_pos['vertex']]
+        end_pos = self.sampler.draw_annulus(sx, sy, self.crs, self.route_dist / 2, self.max_dist, weighted = self.weighted, rng = rng)
+        if end_pos is None:
+            self._count('no_end_point')
+            return None
+        return start_pos, end_pos
+
+    ## Record what routing made of a proposed pair, returning True if it is accepted
+    def record(self, route):
+        if route is None:
+            self._count('no_route')
+            return False
+
+        accepted = route.total_dist > self.route_dist
+        self._count('accepted' if accepted else 'short_route')
+        return accepted
+
+    ## Accepted pairs per routing call and per proposal
+    def stats(self):
+        routed = self.counts['accepted'] + self.counts['short_route'] + self.counts['no_route']
+        out = dict(self.counts)
+        out.update({
+            'routing_calls': routed,
+            'acceptance_rate': self.counts['accepted'] / routed if routed else None,
+            'proposal_acceptance_rate': self.counts['accepted'] / self.counts['proposed'] if self.counts['proposed'] else None
+        })
+        return out
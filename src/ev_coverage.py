@@ -0,0 +1,185 @@
+import json
+from heapq import heappop, heappush
+from pathlib import Path
+
+import numpy as np
+
+from ev_transform import PROJ, WGS84, transform
+
+## Network coverage map ----
+## Network distance (metres, over the LocalBackend road graph) from every graph node
+## to its nearest charger, with that charger's ChargerIndex id and the next node on
+## the way there, found by one multi source Dijkstra seeded at every station's
+## nearest node. Three arrays of one entry per node:
+##
+##   dist     float64 distance to the nearest station (inf where none is reachable)
+##   station  int32 id of that station (-1 where none is reachable)
+##   pred     int32 next node towards it (-1 at the station's own node)
+##
+## A charger added later only takes over the nodes it is now nearest to. Those form
+## a connected region around its node (every node on the shortest path to a node
+## it takes over is also taken over), so the update is a Dijkstra from the new node
+## that stops at any node already as close to another station, rather than a full
+## recompute. Stations stacked on one node keep the lowest id. With a path the
+## arrays are kept on disk and reused while the graph and stations still match,
+## written after a rebuild, every save_every added stations and on close().
+class CoverageMap:
+
+    def __init__(self, graph, path = None, rebuild_size = 64, save_every = 100):
+        self.graph = graph
+        self.path = None if path is None else Path(path)
+        self.rebuild_size = rebuild_size
+        self.save_every = save_every
+        self._unsaved = 0
+
+        n = len(graph)
+        self.dist = np.full(n, np.inf)
+        self.station = np.full(n, -1, dtype = np.int32)
+        self.pred = np.full(n, -1, dtype = np.int32)
+        self.xy = np.empty((0, 2))
+        self.nodes = np.empty(0, dtype = np.int64)
+
+        if self.path is not None:
+            self.path.mkdir(parents = True, exist_ok = True)
+            self._load()
+
+    def __len__(self):
+        return len(self.xy)
+
+    def _load(self):
+        meta_path = self.path / "meta.json"
+        if not meta_path.exists() or json.loads(meta_path.read_text()) != {'n_nodes': len(self.graph)}:
+            return
+        self.dist = np.load(self.path / "dist.npy")
+        self.station = np.load(self.path / "station.npy")
+        self.pred = np.load(self.path / "pred.npy")
+        self.xy = np.load(self.path / "stations.npy")
+        self.nodes = self.graph._tree.query(self.xy)[1] if len(self.xy) else np.empty(0, dtype = np.int64)
+
+    def save(self):
+        self._unsaved = 0
+        if self.path is None:
+            return
+        for name, arr in (("dist", self.dist), ("station", self.station), ("pred", self.pred), ("stations", self.xy)):
+            np.save(self.path / (name + ".npy"), arr)
+        (self.path / "meta.json").write_text(json.dumps({'n_nodes': len(self.graph)}))
+
+    ## Write any stations added since the last save
+    def close(self):
+        if self._unsaved:
+            self.save()
+
+    ## Full multi source search from the nodes of every station at projected xy
+    def build(self, xy):
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import dijkstra
+
+        g = self.graph
+        self.xy = np.asarray(xy, dtype = np.float64).reshape(-1, 2)
+        self.nodes = g._tree.query(self.xy)[1] if len(self.xy) else np.empty(0, dtype = np.int64)
+        n = len(g)
+        if not len(self.nodes):
+            self.dist[:] = np.inf
+            self.station[:] = -1
+            self.pred[:] = -1
+            return
+
+        ## Lowest station id on each seeded node
+        seeds, first = np.unique(self.nodes, return_index = True)
+
+        csr = csr_matrix((g.weights, g.indices, g.indptr), shape = (n, n))
+        dist, pred, source = dijkstra(csr, directed = True, indices = seeds, return_predecessors = True, min_only = True)
+
+        reached = source >= 0
+        self.dist = dist
+        self.pred = np.where(pred >= 0, pred, -1).astype(np.int32)
+        self.station = np.full(n, -1, dtype = np.int32)
+        self.station[reached] = first[np.searchsorted(seeds, source[reached])]
+
+    ## Take over the nodes a new station at projected (x, y) with id i is nearest to
+    def add(self, i, x, y):
+        g = self.graph
+        s = int(g._tree.query([x, y])[1])
+        self.xy = np.concatenate([self.xy, [[x, y]]])
+        self.nodes = np.append(self.nodes, s)
+        if self.dist[s] <= 0:
+            return 0
+
+        indptr, indices, weights = g.indptr, g.indices, g.weights
+        dist, station, pred = self.dist, self.station, self.pred
+        dist[s], station[s], pred[s] = 0, i, -1
+        heap = [(0.0, s)]
+        changed = 0
+
+        while heap:
+            d, n = heappop(heap)
+            if d > dist[n]:
+                continue
+            changed += 1
+            for k in range(indptr[n], indptr[n + 1]):
+                m = int(indices[k])
+                nd = d + weights[k]
+                if nd < dist[m]:
+                    dist[m], station[m], pred[m] = nd, i, n
+                    heappush(heap, (nd, m))
+
+        return changed
+
+    ## Bring the map in line with a ChargerIndex: keep the stations that still match
+    ## and add the rest one at a time, or rebuild when they differ or many are new
+    def sync(self, chg_index):
+        coords = chg_index.coords
+        n = min(len(self), len(coords))
+        same = np.all(np.abs(self.xy[:n] - coords[:n]) < 1e-6, axis = 1).all()
+        if (not same) or (len(self) > len(coords)) or (len(self) == 0) or (len(coords) - len(self) > self.rebuild_size):
+            self.build(coords)
+            self.save()
+        else:
+            for i in range(len(self), len(coords)):
+                self.add(i, *coords[i])
+                self._unsaved += 1
+            if self._unsaved >= self.save_every:
+                self.save()
+
+    ## Nearest graph node of projected points and the distance to it
+    def snap(self, x, y):
+        off, node = self.graph._tree.query(np.column_stack([np.atleast_1d(x), np.atleast_1d(y)]))
+        return node, off
+
+    ## Network distance to, and id of, the nearest station from projected (x, y),
+    ## counting the straight line to the nearest node, plus that node
+    def at(self, x, y):
+        node, off = self.snap(x, y)
+        node, off = int(node[0]), float(off[0])
+        return off + float(self.dist[node]), int(self.station[node]), node
+
+    ## Nodes from node to its nearest station
+    def path_to_station(self, node):
+        path = [node]
+        while self.pred[path[-1]] >= 0:
+            path.append(int(self.pred[path[-1]]))
+        return np.asarray(path)
+
+    ## Projected point where a vehicle at projected (x, y) with range rng runs out
+    ## on the way to its nearest station (the first node it cannot reach)
+    def stranded_at(self, x, y, rng):
+        node, off = self.snap(x, y)
+        path = self.path_to_station(int(node[0]))
+        px, py = self.graph.x[path], self.graph.y[path]
+        left = rng - off - np.concatenate([[0], np.cumsum(np.hypot(np.diff(px), np.diff(py)))])
+        i = int(np.argmax(left <= 0)) if (left <= 0).any() else len(path) - 1
+        return px[i], py[i]
+
+    ## Graph nodes as points with their distance to and id of the nearest station,
+    ## keeping only nodes further than min_dist: with min_dist set to a vehicle range
+    ## this is the layer of roads out of reach of every charger
+    def frame(self, crs = WGS84, min_dist = 0):
+        from geopandas import GeoDataFrame, points_from_xy
+
+        keep = ~(self.dist < min_dist)
+        x, y = transform(self.graph.x[keep], self.graph.y[keep], PROJ, crs)
+        return GeoDataFrame({
+            'dist': self.dist[keep],
+            'station': self.station[keep],
+            'geometry': points_from_xy(x, y)
+        }, crs = crs)
@@ -0,0 +1,140 @@
+import numpy as np
+from scipy.stats import norm
+
+## Wilson score interval for failures out of n trials
+def wilson(failures, n, level = 0.95):
+    if n == 0:
+        return 0.0, 1.0
+    z = norm.ppf(0.5 + level / 2)
+    p = failures / n
+    centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(centre - half, 0.0), min(centre + half, 1.0)
+
+## Per road region codes from square cells of side size (metres, sampler CRS)
+## holding each road's middle vertex, and the cell id of every code
+def grid_regions(sampler, size = 100000):
+    x0, y0 = sampler.origin
+    mx, my = sampler.road_midpoints()
+    cx = np.floor((mx - x0) / size).astype(np.int64)
+    cy = np.floor((my - y0) / size).astype(np.int64)
+    names, codes = np.unique(cy * (cx.max() + 1) + cx, return_inverse = True)
+    return codes.reshape(-1), names
+
+## Failure rate estimate ----
+## Running failure rate of accepted trips, overall and per region, with
+## confidence intervals used to stop route_process once they are tight enough.
+##
+## Without stratification trips are a simple random sample: the overall rate is
+## the pooled rate with a Wilson interval, and each region gets its own Wilson
+## interval. With stratification (stratify = True) start points are drawn region
+## by region. Accepted trips come from region h in proportion to w_h * a_h, its
+## share of the start point pool times its acceptance rate (a_h estimated from
+## the proposals made there, including those with no end point). The overall
+## rate is sum_h W_h p_h with W_h those shares normalised, and its variance
+## sum_h W_h^2 p_h (1 - p_h) / n_h (p_h taken at the Agresti-Coull centre so a
+## region with no failures yet still counts). Regions are given trips in turn to
+## whichever is furthest below its share W_h, so the allocation is proportional
+## and depends only on the counts so far.
+##
+## Regions with no trips yet have no rate: rate() is taken over the regions with
+## trips, unobserved() reports the share of trips expected from the others, and
+## the interval allows anything from 0 to 1 for that share, so it cannot
+## converge while a region that matters is still unseen.
+class FailureEstimate:
+
+    def __init__(self, weights = None, names = None, level = 0.95, stratify = False):
+        self.weights = np.ones(1) if weights is None else np.asarray(weights, dtype = float)
+        self.names = np.arange(len(self.weights)) if names is None else np.asarray(names)
+        self.level = level
+        self.stratify = stratify
+        self.z = norm.ppf(0.5 + level / 2)
+
+        n_regions = len(self.weights)
+        self.proposed = np.zeros(n_regions, dtype = np.int64)
+        self.trips = np.zeros(n_regions, dtype = np.int64)
+        self.failures = np.zeros(n_regions, dtype = np.int64)
+
+    def __len__(self):
+        return int(self.trips.sum())
+
+    ## Count a start point proposed in region h (only needed with stratify)
+    def propose(self, h):
+        self.proposed[h] += 1
+
+    ## Record the outcome of a simulated trip started in region h
+    def add(self, h, failed):
+        self.trips[h] += 1
+        self.failures[h] += bool(failed)
+
+    ## Share of accepted trips coming from each region, observed directly when trips
+    ## are a simple random sample
+    @property
+    def shares(self):
+        if not self.stratify:
+            return self.trips / max(len(self), 1)
+        w = self.weights * (self.trips + 1) / (self.proposed + 2)
+        return w / w.sum()
+
+    ## Region to draw the next start point from
+    def next_region(self):
+        return int(np.argmax(self.shares * (len(self) + 1) - self.trips))
+
+    ## Share of accepted trips expected from regions with no trips yet
+    def unobserved(self):
+        return float(self.shares[self.trips == 0].sum())
+
+    def rate(self):
+        seen = self.trips > 0
+        if not seen.any():
+            return 0.0
+        if self.stratify:
+            shares = self.shares[seen] / self.shares[seen].sum()
+            return float((shares * self.failures[seen] / self.trips[seen]).sum())
+        return self.failures.sum() / len(self)
+
+    def interval(self):
+        if not self.stratify:
+            return wilson(self.failures.sum(), len(self), self.level)
+        seen = self.trips > 0
+        if not seen.any():
+            return 0.0, 1.0
+        n, z = self.trips[seen], self.z
+        shares = self.shares[seen] / self.shares[seen].sum()
+        p = (self.failures[seen] + z * z / 2) / (n + z * z)
+        half = z * np.sqrt((shares ** 2 * p * (1 - p) / n).sum())
+        rate = self.rate()
+        u = self.unobserved()
+        return (1 - u) * max(rate - half, 0.0), (1 - u) * min(rate + half, 1.0) + u
+
+    def half_width(self):
+        lo, hi = self.interval()
+        return (hi - lo) / 2
+
+    ## Per region trips, failures, rate and Wilson interval
+    def regions(self):
+        from pandas import DataFrame
+
+        ci = [wilson(f, n, self.level) for f, n in zip(self.failures, self.trips)]
+        return DataFrame({
+            'region': self.names,
+            'share': self.shares,
+            'trips': self.trips,
+            'failures': self.failures,
+            'rate': self.failures / np.maximum(self.trips, 1),
+            'lo': [lo for lo, hi in ci],
+            'hi': [hi for lo, hi in ci]
+        })
+
+    ## True once min_trips are in, the overall interval half width is at most target
+    ## and, with region_target, so is that of every region trips have started in
+    def converged(self, target, region_target = None, min_trips = 100):
+        if (len(self) < min_trips) or (self.half_width() > target):
+            return False
+        if region_target is None:
+            return True
+        for f, n in zip(self.failures, self.trips):
+            lo, hi = wilson(f, n, self.level)
+            if (n > 0) and ((hi - lo) / 2 > region_target):
+                return False
+        return True
@@ -0,0 +1,273 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from heapq import heappop, heappush
+
+import numpy as np
+import pandas as pd
+
+## Event kinds, in tie-break order for events at the same time
+CHARGE_COMPLETE, ARRIVAL, AT_STATION, DEPLETION = 0, 1, 2, 3
+
+## Station policy decisions
+CHARGE, WAIT, SKIP = 0, 1, 2
+
+FAIL_TYPES = [None, "Chargers out of range", "Chargers unavailable"]
+
+## Station policies ----
+## A policy decides what a vehicle arriving at a station group does, and who (if
+## anyone) takes over a port when a vehicle finishes charging.
+
+## Independent Poisson occupancy per visit, as in simulate_trip. Vehicles do not
+## interact: one draw per stacked station, charge if any draw is below nm_chrg.
+## The draw is made at the decision vertex (at_vertex), before the vehicle sets
+## off, so a vehicle turned away pays no detour, as in simulate_trip and
+## simulate_fleet.
+class PoissonPolicy:
+
+    at_vertex = True
+
+    def __init__(self, alpha = 2, random_state = None):
+        self.alpha = alpha
+        self.random_state = np.random.default_rng(random_state)
+
+    def reset(self, sched):
+        pass
+
+    def arrive(self, sched, vehicle, group, time):
+        draws = self.random_state.poisson(self.alpha, sched.group_size[group])
+        return CHARGE if (draws < sched.group_chgs[group]).any() else SKIP
+
+    def release(self, sched, group, time):
+        return None
+
+## Shared ports: a group has the summed nm_chrg of its stations as ports. A vehicle
+## finding every port busy joins a FIFO queue, or drives on when queue is False.
+## Ports are only known to be busy on arrival, so the decision is made there.
+class PortPolicy:
+
+    at_vertex = False
+
+    def __init__(self, queue = True):
+        self.queue = queue
+
+    def reset(self, sched):
+        self.busy = np.zeros(len(sched.group_ports), dtype = np.int64)
+        self.peak = np.zeros(len(sched.group_ports), dtype = np.int64)
+        self.waiting = defaultdict(deque)
+
+    def arrive(self, sched, vehicle, group, time):
+        if self.busy[group] < sched.group_ports[group]:
+            self.busy[group] += 1
+            self.peak[group] = max(self.peak[group], self.busy[group])
+            return CHARGE
+        if self.queue:
+            self.waiting[group].append(vehicle)
+            return WAIT
+        return SKIP
+
+    ## Hand the freed port to the next vehicle in the queue, if any
+    def release(self, sched, group, time):
+        if self.waiting[group]:
+            return self.waiting[group].popleft()
+        self.busy[group] -= 1
+        return None
+
+## Event scheduler ----
+## Discrete event simulation of many vehicles sharing the station network. Each
+## vehicle drives a round trip Route at constant speed and the heap only holds
+## the events that change something: arriving at the next vertex that needs a
+## decision (a refuel point or the end of the trip), reaching the station,
+## finishing a charge and running out of range. Travel between events is
+## resolved with a bisect over the cumulative distance of the trip.
+##
+## As in fleet mode, the station used is the one nearest the decision vertex,
+## reached by straight line distance times `detour`, and the vehicle rejoins the
+## route at that vertex afterwards. A vehicle turned away (SKIP) drives back to
+## the route and tries again at the next vertex, unless the policy decides at the
+## vertex (at_vertex), in which case it never leaves the route. A vehicle that
+## runs out of range fails where it ran out, between vertices.
+class EventScheduler:
+
+    def __init__(self, routes, evc_data, detour = 1.0, policy = None, chg_index = None):
+        from ev_index import ChargerIndex
+
+        self.chg_index = ChargerIndex(evc_data) if chg_index is None else chg_index
+        self.policy = PortPolicy() if policy is None else policy
+        self.detour = detour
+
+        ## Station groups: stations stacked on the same location
+        group, first, count = self.chg_index.groups()
+        chgs = self.chg_index.data['nm_chrg'].values.astype(np.int64)
+        self.group_size = count
+        self.group_chgs = chgs[first]
+        self.group_ports = np.bincount(group, weights = chgs).astype(np.int64)
+
+        ## Per route trip distances, and the nearest station group and its distance per vertex
+        self.trips = []
+        for route in routes:
+            lon, lat, dist = route.lon, route.lat, route.dist
+            if route.return_trip:
+                lon = np.concatenate([lon, route.return_lon])
+                lat = np.concatenate([lat, route.return_lat])
+                dist = np.concatenate([dist, route.return_dist])
+            stn_id, stn_dist = self.chg_index.nearest_many(lon, lat)
+            self.trips.append({
+                'lon': lon,
+                'lat': lat,
+                'trip_dist': np.cumsum(dist).tolist(),
+                'group': group[stn_id].tolist(),
+                'reach': (detour * stn_dist).tolist()
+            })
+
+    def run(self, route_ids, route_dist, fuel_dist, depart = 0.0, speed = 25.0, charge_time = 1800.0):
+        n = len(route_ids)
+        route_ids = np.asarray(route_ids).tolist()
+        veh_range = np.broadcast_to(np.asarray(route_dist, dtype = float), (n,)).tolist()
+        veh_fuel = np.broadcast_to(np.asarray(fuel_dist, dtype = float), (n,)).tolist()
+        veh_speed = np.broadcast_to(np.asarray(speed, dtype = float), (n,)).tolist()
+        veh_charge = np.broadcast_to(np.asarray(charge_time, dtype = float), (n,)).tolist()
+        depart = np.broadcast_to(np.asarray(depart, dtype = float), (n,)).tolist()
+
+        ## Vehicle state
+        left = list(veh_range)
+        pos = [0] * n
+        refuels = [0] * n
+        waited = [0.0] * n
+        wait_start = [0.0] * n
+        skipped = [False] * n
+        fail = [0] * n
+        end_time = [np.nan] * n
+        stop_lon = [None] * n
+        stop_lat = [None] * n
+
+        self.policy.reset(self)
+        at_vertex = getattr(self.policy, 'at_vertex', False)
+        heap = []
+        seq = 0
+        n_events = 0
+
+        ## Queue the vehicle's next decision vertex, or the point it runs dry before it
+        def schedule_next(v, t):
+            nonlocal seq
+            trip = self.trips[route_ids[v]]
+            trip_dist = trip['trip_dist']
+            here = trip_dist[pos[v]]
+            j = max(bisect_right(trip_dist, here + left[v] - veh_fuel[v]), pos[v] + 1)
+
+            if j >= len(trip_dist):
+                ## No more stops needed, arrive at the end of the trip
+                j = len(trip_dist)
+                travel = trip_dist[-1] - here
+            else:
+                travel = trip_dist[j] - here
+
+            if travel >= left[v]:
+                ## First vertex at or past the point the range runs out
+                j = bisect_left(trip_dist, here + left[v], pos[v] + 1)
+                heappush(heap, (t + left[v] / veh_speed[v], DEPLETION, seq, v, j))
+            else:
+                heappush(heap, (t + travel / veh_speed[v], ARRIVAL, seq, v, j))
+            seq += 1
+
+        for v in range(n):
+            schedule_next(v, depart[v])
+
+        while heap:
+            t, kind, _, v, j = heappop(heap)
+            n_events += 1
+            trip = self.trips[route_ids[v]]
+
+            if kind == ARRIVAL:
+                trip_dist = trip['trip_dist']
+                if j >= len(trip_dist):
+                    end_time[v] = t
+                    continue
+
+                left[v] -= trip_dist[j] - trip_dist[pos[v]]
+                pos[v] = j
+
+                ## A policy deciding at the vertex turns the vehicle away before it leaves
+                if at_vertex and (self.policy.arrive(self, v, trip['group'][j], t) == SKIP):
+                    skipped[v] = True
+                    schedule_next(v, t)
+                    continue
+
+                ## Head for the nearest station if it is in range
+                reach = trip['reach'][j]
+                if left[v] - reach <= 0:
+                    fail[v] = 1
+                    end_time[v] = t
+                    continue
+                left[v] -= reach
+                heappush(heap, (t + reach / veh_speed[v], AT_STATION, seq, v, j))
+                seq += 1
+
+            elif kind == AT_STATION:
+                group = trip['group'][j]
+                decision = CHARGE if at_vertex else self.policy.arrive(self, v, group, t)
+
+                if decision == CHARGE:
+                    heappush(heap, (t + veh_charge[v], CHARGE_COMPLETE, seq, v, j))
+                    seq += 1
+                elif decision == WAIT:
+                    wait_start[v] = t
+                else:
+                    ## Turned away, drive back to the route and try the next vertex
+                    skipped[v] = True
+                    reach = trip['reach'][j]
+                    if left[v] - reach <= 0:
+                        fail[v] = 2
+                        end_time[v] = t + left[v] / veh_speed[v]
+                        continue
+                    left[v] -= reach
+                    schedule_next(v, t + reach / veh_speed[v])
+
+            elif kind == CHARGE_COMPLETE:
+                refuels[v] += 1
+                skipped[v] = False
+
+                ## Pass the port on to the next vehicle waiting at this station
+                nxt = self.policy.release(self, trip['group'][j], t)
+                if nxt is not None:
+                    waited[nxt] += t - wait_start[nxt]
+                    heappush(heap, (t + veh_charge[nxt], CHARGE_COMPLETE, seq, nxt, pos[nxt]))
+                    seq += 1
+
+                reach = trip['reach'][j]
+                left[v] = veh_range[v] - reach
+                schedule_next(v, t + reach / veh_speed[v])
+
+            else:
+                ## Ran out of range between decision points, j - 1 and j are the vertices
+                ## either side of the point it ran out at
+                trip_dist = trip['trip_dist']
+                out_at = trip_dist[pos[v]] + left[v]
+                j = min(j, len(trip_dist) - 1)
+                frac = 1.0 if trip_dist[j] <= trip_dist[j - 1] else min((out_at - trip_dist[j - 1]) / (trip_dist[j] - trip_dist[j - 1]), 1.0)
+                stop_lon[v] = trip['lon'][j - 1] + frac * (trip['lon'][j] - trip['lon'][j - 1])
+                stop_lat[v] = trip['lat'][j - 1] + frac * (trip['lat'][j] - trip['lat'][j - 1])
+                left[v] = 0.0
+                pos[v] = j
+                fail[v] = 2 if skipped[v] else 1
+                end_time[v] = t
+
+        self.n_events = n_events
+
+        fail = np.asarray(fail)
+        pos = np.asarray(pos)
+        failed = fail > 0
+        lon = np.array([self.trips[r]['lon'][p] if x is None else x for r, p, x in zip(route_ids, pos, stop_lon)])
+        lat = np.array([self.trips[r]['lat'][p] if y is None else y for r, p, y in zip(route_ids, pos, stop_lat)])
+
+        return pd.DataFrame({
+            'route': route_ids,
+            'depart': depart,
+            'outcome': failed.astype(int),
+            'fal_typ': [FAIL_TYPES[f] for f in fail],
+            'fail_index': np.where(failed, pos, -1),
+            'lon': np.where(failed, lon, np.nan),
+            'lat': np.where(failed, lat, np.nan),
+            'end_time': end_time,
+            'refuels': refuels,
+            'wait_time': waited
+        })
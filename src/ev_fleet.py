@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+import ev_functions as evc
+
+FAIL_TYPES = np.array([None, "Chargers out of range", "Chargers unavailable"], dtype = object)
+
+## Fleet simulation ----
+## Runs many virtual vehicles along one routed round trip at once. Each vehicle
+## has its own range, refuel threshold and Poisson occupancy rate, and every
+## round of the loop below advances all active vehicles to their next decision
+## vertex together.
+##
+## Unlike simulate_trip no further routing calls are made: at a refuel stop the
+## vehicle uses the station nearest the current vertex, the distance to it is the
+## straight line distance times `detour`, and after charging the vehicle rejoins
+## the route at the same vertex, paying the detour again out of the new charge.
+## The return leg is the outbound route reversed. Station availability follows
+## simulate_trip: one Poisson draw per station stacked at the nearest location,
+## available if any draw is below that station's nm_chrg.
+def simulate_fleet(route, evc_data, route_dist, fuel_dist, alpha = 2, n_vehicles = None, detour = 1.0, chg_index = None, random_state = None):
+    from ev_index import ChargerIndex
+
+    if chg_index is None:
+        chg_index = ChargerIndex(evc_data)
+    random_state = np.random.default_rng(random_state)
+
+    ## Vehicle parameters, scalars are broadcast over the fleet
+    n_vehicles = n_vehicles or max(np.size(route_dist), np.size(fuel_dist), np.size(alpha))
+    veh_range = np.broadcast_to(np.asarray(route_dist, dtype = float), (n_vehicles,))
+    veh_fuel = np.broadcast_to(np.asarray(fuel_dist, dtype = float), (n_vehicles,))
+    veh_alpha = np.broadcast_to(np.asarray(alpha, dtype = float), (n_vehicles,))
+
+    ## Round trip vertices and distance travelled at each
+    lon, lat, dist = route.lon, route.lat, route.dist
+    if route.return_trip:
+        lon = np.concatenate([lon, route.return_lon])
+        lat = np.concatenate([lat, route.return_lat])
+        dist = np.concatenate([dist, route.return_dist])
+    trip_dist = np.cumsum(dist)
+    last = len(trip_dist) - 1
+
+    ## Nearest station to every vertex, collapsed onto its stacked location group
+    stn_id, stn_dist = chg_index.nearest_many(lon, lat)
+    group, first, stacked = chg_index.groups()
+    stn_first = first[group[stn_id]]
+    stn_ties = stacked[group[stn_id]]
+    stn_chgs = chg_index.rows(np.unique(stn_first))['nm_chrg'].reindex(stn_first).values.astype(float)
+    stn_reach = detour * stn_dist
+
+    ## Vehicle state
+    left = veh_range.astype(float)
+    pos = np.zeros(n_vehicles, dtype = np.int64)
+    refuels = np.zeros(n_vehicles, dtype = np.int64)
+    fail = np.zeros(n_vehicles, dtype = np.int8)
+    active = np.ones(n_vehicles, dtype = bool)
+
+    while active.any():
+        v = np.flatnonzero(active)
+
+        ## First vertex where the range left drops below the refuel threshold
+        target = trip_dist[pos[v]] + left[v] - veh_fuel[v]
+        j = np.maximum(np.searchsorted(trip_dist, target, side = "right"), pos[v] + 1)
+
+        ## Vehicles that reach the end of the trip without another stop are done
+        done = j > last
+        active[v[done]] = False
+        v, j = v[~done], j[~done]
+        if not len(v):
+            break
+
+        left[v] -= trip_dist[j] - trip_dist[pos[v]]
+        pos[v] = j
+
+        ## Occupancy draws at the nearest station group
+        ties = stn_ties[j]
+        draws = random_state.poisson(veh_alpha[v][:, None], size = (len(v), ties.max()))
+        usable = np.arange(ties.max()) < ties[:, None]
+        available = ((draws < stn_chgs[j][:, None]) & usable).any(axis = 1)
+
+        ## Available: out of range if the detour uses up the range, otherwise refuel
+        out_of_range = available & (left[v] - stn_reach[j] <= 0)
+        refuelled = available & ~out_of_range
+        left[v[refuelled]] = veh_range[v[refuelled]] - stn_reach[j[refuelled]]
+        refuels[v[refuelled]] += 1
+
+        ## Unavailable: keep driving and try again at the next vertex, unless out of range
+        unavailable = ~available & (left[v] <= 0)
+
+        fail[v[out_of_range]] = 1
+        fail[v[unavailable]] = 2
+        active[v[out_of_range | unavailable]] = False
+
+    failed = fail > 0
+    return pd.DataFrame({
+        'route_dist': veh_range,
+        'fuel_dist': veh_fuel,
+        'alpha': veh_alpha,
+        'outcome': failed.astype(int),
+        'fal_typ': FAIL_TYPES[fail],
+        'fail_index': np.where(failed, pos, -1),
+        'fail_dist': np.where(failed, trip_dist[pos], np.nan),
+        'lon': np.where(failed, lon[pos], np.nan),
+        'lat': np.where(failed, lat[pos], np.nan),
+        'refuels': refuels
+    })
+
+## Failure rows of a fleet outcome table as new chargers, in the evc_data schema
+def fleet_chargers(outcomes, crs):
+    from geopandas import GeoDataFrame, points_from_xy
+
+    failed = outcomes[outcomes['outcome'] == 1]
+    return GeoDataFrame({
+        "fll_ddr": None,
+        "nm_chrg": 4,
+        "fal_typ": failed['fal_typ'].values,
+        "geometry": points_from_xy(failed['lon'], failed['lat'])
+    }, crs = crs)
+
+## Fleet route process ----
+## Samples n_routes qualifying round trips as route_process does and runs a fleet
+## of n_vehicles over each, returning one outcome table with a route column.
+def fleet_route_process(road_data, evc_data, route_dist, fuel_dist, crs, n_routes = 1, n_vehicles = 1000, alpha = 2,
+                        detour = 1.0, weighted = False, max_dist = None, backend = None, seed = None):
+    from ev_index import ChargerIndex
+    from ev_sampler import VertexSampler
+
+    random_state = np.random.default_rng(seed)
+    chg_index = ChargerIndex(evc_data)
+    sampler = VertexSampler(road_data, rng = random_state)
+
+    ## Routes are accepted against the longest range in the fleet
+    min_dist = np.max(route_dist)
+
+    tables = []
+    while len(tables) < n_routes:
+        start_pos = evc.get_start_point(road_data, crs, sampler = sampler, weighted = weighted)
+        end_pos = evc.get_end_point(road_data, start_pos, min_dist, crs, sampler = sampler, max_dist = max_dist, weighted = weighted)
+        if end_pos is None:
+            continue
+
+        route = evc.calculate_route(start_pos, end_pos, crs, return_trip = True, backend = backend)
+        if (route is None) or (route.total_dist <= min_dist):
+            continue
+
+        table = simulate_fleet(route, evc_data, route_dist, fuel_dist, alpha = alpha, n_vehicles = n_vehicles,
+                               detour = detour, chg_index = chg_index, random_state = random_state)
+        table.insert(0, 'route', len(tables))
+        tables.append(table)
+        print("Fleet route:", len(tables), "failures:", table['outcome'].sum())
+
+    return pd.concat(tables).reset_index(drop = True)
@@ -1,10 +1,7 @@
 ## Create sample point function for starting and ending positions ----
 def sample_point(data, crs):
     from random import sample
-    from shapely.geometry import Point
-    from geopandas import GeoDataFrame
-    
-    data = data.copy()
+    from ev_transform import PROJ, position, transform
     
     ## sample one random row from 'data'
     sample_road_row = sample(range(len(data)), 1)
@@ -15,145 +12,130 @@ def sample_point(data, crs):
     ## Randomly select a pair of coordinates within the road we've selected as a starting point
     sample_road_coords = list(sample_road_data.geometry[0].coords)
     sample_index = sample(range(len(sample_road_coords)), 1)
-    sample_geo = Point(list(sample_road_coords[sample_index[0]]))
+    sample_x, sample_y = sample_road_coords[sample_index[0]][:2]
 
-    point_df = GeoDataFrame({'geometry': [sample_geo]}, crs = "EPSG:32613")
-    point_df = point_df.to_crs(crs)
-
-    ## Return a list with the corresponding sample road row number in 'data' and a geometry object
-    return({
-        "road_row_num" : sample_road_data.record[0], 
-        "point" : point_df
-    })
+    ## Return the corresponding sample road row number in 'data' and the point in the CRS specified
+    return position(*transform(sample_x, sample_y, PROJ, crs), crs, road_row_num = sample_road_data.record[0])
 
 ## Get starting point function ----
-def get_start_point(df, crs):
-    from pandas import DataFrame
-    from geopandas import GeoDataFrame
+def get_start_point(df, crs, sampler = None, weighted = False, rng = None):
+    ## Draw straight from the precomputed vertex pool when one is available
+    if sampler is not None:
+        return sampler.draw(crs, level = 3, weighted = weighted, rng = rng)
     
-    data = df.copy()
-
     ## Filter to roadways of level 3 (minor/residential roadways)
-    valid_startpoints = data[data["level"] == 3].reset_index(drop = True)
+    valid_startpoints = df[df["level"] == 3].reset_index(drop = True)
 
     return sample_point(valid_startpoints, crs)
 
 ## Get ending point function ----
-def get_end_point(df, start_pos, route_dist, crs):
-    from pandas import DataFrame
-    from geopandas import GeoDataFrame
+def get_end_point(df, start_pos, route_dist, crs, sampler = None, max_dist = None, weighted = False, rng = None):
+    from shapely.geometry import Point
+    from ev_transform import PROJ, position_xy
     
-    data = df.copy()
-    sp = start_pos['point'].to_crs("EPSG:32613")
+    ## Ring query over the vertex grid instead of a distance scan of every road
+    if sampler is not None:
+        if 'vertex' in start_pos:
+            sx, sy = sampler.x[start_pos['vertex']], sampler.y[start_pos['vertex']]
+        else:
+            sx, sy = position_xy(start_pos, sampler.crs)
+        return sampler.draw_annulus(sx, sy, crs, route_dist / 2, max_dist, weighted = weighted, rng = rng)
     
-    ## Create distances column used for filtering points
-    data['distances'] = data['geometry'].distance(sp.geometry[0])
+    sp = Point(*position_xy(start_pos, PROJ))
     
-    ## Filter points to distances that are further than half of route_dist
-    valid_endpoints = data[data['distances'] >= (route_dist / 2)].reset_index(drop = True)
+    ## Filter points to distances that are further than half of route_dist, without
+    ## copying the road data to hold the distances
+    distances = df['geometry'].distance(sp)
+    valid_endpoints = df[distances.values >= (route_dist / 2)].reset_index(drop = True)
     
     return sample_point(valid_endpoints, crs)
 
+## Longitude and latitude of a sampled position in the CRS specified ----
+def point_lonlat(pos, crs):
+    from ev_transform import position_xy
+    
+    return position_xy(pos, crs)
+
 ## Calculate route between points ----
-def calculate_route(pickup, dropoff, crs, return_trip = False):
-    from geopandas import GeoDataFrame
-    from geopandas import GeoSeries
-    from polyline import decode
-    from time import sleep
-    from shapely.geometry import Point
-    import pandas as pd
-    import requests
-    
-    ## Convert pickup coordinates from UTM to CRS specified
-    pickup_lon = pickup['point'].to_crs(crs).iloc[0]['geometry'].x
-    pickup_lat = pickup['point'].to_crs(crs).iloc[0]['geometry'].y
-    
-    ## Convert dropoff coordinates from UTM to CRS specified
-    dropoff_lon = dropoff['point'].to_crs(crs).iloc[0]['geometry'].x
-    dropoff_lat = dropoff['point'].to_crs(crs).iloc[0]['geometry'].y
-    
-    loc = "{},{};{},{}".format(pickup_lon, pickup_lat, dropoff_lon, dropoff_lat)
-    url = "http://router.project-osrm.org/route/v1/driving/"
-    r = requests.get(url + loc + "?overview=full&annotations=true")
-    if r.status_code != 200:
-        print("Request returned unsuccessful status code... Retrying...")
-        attempt = 1
-        while (r.status_code != 200) & (attempt < 4):
-            sleep(1)
-            attempt += 1
-            r = requests.get(url + loc + "?overview=full&annotations=true")
-        if (r.status_code != 200) & (attempt >= 4):
-            return None
-  
-    res = r.json()
-    
-    ## Get route details from response
-    route_distances = [0, *res['routes'][0]['legs'][0]['annotation']['distance']]
-    
-    ## Collect main features of route from response
-    route_coords = decode(res['routes'][0]['geometry'])
-    route = GeoSeries([Point((x[1], x[0])) for x in route_coords], crs = crs)
-    
-    ## Create route details data frame with distances and coords
-    route_detail = pd.DataFrame({"distance": route_distances, "route": route})
-    
-    ## Return trip decision
-    if return_trip == True:
-        ## Generate a round trip by selecting all but last row and appending to route df
-        ## Get return points and reverse order
-        rd_return = route_detail.loc[0:len(route_detail) - 2][::-1]
-        ## Row bind to route detail df
-        route_detail_rb = pd.concat([route_detail, rd_return]).reset_index(drop = True)
-        route_detail_rb['total_distance'] = route_detail_rb['distance'].cumsum()
-        route_df = GeoDataFrame({
-            'dist': route_detail_rb['distance'],
-            'total_dist': route_detail_rb['total_distance'],
-            'geometry': route_detail_rb['route']
-        }, crs = crs)
-    else:
-        route_detail['total_distance'] = route_detail['distance'].cumsum()
-        route_df = GeoDataFrame({
-            'dist': route_detail['distance'],
-            'total_dist': route_detail['total_distance'],
-            'geometry': route_detail['route']
-        }, crs = crs)
-    
-    start_point = GeoSeries(Point(res['waypoints'][0]['location'][0], res['waypoints'][0]['location'][1]), crs = crs)
-    end_point = GeoSeries(Point(res['waypoints'][1]['location'][0], res['waypoints'][1]['location'][1]), crs = crs)
-    distance = res['routes'][0]['distance']
-    
-    out = {'route':route,
-           'route_detail':route_df,
-           'start_point':start_point,
-           'end_point':end_point,
-           'distance':distance
-          }
-
-    return out
+def calculate_route(pickup, dropoff, crs, return_trip = False, backend = None):
+    from numpy import asarray, concatenate
+    from ev_metrics import get_metrics
+    from ev_routing import Route, default_backend
+    
+    ## Default to the public OSRM server
+    if backend is None:
+        backend = default_backend()
+    metrics = get_metrics()
+    
+    ## Convert pickup and dropoff coordinates from UTM to CRS specified
+    pickup_lon, pickup_lat = point_lonlat(pickup, crs)
+    dropoff_lon, dropoff_lat = point_lonlat(dropoff, crs)
+    
+    with metrics.timer('route_request'):
+        res = backend.route(pickup_lon, pickup_lat, dropoff_lon, dropoff_lat)
+    if res is None:
+        metrics.count('no_route')
+        return None
+    
+    ## Collect route coordinates and distances from response
+    route_coords = asarray(res['coords'], dtype = float).reshape(-1, 2)
+    route_distances = concatenate([[0], asarray(res['distances'], dtype = float)])
+    
+    ## Geometries are only built if a caller asks for the GeoDataFrame view
+    return Route(
+        route_coords[:, 0].copy(),
+        route_coords[:, 1].copy(),
+        route_distances,
+        crs,
+        tuple(res['start']),
+        tuple(res['end']),
+        res['distance'],
+        return_trip = return_trip
+    )
     
 ## Simulation Helpers ----
-def nearest_chg_pt(pos1, evc_data):
-    from pandas import DataFrame
-    from geopandas import GeoSeries
-    from shapely.ops import nearest_points
+def nearest_chg_pt(pos1, evc_data, chg_index = None):
+    from ev_index import ChargerIndex
     
-    chg_pts = evc_data['geometry'].unary_union
-    return GeoSeries(nearest_points(pos1, chg_pts))[1]
+    ## Reuse a prebuilt index when given, otherwise build one for this lookup
+    if chg_index is None:
+        chg_index = ChargerIndex(evc_data)
+    
+    return chg_index.nearest(pos1)['geometry'].iloc[0]
 
 def format_coord(pos, crs):
-    from geopandas import GeoDataFrame
+    from ev_transform import position
     
-    return {'point': GeoDataFrame({'geometry': [pos]}, crs = crs)}
+    return position(pos.x, pos.y, crs)
 
 ## Simulate trip function ----
-def simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, crs, alpha = 2):
+## The range left after each vertex is worked out for a whole stretch of route at
+## once (a running subtraction, so values match stepping vertex by vertex) and the
+## loop below only stops where a decision is made: the first vertex under
+## fuel_dist, every vertex while waiting on an unavailable charger, and the end
+## of each route.
+def simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, crs, alpha = 2, chg_index = None, backend = None, random_state = None,
+                  chg_matrix = None, coverage = None):
     from pandas import DataFrame
-    from numpy import random
-    from geopandas import GeoSeries
+    from shapely.geometry import Point
+    from numpy import random, concatenate, flatnonzero, searchsorted, subtract
+    from ev_index import ChargerIndex
+    from ev_metrics import get_metrics
+    from ev_transform import PROJ, transform
+    
+    metrics = get_metrics()
+    
+    ## Nearest charger lookups go through a spatial index built once per run
+    if chg_index is None:
+        chg_index = ChargerIndex(evc_data)
+    
+    ## Draw occupancy from the given generator, or the global numpy state
+    if random_state is None:
+        random_state = random
     
     # alpha = 2
-    sim_route = route['route']
-    sim_route_details = route['route_detail']
+    sim_route = route
+    sim_dist = route.dist
 
     rng = route_dist
     route_index = 0
@@ -161,23 +143,47 @@ def simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, cr
 
     while rng > 0 & trip_direction < 3:
         
-        ## Decrease range
-        rng -= sim_route_details['dist'].loc[route_index]
+        last_index = len(sim_route) - 1
+        
+        if (rng >= fuel_dist) & (route_index < last_index):
+            ## Decrease range along the rest of the route and jump to the first vertex
+            ## that needs a refuel, or to the end of the route if none does
+            rng_left = subtract.accumulate(concatenate([[rng], sim_dist[route_index:last_index + 1]]))[1:]
+            step = min(searchsorted(-rng_left, -fuel_dist, side = "right"), len(rng_left) - 1)
+            route_index += step
+            rng = rng_left[step]
+        else:
+            ## Decrease range
+            rng -= sim_dist[route_index]
 
         ## Check if we need to refuel
         if rng < fuel_dist:
 
             ## Get our current location and find the nearest charger
-            current_location = sim_route_details['geometry'].loc[route_index]
-            nearest_charger = nearest_chg_pt(current_location, evc_data)
+            current_location = sim_route.point(route_index)
+            reach = None
+            with metrics.timer('nearest_charger'):
+                ## With a coverage map the nearest charger is the nearest by road, and its
+                ## road distance is known without a route
+                if (coverage is not None) and (len(coverage) == len(chg_index)):
+                    px, py = transform(current_location.x, current_location.y, crs, PROJ)
+                    reach, station, _ = coverage.at(px, py)
+                    if station < 0:
+                        reach = None
+                if reach is None:
+                    nearest_stations = chg_index.nearest(current_location)
+                else:
+                    nearest_stations = chg_index.at(station)
+            metrics.count('refuel_checks')
+            nearest_charger = nearest_stations['geometry'].iloc[0]
 
             ## Find the number of chargers at the charging station
-            nearest_chargers = evc_data[evc_data['geometry'] == nearest_charger]['nm_chrg']
+            nearest_chargers = nearest_stations['nm_chrg']
             for row in nearest_chargers.index:
                 num_chgs = nearest_chargers.iloc[0]
             
                 ## Use a Poisson RV to estimate number of available chargers at the station
-                in_use = random.poisson(alpha, 1)
+                in_use = random_state.poisson(alpha, 1)
 
                 if in_use >= num_chgs:
                     charger_available = False
@@ -186,24 +192,49 @@ def simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, cr
                     break
 
             if charger_available == True:
-                ## Get coordinates for current location and charging station
-                pos1 = format_coord(current_location, crs)
-                pos2 = format_coord(nearest_charger, crs)
-
-                ## Generate new route to charger
-                re_route = calculate_route(pos1, pos2, crs, return_trip = False)
-
-                ## Simulate travel to the charger
-                for i in range(len(re_route['route_detail'])):
-                    rng -= re_route['route_detail'].loc[i]['dist']
-                    if rng <= 0:
+                ## A charger the coverage map or distance matrix shows within range needs no
+                ## route to check it, the route is only fetched when the vehicle may run out
+                in_range = False
+                if reach is not None:
+                    metrics.count('reroutes_skipped')
+                    in_range = reach < rng
+                    if not in_range:
                         outcome = DataFrame({
                             "fll_ddr": None,
                             "nm_chrg": 4,
                             "fal_typ": "Chargers out of range",
-                            "geometry": [re_route['route_detail'].loc[i]['geometry']]
+                            "geometry": [Point(*transform(*coverage.stranded_at(px, py, rng), PROJ, crs))]
                         })
                         return outcome
+                elif (chg_matrix is not None) and (len(chg_matrix) == len(chg_index)):
+                    px, py = transform(current_location.x, current_location.y, crs, PROJ)
+                    ## Only the largest distance over the cell is a safe bound, the route is
+                    ## still fetched whenever that is out of range
+                    _, upper = chg_matrix.bounds(nearest_stations.index[0], px, py)
+                    in_range = upper < rng
+                    if in_range:
+                        metrics.count('reroutes_skipped')
+
+                out_of_range = []
+                if not in_range:
+                    ## Get coordinates for current location and charging station
+                    pos1 = format_coord(current_location, crs)
+                    pos2 = format_coord(nearest_charger, crs)
+
+                    ## Generate new route to charger
+                    re_route = calculate_route(pos1, pos2, crs, return_trip = False, backend = backend)
+
+                    ## Simulate travel to the charger, failing at the first vertex out of range
+                    re_rng = subtract.accumulate(concatenate([[rng], re_route.dist]))[1:]
+                    out_of_range = flatnonzero(re_rng <= 0)
+                if len(out_of_range):
+                    outcome = DataFrame({
+                        "fll_ddr": None,
+                        "nm_chrg": 4,
+                        "fal_typ": "Chargers out of range",
+                        "geometry": [re_route.point(out_of_range[0])]
+                    })
+                    return outcome
 
                 ## Refuel the vehicle
                 rng = route_dist
@@ -216,11 +247,12 @@ def simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, cr
                         format_coord(nearest_charger, crs),
                         end_pos,
                         crs,
-                        return_trip = False
+                        return_trip = False,
+                        backend = backend
                     )
 
-                    sim_route = new_route['route']
-                    sim_route_details = new_route['route_detail']
+                    sim_route = new_route
+                    sim_dist = new_route.dist
 
                     ## Reset the route index
                     route_index = 0
@@ -232,11 +264,12 @@ def simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, cr
                         format_coord(nearest_charger, crs),
                         start_pos,
                         crs,
-                        return_trip = False
+                        return_trip = False,
+                        backend = backend
                     )
 
-                    sim_route = new_route['route']
-                    sim_route_details = new_route['route_detail']
+                    sim_route = new_route
+                    sim_dist = new_route.dist
 
                     ## Reset the route index
                     route_index = 0
@@ -248,21 +281,22 @@ def simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, cr
                         "fll_ddr": None,
                         "nm_chrg": 4,
                         "fal_typ": "Chargers unavailable",
-                        "geometry": [GeoSeries(current_location, crs = crs)]
+                        "geometry": [current_location]
                     })
                     return outcome
                 
         if (route_index == len(sim_route) - 1) & (trip_direction == 1):
 
             new_route = calculate_route(
-                format_coord(sim_route.loc[route_index], crs = crs),
+                format_coord(sim_route.point(route_index), crs = crs),
                 start_pos,
                 crs,
-                return_trip = False
+                return_trip = False,
+                backend = backend
             )
 
-            sim_route = new_route['route']
-            sim_route_details = new_route['route_detail']
+            sim_route = new_route
+            sim_dist = new_route.dist
 
             route_index = 0
             trip_direction = 2
@@ -276,53 +310,288 @@ def simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, cr
 
     return None
 
+## One trip ----
+## The per trip steps shared by route_process and the parallel workers (ev_parallel).
+## route_pair routes a proposed (start, end) pair and returns the round
+## trip if the candidate generator accepts it, else None. run_trip simulates an
+## accepted trip and puts the charger a failure adds into chg_index, and into the
+## distance matrix and coverage map when given, returning the outcome.
+def route_pair(pair, candidates, crs, backend = None):
+    from ev_metrics import get_metrics
+
+    start_pos, end_pos = pair
+    with get_metrics().timer('calculate_route'):
+        route = calculate_route(start_pos, end_pos, crs, return_trip = True, backend = backend)
+    return route if candidates.record(route) else None
+
+def run_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, crs, chg_index, backend = None, random_state = None,
+             chg_matrix = None, coverage = None):
+    from ev_metrics import get_metrics
+
+    metrics = get_metrics()
+    with metrics.timer('simulate_trip'):
+        outcome = simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, crs, chg_index = chg_index, backend = backend,
+                                random_state = random_state, chg_matrix = chg_matrix, coverage = coverage)
+    metrics.count('trips')
+
+    if outcome is not None:
+        metrics.count('failures')
+        with metrics.timer('charger_insert'):
+            chg_index.insert(outcome)
+        if chg_matrix is not None:
+            with metrics.timer('matrix_sync'):
+                chg_matrix.sync(chg_index)
+        if coverage is not None:
+            with metrics.timer('coverage_sync'):
+                coverage.sync(chg_index)
+        print("New charger added. Fail Type:", outcome['fal_typ'].iloc[0])
+    return outcome
+
 ## Route process function ----
-def route_process(road_data, evc_data, route_dist, fuel_dist, crs, pre_built, n_sim = 1):
-    from datetime import date
-    import pickle
-    import pandas as pd
+def route_process(road_data, evc_data, route_dist, fuel_dist, crs, pre_built, n_sim = 1, weighted = False, max_dist = None, backend = None, prefetch = 0, seed = None,
+                  log_dir = None, resume = False, sampler = None, metrics = None, chg_matrix = None,
+                  coverage = None, target = None, region_target = None, min_trips = 100, level = 0.95, regions = None, stratify = False, crn = False,
+                  traffic = None, cache_dir = None, tile_budget = None):
+
+    ## Report to the metrics given for this run only, the caller's registry is put
+    ## back however the run ends
+    from ev_metrics import use_metrics
+
+    with use_metrics(metrics):
+        from collections import deque
+        from datetime import date
+        import pickle
+        from ev_candidates import CandidateGenerator
+        from ev_estimate import FailureEstimate, grid_regions
+        from ev_index import ChargerIndex
+        from ev_metrics import get_metrics
+        from ev_sampler import VertexSampler
+        from numpy import asarray, unique
+        from numpy.random import default_rng, SeedSequence
     
-    res = []
-    k = 0
-    today = date.today()
+        metrics = get_metrics()
+
+        ## The matrix and coverage map hold distances over one road graph, so they stand
+        ## in for a route only when routes are fetched over that same graph
+        if (chg_matrix is not None) or (coverage is not None):
+            from ev_routing import default_backend, graph_of
+            graph = graph_of(default_backend() if backend is None else backend)
+            for name, held in (('chg_matrix', chg_matrix), ('coverage', coverage)):
+                if (held is not None) and (held.graph is not graph):
+                    raise ValueError(name + " must be built on the LocalBackend graph that backend routes over")
+
+        res = []
+        k = 0
+        today = date.today()
     
-    while k < n_sim:
-
-        start_pos = get_start_point(road_data, crs)
-        end_pos = get_end_point(road_data, start_pos, route_dist, crs)
-
-        route = calculate_route(start_pos, end_pos, crs, return_trip = True)
-
-        if route is not None:
-            route_total_dist = route['route_detail']['total_dist'].iloc[-1]
-
-        if (route is not None) & (route_total_dist > route_dist):
-            k += 1
-            print("Simulation attempt:", k)
+        ## One seeded generator drives point sampling and charger occupancy. With crn
+        ## (common random numbers) sampling gets a stream of its own and each trip's
+        ## occupancy draws come from a stream keyed on the trip number, so scenarios run
+        ## with the same seed simulate the same trips with the same draws whatever
+        ## chargers they start from or add
+        if crn:
+            seeds = SeedSequence(seed)
+            if seed is None:
+                print("Common random number seed:", seeds.entropy)
+            random_state = default_rng(SeedSequence(seeds.entropy, spawn_key = (0,)))
+        else:
+            random_state = default_rng(seed)
+    
+        ## Flatten road vertices once for start and end point sampling (or reuse a prepared sampler).
+        ## With a prepared cache_dir the vertices are memory mapped, or with a tile_budget
+        ## (bytes) read a tile at a time keeping at most that much loaded
+        if (sampler is None) and (cache_dir is not None):
+            from ev_prepare import open_sampler
+            from ev_tiles import open_tiled_sampler
+            sampler = open_sampler(cache_dir) if tile_budget is None else open_tiled_sampler(cache_dir, budget = tile_budget)
+        if sampler is None:
+            sampler = VertexSampler(road_data, rng = random_state)
+        else:
+            sampler.rng = random_state
+
+        ## Build the charger index once, added chargers are kept in it rather than
+        ## concatenated onto evc_data after every failure (chg_index.data has both).
+        ## Sampling from tiles, the index holds the stations of the tiles around each
+        ## trip, read through the same tile budget. Those are the stations the cache was
+        ## prepared from, in the tile schema (see ev_tiles), so evc_data must be None
+        if hasattr(sampler, 'store'):
+            from ev_tiles import TiledChargers
+            if (chg_matrix is not None) or (coverage is not None):
+                raise ValueError("chg_matrix and coverage need every station indexed, not tiles")
+            if evc_data is not None:
+                raise ValueError("Stations are read from the tiles when sampling from tiles, pass evc_data = None")
+            chg_index = TiledChargers(sampler.store)
+        else:
+            chg_index = ChargerIndex(evc_data)
+    
+        ## Start regions: square cells of side `regions` metres or per road region codes
+        if (regions is None) and stratify:
+            regions = 100000
+        names = None
+        if regions is not None:
+            if isinstance(regions, (int, float)):
+                regions, names = grid_regions(sampler, regions)
+            else:
+                names, regions = unique(asarray(regions), return_inverse = True)
+            sampler.set_strata(regions.reshape(-1))
+            n_regions = int(sampler.strata.max()) + 1
+            weights = [sampler.pool_weight(3, weighted, h) for h in range(n_regions)]
+        else:
+            weights = None
+            if sampler.strata is not None:
+                sampler.set_strata(None)
+    
+        ## Running failure rate with confidence intervals, overall and per region
+        failure_rate = FailureEstimate(weights, names, level = level, stratify = stratify)
+    
+        ## Start and end pairs, counted from proposal to acceptance
+        candidates = CandidateGenerator(sampler, route_dist, crs, max_dist = max_dist, weighted = weighted)
+    
+        ## Stream each trip and added charger to disk instead of holding results in memory
+        log = None
+        if log_dir is not None:
+            from ev_log import OutcomeLog
+            log = OutcomeLog(log_dir, fresh = not resume)
+        
+            ## Pick up after the last completed trip with its chargers, generator state,
+            ## the pairs it had queued (drawn before that state), which go first, and the
+            ## per region proposal counts stratified allocation goes by
+            if resume:
+                k, added, state, pending, proposed = log.resume_state(chg_index.crs)
+                if k > 0:
+                    chg_index.insert(added)
+                    if state is not None:
+                        random_state.bit_generator.state = state
+                    for region, outcome in log.trips()[['region', 'outcome']].fillna(0).values:
+                        failure_rate.add(int(region), outcome)
+                    if stratify and (proposed is not None):
+                        failure_rate.proposed[:] = proposed
+                    print("Resuming after simulation", k, "with", len(added), "chargers added")
+    
+        ## Distance matrix rows for every station, including any restored above
+        if chg_matrix is not None:
+            with metrics.timer('matrix_sync'):
+                chg_matrix.sync(chg_index)
+    
+        ## Road distance to the nearest charger from every graph node, likewise
+        if coverage is not None:
+            with metrics.timer('coverage_sync'):
+                coverage.sync(chg_index)
+    
+        ## Candidate trips whose routes are already being fetched by the backend
+        queued = deque()
+        prefetch = prefetch if hasattr(backend, 'prefetch') else 0
+        if log is not None and resume and k > 0:
+            for start, end in pending:
+                start_pos, end_pos = sampler.point(start, crs), sampler.point(end, crs)
+                if prefetch:
+                    backend.prefetch([(*point_lonlat(start_pos, crs), *point_lonlat(end_pos, crs))])
+                queued.append((start_pos, end_pos))
+    
+        ## Next candidate pair, with stratify from the region furthest below its share
+        def propose():
+            stratum = None
+            if stratify:
+                stratum = failure_rate.next_region()
+                failure_rate.propose(stratum)
+            with metrics.timer('propose'):
+                return candidates.propose(stratum = stratum)
+    
+        while k < n_sim:
 
-            ## Simulate trip given the route fits our criteria for appropriate distance
-            try:
-                outcome = simulate_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, crs)
-                res.append(0 if outcome is None else 1)
-            
-                if outcome is not None:
+            ## Keep the next trips' routes in flight while the current one is simulated
+            while len(queued) < prefetch:
+                pair = propose()
+                if pair is not None:
+                    backend.prefetch([(*point_lonlat(pair[0], crs), *point_lonlat(pair[1], crs))])
+                    queued.append(pair)
 
-                    evc_data = pd.concat([evc_data, outcome]).reset_index(drop = True)
-                    print("New charger added. Fail Type:", outcome['fal_typ'].iloc[0])
+            if queued:
+                pair = queued.popleft()
+            else:
+                pair = propose()
+                if pair is None:
+                    continue
+            start_pos, end_pos = pair
+
+            route = route_pair(pair, candidates, crs, backend = backend)
+
+            if route is not None:
+                k += 1
+                if hasattr(chg_index, 'focus'):
+                    with metrics.timer('corridor'):
+                        chg_index.focus(route.lon, route.lat, crs)
+                print("Simulation attempt:", k)
+                region = 0 if sampler.strata is None else int(sampler.strata[sampler.road[start_pos['vertex']]])
+                occupancy = default_rng(SeedSequence(seeds.entropy, spawn_key = (1, k))) if crn else random_state
+
+                ## Simulate trip given the route fits our criteria for appropriate distance
+                try:
+                    outcome = run_trip(route, start_pos, end_pos, evc_data, route_dist, fuel_dist, crs, chg_index, backend = backend, random_state = occupancy,
+                                       chg_matrix = chg_matrix, coverage = coverage)
+                    if log is None:
+                        res.append(0 if outcome is None else 1)
+                    failure_rate.add(region, outcome is not None)
+
+                    ## Route traversals and failure points binned for the tile pyramid
+                    if traffic is not None:
+                        with metrics.timer('traffic'):
+                            traffic.add_route(route.lon, route.lat)
+                            if outcome is not None:
+                                traffic.add_frame(outcome)
+                
+                    metrics.gauge('chargers', len(chg_index), at = k)
+                
+                    ## Chargers are logged before the trip so a logged trip is always complete
+                    if log is not None:
+                        with metrics.timer('log'):
+                            if outcome is not None:
+                                log.charger(k, outcome)
+                            log.trip(k, outcome, random_state, region, [(p[0]['vertex'], p[1]['vertex']) for p in queued],
+                                     proposed = failure_rate.proposed if stratify else None)
+                
+                    metrics.gauge('failure_rate', failure_rate.rate(), at = k)
+                    metrics.gauge('failure_rate_half_width', failure_rate.half_width(), at = k)
+                    metrics.maybe_export()
                     
-            except:
-                print("Creating pickle!")
-                file_name = 'route_' + today.strftime("%d_%m_%Y") + ".pkl"
-                with open(file_name, 'wb') as f:
-                    pickle.dump([evc_data, route], f)
-                break
+                except:
+                    print("Creating pickle!")
+                    file_name = 'route_' + today.strftime("%d_%m_%Y") + ".pkl"
+                    with open(file_name, 'wb') as f:
+                        pickle.dump([chg_index.data, route], f)
+                    break
+            
+                ## Adaptive mode: n_sim is only a cap, stop once the estimate is precise enough
+                if (target is not None) and failure_rate.converged(target, region_target, min_trips):
+                    print("Failure rate converged after simulation", k)
+                    break
     
-    file_name = 'outcomes_' + today.strftime("%d_%m_%Y") + ".pkl"
-
-    ## Save outcomes to file
-    print("Simulations completed. Creating pickle!")
+        if coverage is not None:
+            coverage.close()
+
+        ## Outcomes of a logged run (resumed ones included) are read back from the log,
+        ## which stays the full record, into the same list of 0 / 1 as an unlogged run
+        if log is not None:
+            log.close()
+            res = log.outcomes().column('outcome').to_pylist()
+    
+        file_name = 'outcomes_' + today.strftime("%d_%m_%Y") + ".pkl"
+
+        ## Save outcomes to file
+        print("Simulations completed. Creating pickle!")
+        print("Candidate pairs accepted:", candidates.counts['accepted'], "of", candidates.stats()['routing_calls'], "routed")
+        lo, hi = failure_rate.interval()
+        print("Failure rate: {:.4f} ({:.0%} CI {:.4f} to {:.4f}) from {} trips".format(failure_rate.rate(), level, lo, hi, len(failure_rate)))
+        if regions is not None:
+            if failure_rate.unobserved() > 0:
+                print("Share of trips from regions with none simulated: {:.4f}".format(failure_rate.unobserved()))
+            print(failure_rate.regions().to_string(index = False))
+    
+        if metrics.enabled:
+            metrics.export()
+            print(metrics.summary())
     
-    with open(file_name, 'wb') as f:
-        pickle.dump([evc_data, res], f)
+        with open(file_name, 'wb') as f:
+            pickle.dump([chg_index.data, res], f)
 
-    return None
\ No newline at end of file
+        return res
\ No newline at end of file
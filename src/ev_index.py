@@ -0,0 +1,152 @@
+from numpy import arange, asarray, column_stack, concatenate, empty, flatnonzero, hypot, where
+from pandas import concat
+from ev_transform import PROJ, transformer
+from scipy.spatial import cKDTree
+
+## Charger spatial index ----
+## Built once over projected (EPSG:32613) station coordinates so nearest charger
+## lookups no longer rebuild a unary_union of every station on each refuel check.
+## New chargers are buffered and searched brute force until the buffer is large
+## enough to be worth folding into a rebuilt tree.
+class ChargerIndex:
+
+    def __init__(self, evc_data, rebuild_size = 256):
+        self.crs = evc_data.crs
+        self.rebuild_size = rebuild_size
+
+        ## Project once from the data CRS into metres for distance queries
+        self._to_proj = transformer(self.crs, PROJ)
+
+        self._base = evc_data.reset_index(drop = True)
+        self._added = []
+        self._xy = self._project(evc_data['geometry'].x.values, evc_data['geometry'].y.values)
+        self._tree = cKDTree(self._xy)
+        self._pending = empty((0, 2))
+
+    def __len__(self):
+        return len(self._xy) + len(self._pending)
+
+    def _project(self, x, y):
+        px, py = self._to_proj.transform(asarray(x, dtype = float), asarray(y, dtype = float))
+        return column_stack([px, py]).reshape(-1, 2)
+
+    def _rebuild(self):
+        self._xy = concatenate([self._xy, self._pending])
+        self._tree = cKDTree(self._xy)
+        self._pending = empty((0, 2))
+
+    def _added_rows(self):
+        if len(self._added) > 1:
+            self._added = [concat(self._added).reset_index(drop = True)]
+        return self._added[0]
+
+    ## Station rows for the given positional ids (ids past the base data are added chargers)
+    def rows(self, ids):
+        ids = asarray(ids)
+        n_base = len(self._base)
+        if (ids < n_base).all():
+            return self._base.iloc[ids]
+        out = concat([
+            self._base.iloc[ids[ids < n_base]],
+            self._added_rows().iloc[ids[ids >= n_base] - n_base]
+        ])
+        out.index = concatenate([ids[ids < n_base], ids[ids >= n_base]])
+        return out
+
+    ## Full station table including any added chargers
+    @property
+    def data(self):
+        if not self._added:
+            return self._base
+        return concat([self._base, self._added_rows()]).reset_index(drop = True)
+
+    ## k-nearest station ids and distances (metres) to a point in the index CRS
+    def query(self, point, k = 1):
+        xy = self._project(point.x, point.y)[0]
+        k = min(k, len(self))
+
+        dist, ids = self._tree.query(xy, k = min(k, len(self._xy)))
+        dist = asarray(dist).reshape(-1)
+        ids = asarray(ids).reshape(-1)
+
+        ## Merge in any chargers added since the last rebuild
+        if len(self._pending):
+            p_dist = hypot(*(self._pending - xy).T)
+            dist = concatenate([dist, p_dist])
+            ids = concatenate([ids, len(self._xy) + arange(len(p_dist))])
+            order = dist.argsort(kind = "stable")[:k]
+            dist, ids = dist[order], ids[order]
+
+        return ids, dist
+
+    ## Projected coordinates of every station, in id order
+    @property
+    def coords(self):
+        return concatenate([self._xy, self._pending])
+
+    ## Stations stacked on the same coordinates form a group: the group of every
+    ## station id, plus each group's lowest station id and number of stations
+    def groups(self):
+        from numpy import unique
+
+        _, first, group, count = unique(self.coords, axis = 0, return_index = True, return_inverse = True, return_counts = True)
+        return group.reshape(-1), first, count
+
+    ## Nearest station id and distance (metres) for arrays of x and y in the index CRS
+    def nearest_many(self, x, y):
+        xy = self._project(x, y)
+        dist, ids = self._tree.query(xy)
+
+        if len(self._pending):
+            p_dist = hypot(xy[:, None, 0] - self._pending[None, :, 0], xy[:, None, 1] - self._pending[None, :, 1])
+            p_best = p_dist.argmin(axis = 1)
+            p_dist = p_dist[arange(len(xy)), p_best]
+            closer = p_dist < dist
+            ids = where(closer, len(self._xy) + p_best, ids)
+            dist = where(closer, p_dist, dist)
+
+        return ids, dist
+
+    ## All station rows sharing the location of the nearest station
+    def nearest(self, point):
+        ids, dist = self.query(point, k = 1)
+        return self.at(ids[0])
+
+    ## All station rows sharing the location of station id i
+    def at(self, i):
+        loc = self._xy[i] if i < len(self._xy) else self._pending[i - len(self._xy)]
+
+        ## Stations stacked on the same coordinates are returned together
+        ties = self._tree.query_ball_point(loc, r = 0)
+        if len(self._pending):
+            same = (self._pending == loc).all(axis = 1)
+            ties = [*ties, *(len(self._xy) + flatnonzero(same))]
+
+        return self.rows(sorted(ties))
+
+    ## Add new charger rows (same schema and CRS as the indexed data)
+    def insert(self, rows):
+        geom = rows['geometry']
+        xy = self._project([g.x for g in geom], [g.y for g in geom])
+
+        self._added.append(rows.reset_index(drop = True))
+        self._pending = concatenate([self._pending, xy])
+
+        if len(self._pending) >= self.rebuild_size:
+            self._rebuild()
+
+    ## Drop every station after the first n (n at least the base data), going back
+    ## to the index as it was before the later chargers were inserted
+    def truncate(self, n):
+        n_base = len(self._base)
+        if n < n_base:
+            raise ValueError("Cannot drop stations of the indexed data")
+        if n >= len(self):
+            return
+        if n < len(self._xy):
+            self._xy = self._xy[:n]
+            self._tree = cKDTree(self._xy)
+            self._pending = empty((0, 2))
+        else:
+            self._pending = self._pending[:n - len(self._xy)]
+        self._added = [self._added_rows().iloc[:n - n_base]] if n > n_base else []
@@ -0,0 +1,188 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+TRIP_SCHEMA = pa.schema([
+    ('trip', pa.int64()),
+    ('outcome', pa.int8()),
+    ('fal_typ', pa.string()),
+    ('rng_state', pa.string()),
+    ('region', pa.int64()),
+    ('queued', pa.list_(pa.int64())),
+    ('proposed', pa.list_(pa.int64()))
+])
+
+CHARGER_SCHEMA = pa.schema([
+    ('trip', pa.int64()),
+    ('nm_chrg', pa.int64()),
+    ('fal_typ', pa.string()),
+    ('lon', pa.float64()),
+    ('lat', pa.float64())
+])
+
+## Streaming outcome log ----
+## Append only Arrow IPC logs of completed trips and of the chargers they add,
+## one record batch per row, flushed as soon as it is written. Every run (and
+## every resume) writes a new numbered segment, so earlier segments are never
+## reopened, and a segment cut short by a crash is read up to its last complete
+## batch. A charger is written before the trip that added it and only counts
+## once that trip is logged in the same segment, so chargers from a trip that
+## crashed part way are dropped when the trip is rerun. A directory holds one run:
+## with fresh set (a new run rather than a resume) it must not have segments yet,
+## so an unrelated earlier run is never read back as part of this one.
+## With prefetch, pairs for later trips are drawn before a trip is logged, so the
+## generator state after a trip is already past them: each trip row also holds
+## the start and end vertices of the pairs still queued, which a resume queues
+## again before drawing anything new. A stratified run also logs the start points
+## proposed so far in each region, which its allocation of trips depends on.
+class OutcomeLog:
+
+    def __init__(self, log_dir, fresh = False):
+        self.log_dir = Path(log_dir)
+        self.log_dir.mkdir(parents = True, exist_ok = True)
+        self._writers = {}
+
+        ## Segment number shared by both logs for this run
+        existing = [int(p.stem.rsplit("_", 1)[1]) for p in self.log_dir.glob("*_*.arrow")]
+        if fresh and existing:
+            raise FileExistsError(
+                "{} already holds a logged run, resume it or log to an empty directory".format(self.log_dir)
+            )
+        self.segment = max(existing, default = -1) + 1
+
+    def _segments(self, name):
+        return sorted(self.log_dir.glob(name + "_*.arrow"))
+
+    def _writer(self, name, schema):
+        if name not in self._writers:
+            sink = pa.OSFile(str(self.log_dir / "{}_{:04d}.arrow".format(name, self.segment)), 'wb')
+            self._writers[name] = (sink, ipc.new_stream(sink, schema))
+        return self._writers[name]
+
+    def _append(self, name, schema, row):
+        sink, writer = self._writer(name, schema)
+        writer.write_batch(pa.record_batch([pa.array([v], type = f.type) for v, f in zip(row, schema)], schema = schema))
+        sink.flush()
+
+    ## Record the chargers a failed trip adds (geometry in the charger data CRS)
+    def charger(self, trip, outcome):
+        for _, row in outcome.iterrows():
+            self._append('chargers', CHARGER_SCHEMA, [trip, int(row['nm_chrg']), row['fal_typ'], row['geometry'].x, row['geometry'].y])
+
+    ## Record a completed trip with the generator state after it, its start region,
+    ## the (start, end) vertex pairs drawn but not yet simulated and, when given, the
+    ## start points proposed so far per region
+    def trip(self, trip, outcome, random_state = None, region = None, queued = (), proposed = None):
+        fal_typ = None if outcome is None else outcome['fal_typ'].iloc[0]
+        state = None if random_state is None else json.dumps(random_state.bit_generator.state)
+        pairs = [int(v) for pair in queued for v in pair]
+        proposed = None if proposed is None else [int(v) for v in proposed]
+        self._append('trips', TRIP_SCHEMA, [trip, 0 if outcome is None else 1, fal_typ, state, region, pairs, proposed])
+
+    def close(self):
+        for sink, writer in self._writers.values():
+            writer.close()
+            sink.close()
+        self._writers = {}
+
+    ## All complete batches of every segment, stopping at a truncated tail. Columns
+    ## missing from segments written before they were added are read as nulls
+    def read(self, name, schema):
+        tables = []
+        for path in self._segments(name):
+            batches = list(self._batches(path))
+            table = pa.Table.from_batches(batches) if batches else schema.empty_table()
+            table = pa.table([
+                table.column(f.name) if f.name in table.column_names else pa.nulls(table.num_rows, f.type) for f in schema
+            ], schema = schema)
+            segment = int(path.stem.rsplit("_", 1)[1])
+            tables.append(table.append_column('segment', pa.array([segment] * table.num_rows, type = pa.int64())))
+        if not tables:
+            return schema.append(pa.field('segment', pa.int64())).empty_table()
+        return pa.concat_tables(tables)
+
+    def trips(self):
+        return self.read('trips', TRIP_SCHEMA).to_pandas()
+
+    ## Trip numbers and outcomes (1 for a failure) as an Arrow table, without
+    ## turning every row into Python objects
+    def outcomes(self):
+        return self.read('trips', TRIP_SCHEMA).select(['trip', 'outcome'])
+
+    ## Logged chargers of completed trips as rows in the evc_data schema
+    def chargers(self, crs):
+        from geopandas import GeoDataFrame, points_from_xy
+
+        chgs = self.read('chargers', CHARGER_SCHEMA).to_pandas()
+        done = self.trips()[['trip', 'segment']]
+        chgs = chgs.merge(done, on = ['trip', 'segment'], how = 'inner')
+        return GeoDataFrame({
+            "fll_ddr": None,
+            "nm_chrg": chgs['nm_chrg'].values,
+            "fal_typ": chgs['fal_typ'].values,
+            "geometry": points_from_xy(chgs['lon'], chgs['lat'])
+        }, crs = crs)
+
+    ## Failure points of completed trips as (lon, lat, fal_typ) array chunks, reading
+    ## one batch at a time. Trips are logged in order and a charger row is written
+    ## before its trip, so within a segment only rows after the last logged trip
+    ## can belong to an unfinished one.
+    def failures(self, chunk_size = 65536):
+        for path in self._segments('chargers'):
+            segment = int(path.stem.rsplit("_", 1)[1])
+            trips = self.log_dir / "trips_{:04d}.arrow".format(segment)
+            last = -1
+            if trips.exists():
+                for batch in self._batches(trips):
+                    last = max(last, max(batch.column('trip').to_pylist(), default = -1))
+
+            buf = []
+            n = 0
+            for batch in self._batches(path):
+                buf.append(batch)
+                n += batch.num_rows
+                if n >= chunk_size:
+                    yield self._failure_chunk(buf, last)
+                    buf, n = [], 0
+            if buf:
+                yield self._failure_chunk(buf, last)
+
+    def _batches(self, path):
+        try:
+            with ipc.open_stream(pa.memory_map(str(path))) as reader:
+                for batch in reader:
+                    yield batch
+        except (pa.ArrowInvalid, OSError):
+            return
+
+    @staticmethod
+    def _failure_chunk(batches, last):
+        table = pa.Table.from_batches(batches)
+        keep = np.asarray(table.column('trip')) <= last
+        return (
+            np.asarray(table.column('lon'))[keep],
+            np.asarray(table.column('lat'))[keep],
+            np.asarray(table.column('fal_typ').to_pylist(), dtype = object)[keep]
+        )
+
+    ## Last completed trip, the chargers added up to it, the generator state after it,
+    ## the (start, end) vertex pairs that were queued at that point and the per region
+    ## proposal counts (None if they were not logged)
+    def resume_state(self, crs):
+        trips = self.read('trips', TRIP_SCHEMA)
+        if trips.num_rows == 0:
+            return 0, None, None, [], None
+
+        last = trips.slice(trips.num_rows - 1).to_pylist()[0]
+        state = None if last['rng_state'] is None else json.loads(last['rng_state'])
+        pairs = last['queued'] or []
+        return last['trip'], self.chargers(crs), state, list(zip(pairs[0::2], pairs[1::2])), last['proposed']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
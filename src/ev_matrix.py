@@ -0,0 +1,217 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+## Charger distance matrix ----
+## Network distances (metres, over the LocalBackend road graph) from every station
+## to a coarse grid of destination cells and between every pair of stations.
+## A cell holds the smallest and largest distance to the graph nodes inside it, so
+## the distance to any node in the cell lies between the two. Rows are kept on disk
+## in append only files, one row per station in ChargerIndex id order, so a charger
+## added by route_process costs one Dijkstra run and a few appends:
+##
+##   meta.json       grid origin, cell size and shape, graph size
+##   stations.f64    projected x, y of each station row
+##   cells.f32       station to cell minimum distances, one row of n_cells per station
+##   cells_max.f32   station to cell maximum distances, laid out like cells.f32
+##   pairs.f32       station to station distances, row i holds stations 0..i
+##                   (the graph is undirected, so the matrix is symmetric)
+##
+## Unreachable and empty cells and unreachable stations are inf. The OSRM table
+## service is not used: the local graph answers these queries offline, from the
+## same roads layer.
+FILES = ("stations.f64", "cells.f32", "cells_max.f32", "pairs.f32")
+
+class ChargerMatrix:
+
+    def __init__(self, graph, path, cell_size = 10000, max_bytes = 64 * 2**20):
+        self.graph = graph
+        self.path = Path(path)
+        self.path.mkdir(parents = True, exist_ok = True)
+
+        ## Sources per Dijkstra call, so the float64 distance rows and their cell
+        ## ordered copy stay under max_bytes however large the graph is
+        self.batch = max(1, int(max_bytes // (16 * len(graph))))
+
+        meta = {
+            'cell_size': cell_size,
+            'x0': float(graph.x.min()),
+            'y0': float(graph.y.min()),
+            'nx': int((graph.x.max() - graph.x.min()) // cell_size) + 1,
+            'ny': int((graph.y.max() - graph.y.min()) // cell_size) + 1,
+            'n_nodes': len(graph),
+            'cells': 'min_max'
+        }
+
+        ## Start over when the grid or graph no longer matches what is on disk
+        meta_path = self.path / "meta.json"
+        if (not meta_path.exists()) or (json.loads(meta_path.read_text()) != meta):
+            for name in FILES:
+                (self.path / name).write_bytes(b"")
+            meta_path.write_text(json.dumps(meta, indent = 1))
+
+        self.cell_size = cell_size
+        self.x0, self.y0, self.nx, self.ny = meta['x0'], meta['y0'], meta['nx'], meta['ny']
+        self.n_cells = self.nx * self.ny
+
+        ## Graph nodes grouped by cell, for reducing a row of node distances per cell
+        node_cell = self.cell_of(graph.x, graph.y)
+        self._node_order = np.argsort(node_cell, kind = "stable")
+        self._occupied, self._cell_start = np.unique(node_cell[self._node_order], return_index = True)
+        self._load()
+
+    ## Read the rows on disk, dropping a partly written last row
+    def _load(self):
+        n_cells = self.n_cells
+        xy = np.fromfile(self.path / "stations.f64", dtype = np.float64)
+        cells = np.fromfile(self.path / "cells.f32", dtype = np.float32)
+        cells_max = np.fromfile(self.path / "cells_max.f32", dtype = np.float32)
+        pairs = np.fromfile(self.path / "pairs.f32", dtype = np.float32)
+
+        n = min(len(xy) // 2, len(cells) // n_cells, len(cells_max) // n_cells)
+        while n * (n + 1) // 2 > len(pairs):
+            n -= 1
+
+        self.n = n
+        self.xy = xy[:2 * n].reshape(-1, 2)
+        self._cells = cells[:n * n_cells].reshape(-1, n_cells)
+        self._cells_max = cells_max[:n * n_cells].reshape(-1, n_cells)
+        self._pairs = pairs[:n * (n + 1) // 2]
+        self.nodes = self.graph._tree.query(self.xy)[1] if n else np.empty(0, dtype = np.int64)
+        if n * 2 != len(xy) or n * n_cells != len(cells) or n * n_cells != len(cells_max) or n * (n + 1) // 2 != len(pairs):
+            self._truncate(n)
+
+    def _truncate(self, n):
+        self.n = n
+        self.xy = self.xy[:n]
+        self.nodes = self.nodes[:n]
+        self.xy.tofile(self.path / "stations.f64")
+        self.cells.tofile(self.path / "cells.f32")
+        self.cells_max.tofile(self.path / "cells_max.f32")
+        self.pairs.tofile(self.path / "pairs.f32")
+
+    ## Row buffers grow by doubling so appending a station does not copy the matrix
+    @staticmethod
+    def _grow(buf, size):
+        if len(buf) >= size:
+            return buf
+        out = np.empty((max(size, 2 * len(buf)), *buf.shape[1:]), dtype = buf.dtype)
+        out[:len(buf)] = buf
+        return out
+
+    @property
+    def cells(self):
+        return self._cells[:self.n]
+
+    @property
+    def cells_max(self):
+        return self._cells_max[:self.n]
+
+    @property
+    def pairs(self):
+        return self._pairs[:self.n * (self.n + 1) // 2]
+
+    def __len__(self):
+        return self.n
+
+    ## Distances from graph nodes to every node, a batch of sources at a time
+    def _dijkstra(self, sources):
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import dijkstra
+
+        g = self.graph
+        if not hasattr(self, '_csr'):
+            self._csr = csr_matrix((g.weights, g.indices, g.indptr), shape = (len(g), len(g)))
+        for i in range(0, len(sources), self.batch):
+            yield i, dijkstra(self._csr, directed = True, indices = sources[i:i + self.batch])
+
+    ## Append rows for stations at projected coordinates xy
+    def add(self, xy):
+        xy = np.asarray(xy, dtype = np.float64).reshape(-1, 2)
+        if not len(xy):
+            return
+        new_nodes = self.graph._tree.query(xy)[1]
+        nodes = np.concatenate([self.nodes, new_nodes])
+
+        ## Stacked stations share a node, so each distinct node is searched once. Each
+        ## batch of node distances is reduced to its cell and station rows and dropped
+        ## before the next, so memory is bounded by the batch, not the graph times the
+        ## number of stations
+        unique, inverse = np.unique(new_nodes, return_inverse = True)
+        inverse = inverse.reshape(-1)
+        cells_min = np.full((len(unique), self.n_cells), np.inf, dtype = np.float32)
+        cells_max = np.full((len(unique), self.n_cells), np.inf, dtype = np.float32)
+        to_nodes = np.empty((len(unique), len(nodes)), dtype = np.float32)
+        for i, dist in self._dijkstra(unique):
+            ordered = dist[:, self._node_order]
+            cells_min[i:i + len(dist), self._occupied] = np.minimum.reduceat(ordered, self._cell_start, axis = 1)
+            ## Round the largest distances up, so a float32 cell maximum stays an upper bound
+            largest = np.maximum.reduceat(ordered, self._cell_start, axis = 1)
+            stored = largest.astype(np.float32)
+            cells_max[i:i + len(dist), self._occupied] = np.where(stored < largest, np.nextafter(stored, np.float32(np.inf)), stored)
+            to_nodes[i:i + len(dist)] = dist[:, nodes]
+            del dist, ordered, largest, stored
+
+        start = self.n
+        cells = cells_min[inverse]
+        cells_max = cells_max[inverse]
+        pairs = np.concatenate([to_nodes[inverse[k], :start + k + 1] for k in range(len(xy))])
+
+        with open(self.path / "stations.f64", 'ab') as f:
+            f.write(xy.tobytes())
+        with open(self.path / "cells.f32", 'ab') as f:
+            f.write(cells.tobytes())
+        with open(self.path / "cells_max.f32", 'ab') as f:
+            f.write(cells_max.tobytes())
+        with open(self.path / "pairs.f32", 'ab') as f:
+            f.write(pairs.tobytes())
+
+        self.n = start + len(xy)
+        self._cells = self._grow(self._cells, self.n)
+        self._cells[start:self.n] = cells
+        self._cells_max = self._grow(self._cells_max, self.n)
+        self._cells_max[start:self.n] = cells_max
+        self._pairs = self._grow(self._pairs, self.n * (self.n + 1) // 2)
+        self._pairs[start * (start + 1) // 2:self.n * (self.n + 1) // 2] = pairs
+        self.xy = np.concatenate([self.xy, xy])
+        self.nodes = nodes
+
+    ## Bring the rows in line with a ChargerIndex: keep the stored prefix that
+    ## matches the index and compute rows for every station after it
+    def sync(self, chg_index):
+        coords = chg_index.coords
+        n = min(len(self), len(coords))
+        same = np.all(np.abs(self.xy[:n] - coords[:n]) < 1e-6, axis = 1)
+        keep = n if same.all() else int(np.argmin(same))
+        if keep < len(self):
+            self._truncate(keep)
+        self.add(coords[keep:])
+
+    ## Grid cell of projected coordinates
+    def cell_of(self, x, y):
+        cx = np.clip(((np.asarray(x) - self.x0) // self.cell_size).astype(np.int64), 0, self.nx - 1)
+        cy = np.clip(((np.asarray(y) - self.y0) // self.cell_size).astype(np.int64), 0, self.ny - 1)
+        return cy * self.nx + cx
+
+    ## Smallest network distance from a station to a node in the cell holding
+    ## projected (x, y)
+    def to_cell(self, station, x, y):
+        return float(self._cells[station, self.cell_of(x, y)])
+
+    ## Lower and upper bounds on the network distance from a station to the graph
+    ## node nearest projected (x, y), from the cell that node lies in (the point's
+    ## own cell may not hold it). The upper bound also covers the straight line legs
+    ## from the point and the station to the nodes they snap to
+    def bounds(self, station, x, y):
+        snap, node = self.graph._tree.query([x, y])
+        node = int(node)
+        cell = self.cell_of(self.graph.x[node], self.graph.y[node])
+        sx, sy = self.xy[station]
+        station_snap = np.hypot(self.graph.x[self.nodes[station]] - sx, self.graph.y[self.nodes[station]] - sy)
+        return float(self._cells[station, cell]), float(self._cells_max[station, cell]) + snap + station_snap
+
+    ## Network distance between two stations
+    def between(self, i, j):
+        i, j = max(i, j), min(i, j)
+        return float(self._pairs[i * (i + 1) // 2 + j])
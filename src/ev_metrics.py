@@ -0,0 +1,219 @@
+import json
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from math import inf
+from pathlib import Path
+from time import monotonic, perf_counter, time
+
+## Metrics ----
+## Stage timers, counters, histograms and gauges for the simulation hot paths.
+## route_process, calculate_route, simulate_trip and the OSRM backends report to
+## the registry returned by get_metrics(), which is a NullMetrics (every call a
+## no-op) until a Metrics is installed with set_metrics() or, for one run,
+## passed to route_process. A Metrics with a path writes a snapshot there at most every
+## `interval` seconds from maybe_export() and whenever export() is called, as
+## Prometheus text for a .prom path and JSON otherwise.
+
+## HTTP latency buckets (seconds)
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, inf)
+
+PREFIX = "evcs_"
+
+class _Timer:
+
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, perf_counter() - self.start)
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+class NullMetrics:
+
+    enabled = False
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, n = 1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def gauge(self, name, value, at = None):
+        pass
+
+    def maybe_export(self):
+        pass
+
+    def export(self, path = None):
+        pass
+
+class Metrics:
+
+    enabled = True
+
+    def __init__(self, path = None, interval = 60.0, buckets = HTTP_BUCKETS, history = 10000):
+        self.path = None if path is None else Path(path)
+        self.interval = interval
+        self.buckets = tuple(buckets)
+        self.history = history
+
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.series = {}
+        self._calls = {}
+        self._stride = {}
+
+        self.started = time()
+        self._last_export = monotonic()
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    ## Stage totals as [calls, seconds, slowest call]
+    def add_time(self, name, seconds):
+        t = self.timers.get(name)
+        if t is None:
+            self.timers[name] = [1, seconds, seconds]
+        else:
+            t[0] += 1
+            t[1] += seconds
+            if seconds > t[2]:
+                t[2] = seconds
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    ## Histogram as per bucket counts plus the sum of observed values
+    def observe(self, name, value):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = [[0] * len(self.buckets), 0.0]
+        h[0][bisect_left(self.buckets, value)] += 1
+        h[1] += value
+
+    ## Current value, plus (at, seconds since start, value) kept as a series. A
+    ## series reaching history points drops every other one and from then on keeps
+    ## every other call, so it stays evenly spread over the whole run
+    def gauge(self, name, value, at = None):
+        self.gauges[name] = value
+        series = self.series.setdefault(name, [])
+        calls = self._calls.get(name, 0)
+        self._calls[name] = calls + 1
+        stride = self._stride.get(name, 1)
+        if calls % stride:
+            return
+        series.append((at, time() - self.started, value))
+        if len(series) >= self.history:
+            del series[1::2]
+            self._stride[name] = 2 * stride
+
+    def snapshot(self):
+        return {
+            'time': time(),
+            'uptime': time() - self.started,
+            'timers': {k: {'calls': c, 'seconds': s, 'max': m} for k, (c, s, m) in self.timers.items()},
+            'counters': dict(self.counters),
+            'histograms': {
+                k: {'buckets': [str(b) for b in self.buckets], 'counts': list(counts), 'sum': total}
+                for k, (counts, total) in self.histograms.items()
+            },
+            'gauges': dict(self.gauges),
+            'series': {k: list(v) for k, v in self.series.items()}
+        }
+
+    def to_prometheus(self):
+        lines = []
+        if self.timers:
+            lines.append("# TYPE {}stage_seconds_total counter".format(PREFIX))
+            for k, (c, s, m) in self.timers.items():
+                lines.append('{}stage_seconds_total{{stage="{}"}} {}'.format(PREFIX, k, s))
+            lines.append("# TYPE {}stage_calls_total counter".format(PREFIX))
+            for k, (c, s, m) in self.timers.items():
+                lines.append('{}stage_calls_total{{stage="{}"}} {}'.format(PREFIX, k, c))
+        for k, v in self.counters.items():
+            lines.append("# TYPE {}{}_total counter".format(PREFIX, k))
+            lines.append("{}{}_total {}".format(PREFIX, k, v))
+        for k, (counts, total) in self.histograms.items():
+            lines.append("# TYPE {}{} histogram".format(PREFIX, k))
+            running = 0
+            for b, c in zip(self.buckets, counts):
+                running += c
+                lines.append('{}{}_bucket{{le="{}"}} {}'.format(PREFIX, k, "+Inf" if b == inf else b, running))
+            lines.append("{}{}_sum {}".format(PREFIX, k, total))
+            lines.append("{}{}_count {}".format(PREFIX, k, running))
+        for k, v in self.gauges.items():
+            lines.append("# TYPE {}{} gauge".format(PREFIX, k))
+            lines.append("{}{} {}".format(PREFIX, k, v))
+        return "\n".join(lines) + "\n"
+
+    def maybe_export(self):
+        if (self.path is not None) and (monotonic() - self._last_export >= self.interval):
+            self.export()
+
+    ## Write to a temporary file and rename, so readers never see a partial snapshot
+    def export(self, path = None):
+        path = self.path if path is None else Path(path)
+        if path is None:
+            return
+        text = self.to_prometheus() if path.suffix == ".prom" else json.dumps(self.snapshot(), indent = 1)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(text)
+        os.replace(tmp, path)
+        self._last_export = monotonic()
+
+    ## Stage table sorted by total time, for printing at the end of a run
+    def summary(self):
+        rows = sorted(self.timers.items(), key = lambda kv: -kv[1][1])
+        return "\n".join(
+            "{:<20} {:>8} calls {:>10.3f} s {:>10.3f} ms/call".format(k, c, s, 1000 * s / c) for k, (c, s, m) in rows
+        )
+
+## Registry used by the instrumented functions
+_metrics = NullMetrics()
+
+def get_metrics():
+    return _metrics
+
+def set_metrics(metrics):
+    global _metrics
+    previous = _metrics
+    _metrics = NullMetrics() if metrics is None else metrics
+    return previous
+
+## Report to metrics inside the block and put the previous registry back however
+## it ends. With metrics None the current registry is kept
+@contextmanager
+def use_metrics(metrics):
+    if metrics is None:
+        yield get_metrics()
+        return
+    previous = set_metrics(metrics)
+    try:
+        yield metrics
+    finally:
+        set_metrics(previous)
@@ -0,0 +1,290 @@
+import asyncio
+import json
+from hashlib import sha1
+from pathlib import Path
+from random import Random
+from threading import Lock, Thread
+from time import perf_counter
+
+from ev_metrics import get_metrics
+
+from ev_routing import OSRM_QUERY, OSRM_URL, osrm_loc, parse_osrm_text
+
+## Fixture file name for a recorded response, keyed on the coordinate part only
+def fixture_name(loc):
+    return sha1(loc.encode()).hexdigest() + ".json"
+
+## Write a raw OSRM response body as the fixture for a request
+def save_fixture(fixture_dir, loc, text):
+    fixture_dir = Path(fixture_dir)
+    fixture_dir.mkdir(parents = True, exist_ok = True)
+    (fixture_dir / fixture_name(loc)).write_text(text)
+
+## OSRM route response for a backend result, so local routes can stand in for recorded ones
+def osrm_response(res):
+    from polyline import encode
+
+    return {
+        'code': "Ok",
+        'routes': [{
+            'geometry': encode([(lat, lon) for lon, lat in res['coords']]),
+            'legs': [{'annotation': {'distance': list(res['distances'])}, 'distance': res['distance']}],
+            'distance': res['distance']
+        }],
+        'waypoints': [{'location': list(res['start'])}, {'location': list(res['end'])}]
+    }
+
+## Async OSRM client ----
+## Runs an asyncio loop on a background thread with one pooled aiohttp session.
+## At most `concurrency` requests are in flight, failed requests back off
+## exponentially with full jitter, and client errors (4xx other than 429) are
+## not retried. A request failing every attempt is counted under http_failures
+## and answered with None. Works as a routing backend through route(), and
+## prefetch() lets route_process queue the next trips' routes while the current
+## one simulates.
+## At most max_pending prefetched routes are kept, the oldest are cancelled
+## first, and close() cancels any never asked for. Requests tally their metrics
+## under a lock on the loop thread, and the tallies are passed to the registry
+## from the calling thread, so the registry is never updated from two threads.
+class AsyncOSRMClient:
+
+    symmetric = False
+
+    def __init__(self, url = OSRM_URL, concurrency = 8, retries = 4, backoff = 0.5, max_backoff = 8, timeout = 30, record_dir = None,
+                 max_pending = 256):
+        self.url = url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.record_dir = record_dir
+        self.max_pending = max_pending
+
+        self._jitter = Random()
+        self._pending = {}
+        self._loop = None
+        self._tally_lock = Lock()
+        self._counts = {}
+        self._observed = []
+
+    ## Start the loop thread and open the session on first use
+    def _start(self):
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target = self._loop.run_forever, daemon = True)
+        self._thread.start()
+        self._submit(self._open()).result()
+
+    async def _open(self):
+        import aiohttp
+
+        self._session = aiohttp.ClientSession(
+            connector = aiohttp.TCPConnector(limit = self.concurrency),
+            timeout = aiohttp.ClientTimeout(total = self.timeout)
+        )
+        self._sem = asyncio.Semaphore(self.concurrency)
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    ## Metric tallies kept on the loop thread until _report() runs
+    def _count(self, name):
+        with self._tally_lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def _observe(self, name, value):
+        with self._tally_lock:
+            self._observed.append((name, value))
+
+    ## Pass the tallies to the metrics registry, from the calling thread
+    def _report(self):
+        with self._tally_lock:
+            counts, observed = self._counts, self._observed
+            self._counts, self._observed = {}, []
+        metrics = get_metrics()
+        for name, n in counts.items():
+            metrics.count(name, n)
+        for name, value in observed:
+            metrics.observe(name, value)
+
+    ## The semaphore is held per attempt, not through the backoff, so requests
+    ## waiting to retry leave their slots to others
+    async def fetch(self, loc):
+        import aiohttp
+
+        for attempt in range(self.retries):
+            if attempt > 0:
+                self._count('http_retries')
+            try:
+                async with self._sem:
+                    start = perf_counter()
+                    async with self._session.get(self.url + loc + OSRM_QUERY) as r:
+                        status = r.status
+                        text = await r.text() if status == 200 else None
+                self._observe('http_seconds', perf_counter() - start)
+                self._count('http_requests')
+                if status == 200:
+                    if self.record_dir is not None:
+                        save_fixture(self.record_dir, loc, text)
+                    return parse_osrm_text(text)
+                if (status < 500) & (status != 429):
+                    return None
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self._count('http_errors')
+
+            if attempt < self.retries - 1:
+                await asyncio.sleep(self._jitter.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+        self._count('http_failures')
+        return None
+
+    async def fetch_many(self, locs):
+        return await asyncio.gather(*(self.fetch(loc) for loc in locs))
+
+    ## Resolve many (pickup_lon, pickup_lat, dropoff_lon, dropoff_lat) pairs concurrently
+    def route_many(self, pairs):
+        self._start()
+        try:
+            return self._submit(self.fetch_many([osrm_loc(*p) for p in pairs])).result()
+        finally:
+            self._report()
+
+    ## Start fetching routes that route() will be asked for later, cancelling the
+    ## oldest ones beyond max_pending
+    def prefetch(self, pairs):
+        self._start()
+        for p in pairs:
+            loc = osrm_loc(*p)
+            if loc not in self._pending:
+                self._pending[loc] = self._submit(self.fetch(loc))
+        while len(self._pending) > self.max_pending:
+            self._pending.pop(next(iter(self._pending))).cancel()
+
+    def route(self, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat):
+        self._start()
+        loc = osrm_loc(pickup_lon, pickup_lat, dropoff_lon, dropoff_lat)
+        future = self._pending.pop(loc, None)
+        if future is None:
+            future = self._submit(self.fetch(loc))
+        try:
+            return future.result()
+        finally:
+            self._report()
+
+    def close(self):
+        if self._loop is None:
+            return
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self._submit(self._session.close()).result()
+        self._report()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+## Replay server ----
+## Local stand-in for an OSRM server answering /route requests from responses
+## recorded with AsyncOSRMClient(record_dir = ...). Unknown routes are answered
+## by the fallback backend (and saved as new fixtures) when one is given, or get
+## OSRM's NoRoute error. fail_rate injects 503s to exercise client retries.
+class ReplayServer:
+
+    def __init__(self, fixture_dir, host = "127.0.0.1", port = 0, fail_rate = 0.0, seed = None, fallback = None):
+        self.fixture_dir = Path(fixture_dir)
+        self.fallback = fallback
+        self.host = host
+        self.port = port
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self._rng = Random(seed)
+        self._lock = Lock()
+        self._httpd = None
+
+    @property
+    def url(self):
+        return "http://{}:{}/route/v1/driving/".format(self.host, self.port)
+
+    def _handler(self):
+        from http.server import BaseHTTPRequestHandler
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                ## Handlers run on their own threads
+                with server._lock:
+                    server.requests += 1
+                    fail = server._rng.random() < server.fail_rate
+                loc = self.path.split("?")[0].rsplit("/", 1)[-1]
+                fixture = server.fixture_dir / fixture_name(loc)
+
+                if fail:
+                    status, body = 503, b'{"code": "Unavailable"}'
+                elif fixture.exists():
+                    status, body = 200, fixture.read_bytes()
+                else:
+                    status, body = 400, b'{"code": "NoRoute"}'
+                    text = server._fall_back(loc)
+                    if text is not None:
+                        status, body = 200, text.encode()
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    ## Route an unknown request with the fallback and save it as a fixture, returning
+    ## the response body or None. Calls are serialised, as a fallback need not be
+    ## thread safe (a CachedBackend's SQLite connection only works on its own thread)
+    def _fall_back(self, loc):
+        if self.fallback is None:
+            return None
+        coords = [float(c) for pair in loc.split(";") for c in pair.split(",")]
+        with self._lock:
+            fixture = self.fixture_dir / fixture_name(loc)
+            if fixture.exists():
+                return fixture.read_text()
+            res = self.fallback.route(*coords)
+            if res is None:
+                return None
+            text = json.dumps(osrm_response(res))
+            save_fixture(self.fixture_dir, loc, text)
+        return text
+
+    def start(self):
+        from http.server import ThreadingHTTPServer
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), self._handler())
+        self.port = self._httpd.server_address[1]
+        self._thread = Thread(target = self._httpd.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
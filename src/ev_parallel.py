@@ -0,0 +1,242 @@
+import ev_functions as evc
+
+## Parallel route process ----
+## Trips are run in synchronization epochs. In each epoch every worker simulates
+## a block of trips against the chargers known at the start of the epoch (plus
+## any it adds itself), then the main process merges the new chargers in worker
+## order so the next epoch sees them all. Each block draws from its own
+## SeedSequence stream keyed on (epoch, worker), so results depend only on the
+## seed and the worker and epoch sizes, not on process scheduling.
+##
+## A block runs the same per trip steps as route_process (route_pair and run_trip)
+## and stops at the first trip that raises, reporting the error rather than
+## taking down the pool. Each worker process keeps one charger index for the whole
+## run: a block first adds the chargers merged since that process last synced,
+## and afterwards drops the ones it added itself, whose place in the merged order
+## is only decided by the main process.
+
+## Per process state set up once by the pool initializer
+_worker = {}
+
+def _init_worker(road_data, evc_data, route_dist, fuel_dist, crs, weighted, max_dist, backend_factory, cache_dir, tile_budget, shared = None):
+    from ev_candidates import CandidateGenerator
+    from ev_index import ChargerIndex
+    from ev_sampler import VertexSampler
+    from ev_prepare import open_sampler
+    from ev_shared import SharedArrays, SharedChargers, shared_sampler
+    from ev_tiles import TiledChargers, open_tiled_sampler
+
+    chargers = None
+    if shared is not None:
+        roads_handle, road_crs, chargers_handle = shared
+        roads = SharedArrays(roads_handle)
+        chargers = SharedChargers.attach(chargers_handle)
+        sampler = shared_sampler(roads, road_crs)
+        evc_data = chargers.frame(0, chargers.n_base)
+        _worker['roads'] = roads
+    elif cache_dir is None:
+        sampler = VertexSampler(road_data)
+    elif tile_budget is None:
+        sampler = open_sampler(cache_dir)
+    else:
+        sampler = open_tiled_sampler(cache_dir, budget = tile_budget)
+
+    ## Sampling from tiles the stations are read from the tiles, as in route_process
+    chg_index = TiledChargers(sampler.store) if hasattr(sampler, 'store') else ChargerIndex(evc_data)
+
+    _worker.update({
+        'evc_data': evc_data,
+        'route_dist': route_dist,
+        'fuel_dist': fuel_dist,
+        'crs': crs,
+        'sampler': sampler,
+        'candidates': CandidateGenerator(sampler, route_dist, crs, max_dist = max_dist, weighted = weighted),
+        'chg_index': chg_index,
+        'synced': 0,
+        'chargers': chargers,
+        'backend': None if backend_factory is None else backend_factory()
+    })
+
+## Add the merged chargers this process has not seen yet, up to the first `known`:
+## from the shared table, or from the per epoch files in merged_dir
+def _sync(known, merged_dir):
+    import pickle
+    from pathlib import Path
+
+    w = _worker
+    if known <= w['synced']:
+        return
+    if w['chargers'] is not None:
+        n_base = w['chargers'].n_base
+        w['chg_index'].insert(w['chargers'].frame(n_base + w['synced'], n_base + known))
+    else:
+        for path in sorted(Path(merged_dir).glob("added_*.pkl")):
+            if w['synced'] <= int(path.stem.split("_")[1]) < known:
+                with open(path, 'rb') as f:
+                    w['chg_index'].insert(pickle.load(f))
+    w['synced'] = known
+
+## Simulate n_trips accepted trips, returning their results, new charger rows and
+## the error that stopped the block, if any
+def _run_block(task):
+    from numpy.random import default_rng, SeedSequence
+
+    entropy, epoch, worker, n_trips, known, merged_dir = task
+    w = _worker
+    random_state = default_rng(SeedSequence(entropy, spawn_key = (epoch, worker)))
+
+    _sync(known, merged_dir)
+    chg_index = w['chg_index']
+    n_merged = len(chg_index)
+
+    res = []
+    outcomes = []
+    error = None
+    k = 0
+
+    while k < n_trips:
+        try:
+            pair = w['candidates'].propose(rng = random_state)
+            if pair is None:
+                continue
+            route = evc.route_pair(pair, w['candidates'], w['crs'], backend = w['backend'])
+            if route is None:
+                continue
+            k += 1
+            if hasattr(chg_index, 'focus'):
+                chg_index.focus(route.lon, route.lat, w['crs'])
+            outcome = evc.run_trip(route, pair[0], pair[1], w['evc_data'], w['route_dist'], w['fuel_dist'], w['crs'], chg_index,
+                                   backend = w['backend'], random_state = random_state)
+        except Exception as e:
+            error = repr(e)
+            break
+
+        res.append(0 if outcome is None else 1)
+        if outcome is not None:
+            outcomes.append(outcome)
+
+    chg_index.truncate(n_merged)
+    return res, outcomes, error
+
+def parallel_route_process(road_data, evc_data, route_dist, fuel_dist, crs, pre_built, n_sim = 1, n_workers = None,
+                           sync_every = 50, seed = None, weighted = False, max_dist = None, backend_factory = None, cache_dir = None,
+                           tile_budget = None, shared = False):
+    from datetime import date
+    from multiprocessing import get_context, cpu_count
+    from numpy.random import SeedSequence
+    from tempfile import TemporaryDirectory
+    import pickle
+    import pandas as pd
+
+    n_workers = cpu_count() if n_workers is None else n_workers
+    entropy = SeedSequence(seed).entropy
+    today = date.today()
+
+    ## Spawned workers receive the road and charger data once, through the initializer.
+    ## With a prepared cache_dir they memory map the road vertices instead, and
+    ## road_data can be None unless the backend factory needs it. With a tile_budget
+    ## (bytes) they open road tiles on demand and keep at most that much loaded.
+    ## The tiles are built here, before the workers start, and the stations are read
+    ## from them as in route_process, so evc_data must then be None.
+    ##
+    ## With shared the road vertex arrays and the chargers are published once into
+    ## shared memory and workers attach to them by name, so neither GeoDataFrame is
+    ## pickled to the workers (road_data is then only read here, to build the arrays
+    ## when there is no cache_dir). Chargers merged after each epoch are appended to
+    ## the shared table and each task only carries the row count to read up to.
+    ## Otherwise each epoch's merged chargers are written once to a file in a
+    ## temporary directory, which workers read the epochs they have not seen from.
+    ctx = get_context("spawn")
+    tiled = (cache_dir is not None) and (tile_budget is not None) and not shared
+    if tiled:
+        from ev_tiles import build_tiles
+        if evc_data is not None:
+            raise ValueError("Stations are read from the tiles when sampling from tiles, pass evc_data = None")
+        build_tiles(cache_dir)
+
+    roads = chargers = None
+    if shared:
+        from ev_prepare import read_manifest
+        from ev_shared import SharedChargers, share_roads
+
+        road_crs = road_data.crs if cache_dir is None else read_manifest(cache_dir)['proj']
+        roads = share_roads(road_data, cache_dir)
+        chargers = SharedChargers.publish(evc_data, capacity = n_sim)
+        init_args = (None, None, route_dist, fuel_dist, crs, weighted, max_dist, backend_factory, None, None, (roads.handle, road_crs, chargers.handle))
+    else:
+        init_args = (road_data, evc_data, route_dist, fuel_dist, crs, weighted, max_dist, backend_factory, cache_dir, tile_budget)
+
+    merged_dir = None if shared else TemporaryDirectory()
+    try:
+        res, added = _run_epochs(ctx, init_args, n_sim, n_workers, sync_every, entropy, chargers, None if shared else merged_dir.name)
+    finally:
+        if shared:
+            roads.close()
+            chargers.close()
+        else:
+            merged_dir.cleanup()
+
+    if tiled:
+        from ev_tiles import TiledChargers, open_tiled_sampler
+        chg_index = TiledChargers(open_tiled_sampler(cache_dir, budget = tile_budget).store)
+        if added is not None:
+            chg_index.insert(added)
+        evc_data = chg_index.data
+    elif added is not None:
+        evc_data = pd.concat([evc_data, added]).reset_index(drop = True)
+
+    file_name = 'outcomes_' + today.strftime("%d_%m_%Y") + ".pkl"
+
+    ## Save outcomes to file in the same format as route_process
+    print("Simulations completed. Creating pickle!")
+
+    with open(file_name, 'wb') as f:
+        pickle.dump([evc_data, res], f)
+
+    return res
+
+## Run epochs of blocks until n_sim trips are done, returning the results and added chargers
+def _run_epochs(ctx, init_args, n_sim, n_workers, sync_every, entropy, chargers, merged_dir):
+    import pickle
+    from pathlib import Path
+    import pandas as pd
+
+    res = []
+    added = None
+    k = 0
+    epoch = 0
+
+    with ctx.Pool(n_workers, initializer = _init_worker, initargs = init_args) as pool:
+        while k < n_sim:
+
+            ## Split this epoch's trips evenly over the workers
+            n_epoch = min(n_sim - k, n_workers * sync_every)
+            sizes = [n_epoch // n_workers + (i < n_epoch % n_workers) for i in range(n_workers)]
+            known = 0 if added is None else len(added)
+            tasks = [(entropy, epoch, i, n, known, merged_dir) for i, n in enumerate(sizes) if n > 0]
+
+            error = None
+            for block_res, block_outcomes, block_error in pool.map(_run_block, tasks):
+                res.extend(block_res)
+                k += len(block_res)
+                if block_outcomes:
+                    new = pd.concat(block_outcomes).reset_index(drop = True)
+                    added = new if added is None else pd.concat([added, new]).reset_index(drop = True)
+                error = error or block_error
+
+            ## Publish this epoch's chargers for the next one
+            if (added is not None) and (len(added) > known):
+                if chargers is not None:
+                    chargers.append(added.iloc[known:])
+                else:
+                    with open(Path(merged_dir) / "added_{:09d}.pkl".format(known), 'wb') as f:
+                        pickle.dump(added.iloc[known:].reset_index(drop = True), f)
+
+            epoch += 1
+            print("Epoch", epoch, "completed:", k, "simulations,", 0 if added is None else len(added), "chargers added")
+
+            if error is not None:
+                print("Worker failed:", error)
+                break
+
+    return res, added
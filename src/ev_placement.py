@@ -0,0 +1,173 @@
+import numpy as np
+
+from ev_transform import PROJ, transform
+
+FAIL_TYPES = ("Chargers out of range", "Chargers unavailable")
+
+## Offset keeping cell coordinates positive when packed into one int64 key
+_OFFSET = 1 << 30
+
+## Column sums of values grouped by group id
+def _group_sum(group, values, n):
+    return np.column_stack([np.bincount(group, weights = values[:, j], minlength = n) for j in range(values.shape[1])]).reshape(n, values.shape[1])
+
+## Failure points of an outcome or charger table as (lon, lat, fal_typ) arrays:
+## fleet and event outcomes (lon / lat columns), logged charger rows (lon / lat),
+## simulate_trip outcomes and charger frames (point geometry, in a GeoDataFrame or
+## a plain DataFrame). Only failed trips (outcome 1) and rows with a failure type
+## are kept, so placed or recommended chargers in a charger table are not counted.
+def failure_points(frame):
+    if 'outcome' in frame:
+        frame = frame[frame['outcome'] == 1]
+    if 'fal_typ' in frame:
+        frame = frame[frame['fal_typ'].isin(FAIL_TYPES)]
+    fal_typ = frame['fal_typ'].values if 'fal_typ' in frame else None
+    if ('lon' in frame) and ('lat' in frame):
+        return frame['lon'].values.astype(float), frame['lat'].values.astype(float), fal_typ
+    if 'geometry' in frame:
+        return np.array([p.x for p in frame['geometry']], dtype = float), np.array([p.y for p in frame['geometry']], dtype = float), fal_typ
+    raise ValueError("Table has no failure locations (lon / lat columns or point geometry), read them with OutcomeLog.failures")
+
+## Failure grid ----
+## Failure points are binned into square cells of side eps metres (projected) as
+## they stream in, keeping per cell only the point count, coordinate sums and a
+## count per failure type. Memory grows with the number of occupied cells, not the
+## number of points, so millions of failures fit in a few arrays.
+class FailureGrid:
+
+    def __init__(self, eps = 5000, crs = "EPSG:4326"):
+        self.eps = eps
+        self.crs = crs
+        self.keys = np.empty(0, dtype = np.int64)
+        self.stats = np.empty((0, 3 + len(FAIL_TYPES)))
+        self.n_points = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    ## Add a chunk of failure points given in the grid CRS
+    def add(self, lon, lat, fal_typ = None):
+        x, y = transform(np.asarray(lon, dtype = float), np.asarray(lat, dtype = float), self.crs, PROJ)
+        if not len(x):
+            return
+        ix = np.floor(x / self.eps).astype(np.int64) + _OFFSET
+        iy = np.floor(y / self.eps).astype(np.int64) + _OFFSET
+
+        ## Count, x sum, y sum, then one count column per failure type
+        stats = np.zeros((len(x), 3 + len(FAIL_TYPES)))
+        stats[:, 0] = 1
+        stats[:, 1] = x
+        stats[:, 2] = y
+        if fal_typ is not None:
+            fal_typ = np.asarray(fal_typ, dtype = object)
+            for i, name in enumerate(FAIL_TYPES):
+                stats[:, 3 + i] = fal_typ == name
+
+        self._merge((ix << 32) | iy, stats)
+        self.n_points += len(x)
+
+    ## Failure rows of an outcome or charger table (see failure_points)
+    def add_frame(self, frame):
+        self.add(*failure_points(frame))
+
+    def _merge(self, keys, stats):
+        keys = np.concatenate([self.keys, keys])
+        stats = np.concatenate([self.stats, stats])
+        self.keys, inverse = np.unique(keys, return_inverse = True)
+        self.stats = _group_sum(inverse.reshape(-1), stats, len(self.keys))
+
+    ## Row of each key in keys, or -1 where the cell is empty
+    def lookup(self, keys):
+        if not len(self.keys):
+            return np.full(len(keys), -1)
+        pos = np.searchsorted(self.keys, keys)
+        pos = np.minimum(pos, len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, pos, -1)
+
+    ## Rows of the 8 neighbours of every occupied cell (-1 where empty), as (n_cells, 8)
+    def neighbours(self):
+        offsets = [(dx << 32) + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (dx, dy) != (0, 0)]
+        return np.column_stack([self.lookup(self.keys + o) for o in offsets])
+
+## Grid DBSCAN ----
+## DBSCAN run on cells instead of points: a cell is core when its own points plus
+## those of its 8 neighbours number at least min_pts (the neighbourhood of any point
+## is then covered by a 3 x 3 block of cells of side eps), core cells that touch are
+## joined into one cluster, and a non core cell touching a core cell joins the
+## cluster of its busiest core neighbour. Cells touching no core cell are noise.
+## Each cluster becomes a candidate site at the mean of its failure points,
+## weighted by its failure count (its demand), and sites are ranked by demand.
+def cluster_sites(grid, min_pts = 5):
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from geopandas import GeoDataFrame, points_from_xy
+
+    count = grid.stats[:, 0]
+    nbr = grid.neighbours()
+    near = count + np.where(nbr >= 0, count[np.maximum(nbr, 0)], 0).sum(axis = 1)
+    core = near >= min_pts
+
+    ## Clusters of touching core cells
+    rows, cols = np.nonzero((nbr >= 0) & core[:, None] & core[np.maximum(nbr, 0)])
+    n = len(count)
+    adj = coo_matrix((np.ones(len(rows)), (rows, nbr[rows, cols])), shape = (n, n))
+    _, label = connected_components(adj, directed = False)
+    label = np.where(core, label, -1)
+
+    ## Border cells take the label of their busiest core neighbour
+    nbr_core = np.where((nbr >= 0) & core[np.maximum(nbr, 0)], count[np.maximum(nbr, 0)], -1)
+    best = nbr_core.argmax(axis = 1)
+    border = ~core & (nbr_core.max(axis = 1) >= 0)
+    label[border] = label[nbr[border, best[border]]]
+
+    ## Renumber clusters and sum their cell statistics
+    keep = label >= 0
+    clusters, cluster = np.unique(label[keep], return_inverse = True)
+    sums = _group_sum(cluster.reshape(-1), grid.stats[keep], len(clusters))
+    cells = np.bincount(cluster.reshape(-1), minlength = len(clusters))
+
+    demand = sums[:, 0]
+    lon, lat = transform(sums[:, 1] / np.maximum(demand, 1), sums[:, 2] / np.maximum(demand, 1), PROJ, grid.crs)
+    order = np.argsort(-demand, kind = "stable")
+
+    sites = {
+        'rank': np.arange(1, len(order) + 1),
+        'demand': demand[order].astype(np.int64),
+        'share': demand[order] / max(grid.n_points, 1),
+        'cells': cells[order]
+    }
+    for i, name in enumerate(FAIL_TYPES):
+        sites[name.lower().replace(" ", "_")] = sums[order, 3 + i].astype(np.int64)
+    sites['geometry'] = points_from_xy(np.atleast_1d(lon)[order], np.atleast_1d(lat)[order])
+
+    return GeoDataFrame(sites, crs = grid.crs)
+
+## Ranked sites from an OutcomeLog directory, an outcome / charger table, or an
+## iterable of (lon, lat, fal_typ) chunks, read a chunk at a time
+def recommend_sites(source, eps = 5000, min_pts = 5, crs = "EPSG:4326", chunk_size = 65536):
+    from pathlib import Path
+
+    grid = FailureGrid(eps, crs)
+    if isinstance(source, (str, Path)):
+        from ev_log import OutcomeLog
+        source = OutcomeLog(source).failures(chunk_size)
+    elif hasattr(source, 'columns'):
+        grid.add_frame(source)
+        source = []
+
+    for lon, lat, fal_typ in source:
+        grid.add(lon, lat, fal_typ)
+
+    return cluster_sites(grid, min_pts)
+
+## Top n sites as rows in the evc_data schema, to place them for another run
+def sites_as_chargers(sites, n = None, nm_chrg = 4):
+    from geopandas import GeoDataFrame
+
+    top = sites.iloc[:n]
+    return GeoDataFrame({
+        "fll_ddr": None,
+        "nm_chrg": nm_chrg,
+        "fal_typ": "Recommended site",
+        "geometry": top['geometry'].values
+    }, crs = sites.crs)
@@ -0,0 +1,116 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+## Dataset cache ----
+## Reading and reprojecting all_roads.shp and alt_fuel_stations.shp takes minutes,
+## so prepare() does it once and writes both layers in both CRSs as GeoParquet,
+## plus the projected road vertices and station coordinates as .npy arrays that
+## open memory mapped in milliseconds (VertexSampler.from_arrays takes them
+## directly). The cache is keyed on the size and mtime of every source file and
+## rebuilt when any of them change.
+
+## Shapefile sidecars that change the layer when they change
+SIDECARS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+def fingerprint(*paths):
+    out = {}
+    for path in paths:
+        for part in sorted(Path(path).parent.glob(Path(path).stem + ".*")):
+            if part.suffix.lower() in SIDECARS:
+                stat = part.stat()
+                out[str(part.resolve())] = [stat.st_size, stat.st_mtime_ns]
+    return out
+
+## Object columns (strings read from a shapefile) as fixed width strings, which
+## .npy files and shared memory hold without pickling
+def plain_array(values):
+    values = np.asarray(values)
+    return values.astype(str) if values.dtype.hasobject else values
+
+## Flattened road vertices in the layout VertexSampler uses
+def road_arrays(roads):
+    from ev_sampler import line_coords
+
+    coords = [line_coords(geom) for geom in roads['geometry']]
+    xy = np.concatenate(coords) if len(coords) else np.empty((0, 2))
+    return {
+        'road_x': np.ascontiguousarray(xy[:, 0]),
+        'road_y': np.ascontiguousarray(xy[:, 1]),
+        'road_offsets': np.concatenate([[0], np.cumsum([len(c) for c in coords])]).astype(np.int64),
+        'road_record': plain_array(roads['record'].values),
+        'road_level': roads['level'].values,
+        'road_length': roads['geometry'].length.values
+    }
+
+def prepare(roads_path, stations_path, cache_dir, crs = "GCS_WGS84", proj = "EPSG:32613", force = False):
+    from geopandas import read_file
+
+    cache_dir = Path(cache_dir)
+    manifest_path = cache_dir / "manifest.json"
+    sources = fingerprint(roads_path, stations_path)
+    manifest = {'sources': sources, 'crs': crs, 'proj': proj}
+
+    if (not force) and manifest_path.exists():
+        if json.loads(manifest_path.read_text()) == manifest:
+            return cache_dir
+
+    cache_dir.mkdir(parents = True, exist_ok = True)
+    print("Preparing dataset cache in", cache_dir)
+
+    roads = read_file(roads_path).to_crs(crs)
+    roads_proj = roads.to_crs(proj)
+    roads.to_parquet(cache_dir / "roads.parquet")
+    roads_proj.to_parquet(cache_dir / "roads_proj.parquet")
+
+    chgs = read_file(stations_path).to_crs(crs)
+    chgs_proj = chgs.to_crs(proj)
+    chgs.to_parquet(cache_dir / "stations.parquet")
+    chgs_proj.to_parquet(cache_dir / "stations_proj.parquet")
+
+    arrays = road_arrays(roads_proj)
+    arrays.update({
+        'station_x': chgs_proj['geometry'].x.values,
+        'station_y': chgs_proj['geometry'].y.values,
+        'station_lon': chgs['geometry'].x.values,
+        'station_lat': chgs['geometry'].y.values,
+        'station_nm_chrg': chgs['nm_chrg'].values
+    })
+    for name, values in arrays.items():
+        np.save(cache_dir / (name + ".npy"), plain_array(values))
+
+    ## Manifest last, so an interrupted prepare is redone next time
+    manifest_path.write_text(json.dumps(manifest, indent = 1))
+    return cache_dir
+
+## Manifest written by prepare(): source fingerprints and the CRSs the layers are
+## cached in ('crs' for longitude / latitude, 'proj' for the projected copies)
+def read_manifest(cache_dir):
+    return json.loads((Path(cache_dir) / "manifest.json").read_text())
+
+## Memory mapped arrays written by prepare()
+def open_arrays(cache_dir):
+    return {p.stem: np.load(p, mmap_mode = 'r', allow_pickle = False) for p in Path(cache_dir).glob("*.npy")}
+
+## Vertex sampler over the cached projected roads, without reading any geometry
+def open_sampler(cache_dir, rng = None):
+    from ev_sampler import VertexSampler
+
+    arrays = open_arrays(cache_dir)
+    manifest = read_manifest(cache_dir)
+    return VertexSampler.from_arrays(
+        arrays['road_x'], arrays['road_y'], arrays['road_offsets'],
+        arrays['road_record'], arrays['road_level'], arrays['road_length'],
+        manifest['proj'], rng = rng
+    )
+
+## One cached GeoDataFrame: roads, roads_proj, stations or stations_proj
+def load_layer(cache_dir, name):
+    from geopandas import read_parquet
+
+    return read_parquet(Path(cache_dir) / (name + ".parquet"))
+
+## Every cached GeoDataFrame, as (roads, roads_proj, stations, stations_proj)
+def load_layers(cache_dir):
+    return tuple(load_layer(cache_dir, name) for name in ("roads", "roads_proj", "stations", "stations_proj"))
@@ -1,14 +1,15 @@
 import ev_functions as evc
-from geopandas import read_file
-from geopandas import GeoDataFrame
+from ev_prepare import prepare, load_layer, open_sampler, read_manifest
 
-all_roads = read_file('C:/Users/jason/Downloads/Datasets/ev_geospatial/all_roads.shp').to_crs('GCS_WGS84')
-all_roads_proj = all_roads.to_crs("EPSG:32613")
+roads_path = 'C:/Users/jason/Downloads/Datasets/ev_geospatial/all_roads.shp'
+# chgs_path = '/home/jcarey9/ev_chargers/data/alt_fuel_stations.shp'
+chgs_path = 'C:/Users/jason/Downloads/Datasets/ev_geospatial/alt_fuel_stations.shp'
 
-## Read in chgs shape file
-# chgs = gpd.read_file('/home/jcarey9/ev_chargers/data/alt_fuel_stations.shp').to_crs("GCS_WGS84")
-chgs = read_file('C:/Users/jason/Downloads/Datasets/ev_geospatial/alt_fuel_stations.shp').to_crs('GCS_WGS84')
-chgs_proj = chgs.to_crs("EPSG:32613")
+## Read and reproject both layers once, later runs open the cached copies. Only
+## the charger layer is read as geometry, the roads are only needed as the
+## memory mapped vertex arrays the sampler draws from
+cache_dir = prepare(roads_path, chgs_path, 'C:/Users/jason/Downloads/Datasets/ev_geospatial/cache')
+chgs = load_layer(cache_dir, 'stations')
 
 pre_built = len(chgs)
 
@@ -18,7 +19,11 @@ fuel_dist = route_dist * .25
 n = 10000
 
 ## Get the CRS for future calculations between geometries
-wgs = all_roads.crs
-epsg = all_roads_proj.crs
+manifest = read_manifest(cache_dir)
+wgs = manifest['crs']
+epsg = manifest['proj']
 
-sim_outcomes = evc.route_process(all_roads_proj, chgs, route_dist, fuel_dist, wgs, pre_built, n_sim = n)
\ No newline at end of file
+## Start and end points are drawn from the cached vertex arrays, memory mapped
+sampler = open_sampler(cache_dir)
+
+sim_outcomes = evc.route_process(None, chgs, route_dist, fuel_dist, wgs, pre_built, n_sim = n, sampler = sampler)
@@ -0,0 +1,280 @@
+import json
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from ev_transform import WGS84, transform
+
+TILE = 256
+
+## Layers kept by a TrafficGrid: routes count the trips crossing each pixel, and
+## failures the failure points in it
+LAYERS = ("routes", "failures")
+
+## Colour ramps as (position, r, g, b, a) stops over counts scaled to [0, 1]
+RAMPS = {
+    "routes": [(0.0, 255, 255, 178, 90), (0.35, 254, 204, 92, 170), (0.7, 240, 59, 32, 220), (1.0, 128, 0, 38, 255)],
+    "failures": [(0.0, 158, 202, 225, 200), (0.5, 49, 130, 189, 235), (1.0, 8, 48, 107, 255)]
+}
+
+## Global web mercator pixel coordinates of lon / lat at zoom z
+def mercator_pixels(lon, lat, z):
+    lat = np.clip(np.asarray(lat, dtype = float), -85.0511, 85.0511)
+    size = TILE * 2 ** z
+    x = (np.asarray(lon, dtype = float) + 180) / 360 * size
+    y = (1 - np.log(np.tan(np.radians(lat)) + 1 / np.cos(np.radians(lat))) / np.pi) / 2 * size
+    return x, y
+
+## Lon / lat of global pixel coordinates at zoom z
+def mercator_lonlat(x, y, z):
+    size = TILE * 2 ** z
+    lon = np.asarray(x, dtype = float) / size * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype = float) / size))))
+    return lon, lat
+
+## RGBA image as PNG bytes (8 bit, no filtering)
+def png_bytes(rgba):
+    h, w, _ = rgba.shape
+    raw = np.concatenate([np.zeros((h, 1), dtype = np.uint8), rgba.reshape(h, w * 4)], axis = 1).tobytes()
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(raw, 6)),
+        chunk(b"IEND", b"")
+    ])
+
+## Counts coloured on a log scale against vmax, empty pixels transparent
+def colourise(counts, vmax, ramp):
+    stops = np.asarray(ramp, dtype = float)
+    scaled = np.log1p(counts) / np.log1p(max(vmax, 1))
+    rgba = np.stack([np.interp(scaled, stops[:, 0], stops[:, i]) for i in range(1, 5)], axis = -1)
+    rgba[counts == 0] = 0
+    return np.round(rgba).astype(np.uint8)
+
+## Traffic grid ----
+## Route traversals and failure points binned into web mercator pixels at
+## max_zoom, held as sparse 256 x 256 tiles (only tiles something touched exist).
+## A route is rasterised by stepping along each segment at most a pixel at a time
+## and counts once in every pixel it crosses, so pixel values are numbers of
+## trips whatever the vertex density of the route. Memory depends on the area
+## covered, not on the number of routes or vertices.
+class TrafficGrid:
+
+    def __init__(self, max_zoom = 10, crs = WGS84):
+        self.max_zoom = max_zoom
+        self.crs = crs
+        self.tiles = {layer: {} for layer in LAYERS}
+        self.n_routes = 0
+        self.n_failures = 0
+
+    def _lonlat(self, x, y):
+        x, y = np.asarray(x, dtype = float), np.asarray(y, dtype = float)
+        if self.crs == WGS84:
+            return x, y
+        return transform(x, y, self.crs, WGS84)
+
+    ## Add one to every pixel at global pixel indices ix, iy of a layer
+    def _add(self, layer, ix, iy):
+        tiles = self.tiles[layer]
+        tile_id = (ix >> 8) * (1 << 32) + (iy >> 8)
+        order = np.argsort(tile_id, kind = "stable")
+        tile_id, ix, iy = tile_id[order], ix[order], iy[order]
+        keys, starts = np.unique(tile_id, return_index = True)
+        for key, a, b in zip(keys, starts, np.append(starts[1:], len(tile_id))):
+            key = (int(key >> 32), int(key & 0xffffffff))
+            if key not in tiles:
+                tiles[key] = np.zeros((TILE, TILE), dtype = np.uint32)
+            np.add.at(tiles[key], (iy[a:b] & 0xff, ix[a:b] & 0xff), 1)
+
+    ## Rasterise a route given as vertex coordinates in the grid CRS
+    def add_route(self, x, y):
+        px, py = mercator_pixels(*self._lonlat(x, y), self.max_zoom)
+        if not len(px):
+            return
+        dx, dy = np.diff(px), np.diff(py)
+        steps = np.maximum(np.ceil(np.hypot(dx, dy)), 1).astype(np.int64)
+        seg = np.repeat(np.arange(len(dx)), steps)
+        t = (np.arange(len(seg)) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+        sx = np.append(px[seg] + t * dx[seg], px[-1])
+        sy = np.append(py[seg] + t * dy[seg], py[-1])
+
+        ## Each pixel once per route
+        pixels = np.unique(np.floor(sx).astype(np.int64) * (1 << 32) + np.floor(sy).astype(np.int64))
+        self._add("routes", pixels >> 32, pixels & 0xffffffff)
+        self.n_routes += 1
+
+    ## Add failure points given in the grid CRS
+    def add_failures(self, x, y):
+        px, py = mercator_pixels(*self._lonlat(x, y), self.max_zoom)
+        if not len(px):
+            return
+        self._add("failures", np.floor(px).astype(np.int64), np.floor(py).astype(np.int64))
+        self.n_failures += len(px)
+
+    ## Failure rows of an outcome or charger table (see ev_placement.failure_points)
+    def add_frame(self, frame):
+        from ev_placement import failure_points
+
+        lon, lat, _ = failure_points(frame)
+        self.add_failures(lon, lat)
+
+    ## Failure points of the completed trips in an OutcomeLog directory
+    def add_log(self, log_dir, chunk_size = 65536):
+        from ev_log import OutcomeLog
+
+        for lon, lat, _ in OutcomeLog(log_dir).failures(chunk_size):
+            self.add_failures(lon, lat)
+
+    ## Sparse tiles to and from one .npz, so grids from several runs can be merged
+    def save(self, path):
+        arrays = {'meta': np.array([self.max_zoom, self.n_routes, self.n_failures])}
+        for layer, tiles in self.tiles.items():
+            keys = sorted(tiles)
+            arrays[layer + '_keys'] = np.array(keys, dtype = np.int64).reshape(-1, 2)
+            arrays[layer + '_tiles'] = np.stack([tiles[k] for k in keys]) if keys else np.zeros((0, TILE, TILE), dtype = np.uint32)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path, crs = WGS84):
+        with np.load(path) as f:
+            max_zoom, n_routes, n_failures = (int(v) for v in f['meta'])
+            grid = cls(max_zoom, crs)
+            grid.n_routes, grid.n_failures = n_routes, n_failures
+            for layer in LAYERS:
+                grid.tiles[layer] = {(int(kx), int(ky)): t for (kx, ky), t in zip(f[layer + '_keys'], f[layer + '_tiles'])}
+        return grid
+
+    def merge(self, other):
+        if other.max_zoom != self.max_zoom:
+            raise ValueError("Grids have different zooms")
+        for layer in LAYERS:
+            for key, tile in other.tiles[layer].items():
+                if key in self.tiles[layer]:
+                    self.tiles[layer][key] = self.tiles[layer][key] + tile
+                else:
+                    self.tiles[layer][key] = tile.copy()
+        self.n_routes += other.n_routes
+        self.n_failures += other.n_failures
+
+## Tiles of the next zoom out: each 2 x 2 block of pixels becomes one, taking the
+## busiest pixel for routes (trips through the area, not pixels crossed) and the
+## total for failures
+def _zoom_out(tiles, layer):
+    parents = {}
+    for (tx, ty), tile in tiles.items():
+        block = tile.reshape(TILE // 2, 2, TILE // 2, 2)
+        half = block.max(axis = (1, 3)) if layer == "routes" else block.sum(axis = (1, 3), dtype = np.uint32)
+        key = (tx >> 1, ty >> 1)
+        if key not in parents:
+            parents[key] = np.zeros((TILE, TILE), dtype = np.uint32)
+        oy, ox = (ty & 1) * (TILE // 2), (tx & 1) * (TILE // 2)
+        parents[key][oy:oy + TILE // 2, ox:ox + TILE // 2] = half
+    return parents
+
+## Tile pyramid ----
+## Writes out_dir/<layer>/<z>/<x>/<y>.png for every zoom from the grid's max_zoom
+## down to min_zoom (standard XYZ tiles, so any web map can show them), coloured
+## on a log scale against the busiest pixel at each zoom. Only tiles with data are
+## written. meta.json records the zooms, bounds and counts, and index.html is a
+## Leaflet viewer over them that fetches only the tiles in view.
+##
+## The viewer loads Leaflet from `leaflet`, a URL (unpkg by default, so viewing
+## needs the network) or a local directory holding leaflet.js and leaflet.css,
+## which are copied next to the pyramid so it can be viewed offline. The overlays
+## are drawn on a blank map unless base_tiles gives an XYZ URL template for a
+## base layer (with its attribution). Public servers such as OpenStreetMap's have
+## usage policies that rule out bulk use, so none is used by default.
+LEAFLET_URL = "https://unpkg.com/leaflet@1.9.4/dist"
+
+def write_pyramid(grid, out_dir, min_zoom = 4, leaflet = LEAFLET_URL, base_tiles = None, base_attribution = ""):
+    import shutil
+
+    out_dir = Path(out_dir)
+    meta = {'min_zoom': min_zoom, 'max_zoom': grid.max_zoom, 'routes': grid.n_routes, 'failures': grid.n_failures, 'layers': {}}
+
+    for layer in LAYERS:
+        tiles = grid.tiles[layer]
+        vmax = {}
+        bounds = None
+        for z in range(grid.max_zoom, min_zoom - 1, -1):
+            if z < grid.max_zoom:
+                tiles = _zoom_out(tiles, layer)
+            if not tiles:
+                break
+            vmax[z] = int(max(int(t.max()) for t in tiles.values()))
+            for (tx, ty), tile in tiles.items():
+                path = out_dir / layer / str(z) / str(tx) / "{}.png".format(ty)
+                path.parent.mkdir(parents = True, exist_ok = True)
+                path.write_bytes(png_bytes(colourise(tile, vmax[z], RAMPS[layer])))
+            if z == grid.max_zoom:
+                keys = np.array(list(tiles))
+                lon0, lat0 = mercator_lonlat(keys[:, 0].min() * TILE, (keys[:, 1].max() + 1) * TILE, z)
+                lon1, lat1 = mercator_lonlat((keys[:, 0].max() + 1) * TILE, keys[:, 1].min() * TILE, z)
+                bounds = [[float(lat0), float(lon0)], [float(lat1), float(lon1)]]
+        meta['layers'][layer] = {'max_count': {str(z): v for z, v in vmax.items()}, 'bounds': bounds}
+
+    out_dir.mkdir(parents = True, exist_ok = True)
+    if Path(leaflet).is_dir():
+        (out_dir / "leaflet").mkdir(exist_ok = True)
+        for name in ("leaflet.js", "leaflet.css"):
+            shutil.copyfile(Path(leaflet) / name, out_dir / "leaflet" / name)
+        leaflet = "leaflet"
+    base = None if base_tiles is None else {'url': base_tiles, 'attribution': base_attribution}
+
+    (out_dir / "meta.json").write_text(json.dumps(meta, indent = 1))
+    viewer = VIEWER.replace("__LEAFLET__", leaflet.rstrip("/")).replace("__BASE__", json.dumps(base))
+    (out_dir / "index.html").write_text(viewer.replace("__META__", json.dumps(meta)))
+    return out_dir
+
+VIEWER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>EVCS simulated routes and failures</title>
+<link rel="stylesheet" href="__LEAFLET__/leaflet.css">
+<script src="__LEAFLET__/leaflet.js"></script>
+<style>
+html, body, #map { height: 100%; margin: 0; }
+.info { background: white; padding: 6px 8px; font: 13px sans-serif; border-radius: 4px; }
+</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var meta = __META__;
+var base = __BASE__;
+var blank = "data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7";
+var map = L.map("map");
+var bases = {};
+if (base) {
+  bases["Base map"] = L.tileLayer(base.url, {maxZoom: 18, attribution: base.attribution}).addTo(map);
+}
+var overlays = {};
+Object.keys(meta.layers).forEach(function (name) {
+  var layer = meta.layers[name];
+  if (!layer.bounds) { return; }
+  overlays[name] = L.tileLayer(name + "/{z}/{x}/{y}.png", {
+    minZoom: meta.min_zoom, maxNativeZoom: meta.max_zoom, maxZoom: 18,
+    bounds: layer.bounds, errorTileUrl: blank, opacity: 0.85
+  }).addTo(map);
+});
+L.control.layers(bases, overlays).addTo(map);
+var bounds = (meta.layers.routes.bounds || meta.layers.failures.bounds);
+if (bounds) { map.fitBounds(bounds); } else { map.setView([39, -105.5], 7); }
+var info = L.control({position: "bottomleft"});
+info.onAdd = function () {
+  var div = L.DomUtil.create("div", "info");
+  div.innerHTML = meta.routes + " routes, " + meta.failures + " failures";
+  return div;
+};
+info.addTo(map);
+</script>
+</body>
+</html>
+"""
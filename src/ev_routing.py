@@ -0,0 +1,502 @@
+import json
+import re
+from heapq import heappop, heappush
+from math import hypot, inf
+from time import perf_counter, sleep
+
+import numpy as np
+
+from ev_metrics import get_metrics
+
+## Routing backends ----
+## A backend answers route(pickup_lon, pickup_lat, dropoff_lon, dropoff_lat) with
+## a dict of lon/lat 'coords' (pairs or an (n, 2) array), per segment 'distances'
+## (metres, a sequence or array), snapped 'start'
+## and 'end' locations and the total 'distance', or None when no route is found.
+## calculate_route turns that into the route dict used by the simulation.
+
+OSRM_URL = "http://router.project-osrm.org/route/v1/driving/"
+## Only the distance annotation is read, so only it is requested
+OSRM_QUERY = "?overview=full&annotations=distance"
+
+## Coordinate part of an OSRM route request
+def osrm_loc(pickup_lon, pickup_lat, dropoff_lon, dropoff_lat):
+    return "{},{};{},{}".format(pickup_lon, pickup_lat, dropoff_lon, dropoff_lat)
+
+## Encoded polyline as an (n, 2) float64 array of lon, lat. Each value is a run of
+## 5 bit chunks (offset by 63, every chunk but the last with bit 0x20 set) holding
+## the zigzag encoded change from the previous vertex, lat before lon. The chunks
+## of every value are summed at once with reduceat and the changes accumulated
+## with cumsum, giving the same floats as polyline.decode.
+def decode_polyline(expression, precision = 5):
+    chunks = np.frombuffer(expression.encode("ascii"), dtype = np.uint8).astype(np.int64) - 63
+    ends = np.flatnonzero(chunks < 0x20)
+    coords = np.empty((len(ends) // 2, 2))
+    if not len(coords):
+        return coords
+
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shift = 5 * (np.arange(len(chunks)) - np.repeat(starts, ends - starts + 1))
+    values = np.add.reduceat((chunks & 0x1f) << shift, starts)[:2 * len(coords)]
+    values = (values >> 1) ^ -(values & 1)
+
+    factor = float(10 ** precision)
+    np.divide(np.cumsum(values[1::2]), factor, out = coords[:, 0])
+    np.divide(np.cumsum(values[0::2]), factor, out = coords[:, 1])
+    return coords
+
+## Backend result from a parsed OSRM route response, with the distance annotation
+## as an array when it has already been read
+def parse_osrm(res, distances = None):
+    route = res['routes'][0]
+    if distances is None:
+        distances = np.asarray(route['legs'][0]['annotation']['distance'], dtype = float)
+
+    return {
+        'coords': decode_polyline(route['geometry']),
+        'distances': distances,
+        'start': tuple(res['waypoints'][0]['location']),
+        'end': tuple(res['waypoints'][1]['location']),
+        'distance': route['distance']
+    }
+
+## Start of the first leg's distance annotation array in a response body
+_ANNOTATION = re.compile(r'"annotation"\s*:\s*\{[^{}]*?"distance"\s*:\s*\[')
+
+## Backend result from an OSRM response body. The distance annotation, one number
+## per route segment, is cut out of the text and parsed straight into an array, so
+## json only builds the small remainder of the response.
+def parse_osrm_text(text):
+    found = _ANNOTATION.search(text)
+    if found is None:
+        return parse_osrm(json.loads(text))
+
+    start = found.end()
+    end = text.index("]", start)
+    body = text[start:end].strip()
+    distances = np.fromstring(body, sep = ",") if body else np.empty(0)
+    return parse_osrm(json.loads(text[:start] + text[end:]), distances)
+
+## Shared OSRMBackend used when calculate_route is not given a backend
+_default_backend = None
+
+def default_backend():
+    global _default_backend
+    if _default_backend is None:
+        _default_backend = OSRMBackend()
+    return _default_backend
+
+## Public OSRM server (or any OSRM compatible endpoint) over HTTP
+class OSRMBackend:
+
+    ## Routes follow one way streets, so A to B cannot answer B to A
+    symmetric = False
+
+    def __init__(self, url = OSRM_URL, retries = 4):
+        import requests
+
+        self.url = url
+        self.retries = retries
+
+        ## One session so every request reuses the pooled connection
+        self.session = requests.Session()
+
+    def _get(self, loc):
+        metrics = get_metrics()
+        start = perf_counter()
+        r = self.session.get(self.url + loc + OSRM_QUERY)
+        metrics.observe('http_seconds', perf_counter() - start)
+        metrics.count('http_requests')
+        return r
+
+    def route(self, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat):
+        loc = osrm_loc(pickup_lon, pickup_lat, dropoff_lon, dropoff_lat)
+        r = self._get(loc)
+        if r.status_code != 200:
+            print("Request returned unsuccessful status code... Retrying...")
+            attempt = 1
+            while (r.status_code != 200) & (attempt < self.retries):
+                sleep(1)
+                attempt += 1
+                get_metrics().count('http_retries')
+                r = self._get(loc)
+            if (r.status_code != 200) & (attempt >= self.retries):
+                get_metrics().count('http_failures')
+                return None
+
+        return parse_osrm_text(r.text)
+
+## Offline router over the roads layer ----
+## Road vertices become graph nodes (vertices within snap_tol metres of each other
+## are merged so connecting roads share a node) and consecutive vertices become
+## undirected edges weighted by their projected length. Queries snap pickup and
+## dropoff to the nearest node and run A* with a straight line heuristic, which
+## is admissible because every edge weight is a straight line length.
+class LocalBackend:
+
+    symmetric = True
+
+    def __init__(self, road_data, crs = "EPSG:4326", snap_tol = 0.1):
+        from scipy.spatial import cKDTree
+        from ev_sampler import line_coords
+        from ev_transform import transformer
+
+        self._to_proj = transformer(crs, road_data.crs)
+        self._from_proj = transformer(road_data.crs, crs)
+
+        ## Stack every line part, remembering which consecutive vertices are joined
+        parts = []
+        for geom in road_data['geometry']:
+            if geom is None or geom.is_empty:
+                continue
+            for part in (geom.geoms if geom.geom_type == "MultiLineString" else [geom]):
+                parts.append(line_coords(part))
+        xy = np.concatenate(parts)
+        joined = np.ones(len(xy), dtype = bool)
+        joined[np.cumsum([len(p) for p in parts])[:-1]] = False
+        joined[0] = False
+
+        ## Merge coincident vertices into shared nodes
+        keys = np.round(xy / snap_tol).astype(np.int64)
+        keys, first, node = np.unique(keys, axis = 0, return_index = True, return_inverse = True)
+        node = node.reshape(-1)
+        self.x = xy[first, 0]
+        self.y = xy[first, 1]
+
+        ## Undirected edges, keeping the shortest of any duplicates
+        u, v = node[:-1][joined[1:]], node[1:][joined[1:]]
+        w = np.hypot(xy[1:, 0] - xy[:-1, 0], xy[1:, 1] - xy[:-1, 1])[joined[1:]]
+        u, v, w = np.concatenate([u, v]), np.concatenate([v, u]), np.concatenate([w, w])
+        keep = u != v
+        u, v, w = u[keep], v[keep], w[keep]
+        order = np.lexsort((w, v, u))
+        u, v, w = u[order], v[order], w[order]
+        first_edge = np.ones(len(u), dtype = bool)
+        first_edge[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        u, v, w = u[first_edge], v[first_edge], w[first_edge]
+
+        ## Compressed adjacency, node n's edges are indptr[n]:indptr[n + 1]
+        self.indptr = np.searchsorted(u, np.arange(len(self.x) + 1))
+        self.indices = v
+        self.weights = w
+
+        self._tree = cKDTree(np.column_stack([self.x, self.y]))
+
+    def __len__(self):
+        return len(self.x)
+
+    ## Nearest graph node to a lon/lat position
+    def snap(self, lon, lat):
+        px, py = self._to_proj.transform(lon, lat)
+        return int(self._tree.query([px, py])[1])
+
+    ## Node path and length from s to t, or None when t is unreachable
+    def shortest_path(self, s, t):
+        indptr, indices, weights = self.indptr, self.indices, self.weights
+        x, y = self.x, self.y
+        tx, ty = x[t], y[t]
+
+        best = {s: 0.0}
+        prev = {s: -1}
+        closed = set()
+        heap = [(hypot(x[s] - tx, y[s] - ty), 0.0, s)]
+
+        while heap:
+            f, d, n = heappop(heap)
+            if n == t:
+                break
+            if n in closed:
+                continue
+            closed.add(n)
+
+            for k in range(indptr[n], indptr[n + 1]):
+                m = int(indices[k])
+                nd = d + weights[k]
+                if nd < best.get(m, inf):
+                    best[m] = nd
+                    prev[m] = n
+                    heappush(heap, (nd + hypot(x[m] - tx, y[m] - ty), nd, m))
+        else:
+            return None
+
+        path = [t]
+        while prev[path[-1]] != -1:
+            path.append(prev[path[-1]])
+        return path[::-1], best[t]
+
+    def route(self, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat):
+        s = self.snap(pickup_lon, pickup_lat)
+        t = self.snap(dropoff_lon, dropoff_lat)
+
+        found = self.shortest_path(s, t)
+        if found is None:
+            return None
+        path, distance = found
+
+        path = np.asarray(path)
+        px, py = self.x[path], self.y[path]
+        lon, lat = self._from_proj.transform(px, py)
+        coords = list(zip(np.atleast_1d(lon), np.atleast_1d(lat)))
+
+        return {
+            'coords': coords,
+            'distances': np.hypot(np.diff(px), np.diff(py)).tolist(),
+            'start': coords[0],
+            'end': coords[-1],
+            'distance': distance
+        }
+
+## Local road graph a backend routes over, looking through caching wrappers, or
+## None for a backend that routes elsewhere (OSRM)
+def graph_of(backend):
+    while backend is not None:
+        if isinstance(backend, LocalBackend):
+            return backend
+        backend = getattr(backend, 'backend', None)
+    return None
+
+## Route ----
+## Array backed route as returned by calculate_route. Vertices are float64 lon/lat
+## arrays with dist[i] the length of the segment ending at vertex i (dist[0] = 0).
+## With return_trip the return leg is the outbound leg reversed, exposed as
+## negative stride views rather than copies. The GeoSeries and GeoDataFrame of the
+## old dict output are only built when asked for, through route['route'] and
+## route['route_detail'], and are cached once built.
+class Route:
+
+    __slots__ = ('lon', 'lat', 'dist', 'crs', 'start', 'end', 'distance', 'return_trip', '_cum_dist', '_geoseries', '_frame')
+
+    def __init__(self, lon, lat, dist, crs, start, end, distance, return_trip = False):
+        self.lon = lon
+        self.lat = lat
+        self.dist = dist
+        self.crs = crs
+        self.start = start
+        self.end = end
+        self.distance = distance
+        self.return_trip = return_trip
+        self._cum_dist = None
+        self._geoseries = None
+        self._frame = None
+
+    ## Number of outbound vertices
+    def __len__(self):
+        return len(self.lon)
+
+    def point(self, i):
+        from shapely.geometry import Point
+        return Point(self.lon[i], self.lat[i])
+
+    @property
+    def cum_dist(self):
+        if self._cum_dist is None:
+            self._cum_dist = np.cumsum(self.dist)
+        return self._cum_dist
+
+    ## Return leg vertices and distances, as views on the outbound arrays
+    @property
+    def return_lon(self):
+        return self.lon[-2::-1]
+
+    @property
+    def return_lat(self):
+        return self.lat[-2::-1]
+
+    @property
+    def return_dist(self):
+        return self.dist[-2::-1]
+
+    ## Last total_dist of the route detail, summed in the same order
+    @property
+    def total_dist(self):
+        if not self.return_trip:
+            return self.cum_dist[-1]
+        return np.cumsum(np.concatenate([self.cum_dist[-1:], self.return_dist]))[-1]
+
+    def geoseries(self):
+        from geopandas import GeoSeries, points_from_xy
+
+        if self._geoseries is None:
+            self._geoseries = GeoSeries(points_from_xy(self.lon, self.lat), crs = self.crs)
+        return self._geoseries
+
+    def frame(self):
+        from geopandas import GeoDataFrame, points_from_xy
+
+        if self._frame is None:
+            lon, lat, dist = self.lon, self.lat, self.dist
+            if self.return_trip:
+                lon = np.concatenate([lon, self.return_lon])
+                lat = np.concatenate([lat, self.return_lat])
+                dist = np.concatenate([dist, self.return_dist])
+            self._frame = GeoDataFrame({
+                'dist': dist,
+                'total_dist': np.cumsum(dist),
+                'geometry': points_from_xy(lon, lat)
+            }, crs = self.crs)
+        return self._frame
+
+    ## Dict style access matching the old calculate_route output
+    def __getitem__(self, key):
+        from geopandas import GeoSeries
+        from shapely.geometry import Point
+
+        if key == 'route':
+            return self.geoseries()
+        if key == 'route_detail':
+            return self.frame()
+        if key == 'start_point':
+            return GeoSeries(Point(*self.start), crs = self.crs)
+        if key == 'end_point':
+            return GeoSeries(Point(*self.end), crs = self.crs)
+        if key == 'distance':
+            return self.distance
+        raise KeyError(key)
+
+## Reverse a backend result so an A to B route answers B to A
+def reverse_route(res):
+    return {
+        'coords': res['coords'][::-1],
+        'distances': res['distances'][::-1],
+        'start': res['end'],
+        'end': res['start'],
+        'distance': res['distance']
+    }
+
+## Two tier route cache ----
+## Wraps any backend with an in-memory LRU in front of a SQLite store. Entries are
+## keyed by pickup and dropoff quantized to `precision` degrees. The cached value
+## is the backend result itself, so one entry serves both the one way and the
+## round trip versions built by calculate_route. Both tiers are size bounded and
+## evict the least recently used routes first. Disk hits only note when a row was
+## used, and those times are written touch_batch at a time (or with the next
+## store) in one short transaction, so no write lock is held between requests.
+## Several processes can share one file: the file keeps its own row count, which
+## triggers update on every insert and delete, so eviction reads the count of the
+## whole file without scanning it.
+class CachedBackend:
+
+    def __init__(self, backend, path = "routes.sqlite", precision = 1e-5, max_memory = 4096, max_disk = 1000000, touch_batch = 256):
+        import sqlite3
+        from collections import OrderedDict
+
+        self.backend = backend
+        self.symmetric = getattr(backend, 'symmetric', False)
+        self.precision = precision
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.touch_batch = touch_batch
+
+        self.memory = OrderedDict()
+        self._touched = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        ## Not tied to the opening thread, so a caller serialising its calls (such
+        ## as ReplayServer) can use the cache from any thread
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.executescript("""
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, value BLOB, used INTEGER);
+            CREATE INDEX IF NOT EXISTS routes_used ON routes (used);
+            CREATE TABLE IF NOT EXISTS route_count (n INTEGER);
+            INSERT INTO route_count SELECT (SELECT COUNT(*) FROM routes) WHERE NOT EXISTS (SELECT 1 FROM route_count);
+            CREATE TRIGGER IF NOT EXISTS routes_added AFTER INSERT ON routes BEGIN UPDATE route_count SET n = n + 1; END;
+            CREATE TRIGGER IF NOT EXISTS routes_removed AFTER DELETE ON routes BEGIN UPDATE route_count SET n = n - 1; END;
+            COMMIT;
+        """)
+        self._clock = self.db.execute("SELECT COALESCE(MAX(used), 0) FROM routes").fetchone()[0]
+
+    def _key(self, lon1, lat1, lon2, lat2):
+        q = self.precision
+        return "{},{};{},{}".format(round(lon1 / q), round(lat1 / q), round(lon2 / q), round(lat2 / q))
+
+    def _remember(self, key, res):
+        self.memory[key] = res
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory:
+            self.memory.popitem(last = False)
+
+    def _lookup(self, key):
+        import pickle
+
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        row = self.db.execute("SELECT value FROM routes WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        self._clock += 1
+        self._touched[key] = self._clock
+        if len(self._touched) >= self.touch_batch:
+            self._touch()
+            self.db.commit()
+        res = pickle.loads(row[0])
+        self._remember(key, res)
+        self.disk_hits += 1
+        return res
+
+    ## Write the use times of disk hits not yet written
+    def _touch(self):
+        if self._touched:
+            self.db.executemany("UPDATE routes SET used = ? WHERE key = ?", [(t, k) for k, t in self._touched.items()])
+            self._touched = {}
+
+    def _store(self, key, res):
+        import pickle
+
+        self._clock += 1
+        self._touch()
+        ## An upsert rather than INSERT OR REPLACE, whose implicit delete would not
+        ## fire the row count trigger
+        self.db.execute(
+            "INSERT INTO routes (key, value, used) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value, used = excluded.used",
+            (key, pickle.dumps(res, protocol = pickle.HIGHEST_PROTOCOL), self._clock)
+        )
+
+        ## Evict the least recently used rows once the store is over budget, counting
+        ## rows other processes sharing the file have added too
+        over = self.db.execute("SELECT n FROM route_count").fetchone()[0] - self.max_disk
+        if over > 0:
+            self.db.execute("DELETE FROM routes WHERE key IN (SELECT key FROM routes ORDER BY used LIMIT ?)", (over,))
+        self.db.commit()
+        self._remember(key, res)
+
+    def route(self, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat):
+        key = self._key(pickup_lon, pickup_lat, dropoff_lon, dropoff_lat)
+        res = self._lookup(key)
+        if res is not None:
+            return res
+
+        ## A symmetric backend can answer with the reverse of a cached B to A route
+        if self.symmetric:
+            res = self._lookup(self._key(dropoff_lon, dropoff_lat, pickup_lon, pickup_lat))
+            if res is not None:
+                res = reverse_route(res)
+                self._remember(key, res)
+                return res
+
+        self.misses += 1
+        res = self.backend.route(pickup_lon, pickup_lat, dropoff_lon, dropoff_lat)
+        if res is not None:
+            self._store(key, res)
+        return res
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / total if total else 0.0,
+            'memory_size': len(self.memory)
+        }
+
+    def close(self):
+        self._touch()
+        self.db.commit()
+        self.db.close()
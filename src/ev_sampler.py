@@ -0,0 +1,228 @@
+from numpy import arange, argsort, asarray, concatenate, cumsum, empty, flatnonzero, floor, hypot, inf, int64, maximum, minimum, repeat, searchsorted
+from numpy.random import default_rng
+from ev_transform import position, transform
+
+## Road vertex coordinates as an (n, 2) array, MultiLineStrings are flattened part by part
+def line_coords(geom):
+    if geom is None or geom.is_empty:
+        return empty((0, 2))
+    if geom.geom_type == "MultiLineString":
+        return concatenate([asarray(part.coords)[:, :2] for part in geom.geoms])
+    return asarray(geom.coords)[:, :2]
+
+## Vertex sampler ----
+## Flattens every road vertex into contiguous arrays once so start and end points
+## can be drawn without copying or filtering the road GeoDataFrame per call.
+## Road r owns vertices offsets[r]:offsets[r + 1].
+class VertexSampler:
+
+    def __init__(self, road_data, rng = None):
+        coords = [line_coords(geom) for geom in road_data['geometry']]
+        xy = concatenate(coords) if len(coords) else empty((0, 2))
+        counts = asarray([len(c) for c in coords], dtype = int64)
+
+        self._setup(
+            xy[:, 0].copy(), xy[:, 1].copy(), concatenate([[0], cumsum(counts)]),
+            road_data['record'].values, road_data['level'].values, road_data['geometry'].length.values,
+            road_data.crs, rng
+        )
+
+    ## Build from prepared arrays (see ev_prepare), which may be memory mapped
+    @classmethod
+    def from_arrays(cls, x, y, offsets, record, level, length, crs, rng = None):
+        sampler = cls.__new__(cls)
+        sampler._setup(x, y, offsets, record, level, length, crs, rng)
+        return sampler
+
+    def _setup(self, x, y, offsets, record, level, length, crs, rng):
+        self.crs = crs
+        self.rng = default_rng() if rng is None else rng
+
+        ## Per road columns
+        self.offsets = asarray(offsets, dtype = int64)
+        self.counts = self.offsets[1:] - self.offsets[:-1]
+        self.record = record
+        self.level = level
+        self.length = length
+
+        ## Per vertex columns
+        self.x = x
+        self.y = y
+        self.road = repeat(arange(len(self.counts)), self.counts)
+        self.vertex_level = self.level[self.road]
+
+        self.strata = None
+        self._pools = {}
+        self._grid = None
+
+    def __len__(self):
+        return len(self.x)
+
+    ## Lowest projected x and y of any vertex, and the middle vertex of every road
+    @property
+    def origin(self):
+        return self.x.min(), self.y.min()
+
+    def road_midpoints(self):
+        mid = minimum(self.offsets[:-1] + self.counts // 2, len(self) - 1)
+        return self.x[mid], self.y[mid]
+
+    ## Per road stratum codes for draws restricted to one stratum (None to clear)
+    def set_strata(self, codes):
+        self.strata = None if codes is None else asarray(codes)
+        self._pools = {}
+
+    ## Candidate roads (and cumulative length weights) for a level and stratum filter
+    def _pool(self, level, weighted, stratum = None):
+        key = (level, weighted, stratum)
+        if key not in self._pools:
+            keep = self.counts > 0
+            if level is not None:
+                keep &= self.level == level
+            if stratum is not None:
+                keep &= self.strata == stratum
+            roads = flatnonzero(keep)
+            weights = cumsum(self.length[roads]) if weighted else None
+            self._pools[key] = (roads, weights)
+        return self._pools[key]
+
+    ## Draw vertex ids: a road uniformly (or by length), then a vertex uniformly within it
+    def sample(self, size = None, level = None, weighted = False, rng = None, stratum = None):
+        rng = self.rng if rng is None else rng
+        roads, weights = self._pool(level, weighted, stratum)
+
+        if weighted:
+            road = roads[searchsorted(weights, rng.random(size) * weights[-1], side = "right")]
+        else:
+            road = roads[rng.integers(len(roads), size = size)]
+
+        return self.offsets[road] + rng.integers(self.counts[road])
+
+    ## Chance of a sample() draw landing in the stratum, up to a constant factor
+    def pool_weight(self, level = None, weighted = False, stratum = None):
+        roads, weights = self._pool(level, weighted, stratum)
+        if weighted:
+            return weights[-1] if len(weights) else 0.0
+        return len(roads)
+
+    ## Per vertex weights reproducing the road-then-vertex draw of sample()
+    def vertex_weights(self, ids = slice(None), weighted = False):
+        road = self.road[ids]
+        w = 1.0 / self.counts[road]
+        return w * self.length[road] if weighted else w
+
+    ## Spatial grid over the vertices, built on first use
+    @property
+    def grid(self):
+        if self._grid is None:
+            self._grid = VertexGrid(self)
+        return self._grid
+
+    ## Draw a vertex between r_min and r_max (metres) of the point (x, y) in the sampler CRS
+    def sample_annulus(self, x, y, r_min, r_max = None, weighted = False, rng = None):
+        rng = self.rng if rng is None else rng
+        return self.grid.sample(x, y, r_min, r_max, weighted, rng)
+
+    ## Same output as sample_point for a single vertex id
+    def point(self, vertex, crs):
+        x, y = transform(float(self.x[vertex]), float(self.y[vertex]), self.crs, crs)
+        return position(x, y, crs, road_row_num = self.record[self.road[vertex]], vertex = vertex)
+
+    def draw(self, crs, level = None, weighted = False, rng = None, stratum = None):
+        return self.point(self.sample(level = level, weighted = weighted, rng = rng, stratum = stratum), crs)
+
+    def draw_annulus(self, x, y, crs, r_min, r_max = None, weighted = False, rng = None):
+        vertex = self.sample_annulus(x, y, r_min, r_max, weighted = weighted, rng = rng)
+        return None if vertex is None else self.point(vertex, crs)
+
+## Vertex grid ----
+## Buckets vertices into square cells so ring (annulus) queries only test the
+## vertices of cells cut by the ring boundary. Cells wholly inside the ring are
+## taken as a block through the cell-sorted vertex order.
+class VertexGrid:
+
+    def __init__(self, sampler, cell_size = 10000):
+        self.sampler = sampler
+        self.cell_size = cell_size
+        self.x0 = sampler.x.min()
+        self.y0 = sampler.y.min()
+
+        cx = floor((sampler.x - self.x0) / cell_size).astype(int64)
+        cy = floor((sampler.y - self.y0) / cell_size).astype(int64)
+        self.nx = int(cx.max()) + 1
+        self.ny = int(cy.max()) + 1
+
+        ## Vertices sorted by cell, cell c owns order[starts[c]:starts[c + 1]]
+        cell = cy * self.nx + cx
+        self.order = argsort(cell, kind = "stable")
+        self.starts = searchsorted(cell[self.order], arange(self.nx * self.ny + 1))
+
+        ## Lower left corner of every cell
+        cells = arange(self.nx * self.ny)
+        self.cell_x = self.x0 + (cells % self.nx) * cell_size
+        self.cell_y = self.y0 + (cells // self.nx) * cell_size
+
+        self._cum_w = {}
+
+    ## Running vertex weights in cell order, so any cell's total is a difference
+    def _cum_weights(self, weighted):
+        if weighted not in self._cum_w:
+            w = self.sampler.vertex_weights(self.order, weighted)
+            self._cum_w[weighted] = concatenate([[0], cumsum(w)])
+        return self._cum_w[weighted]
+
+    ## Split non-empty cells into those wholly inside the ring and those cut by it
+    def _classify(self, x, y, r_min, r_max):
+        r_max = inf if r_max is None else r_max
+        lo_x, lo_y = self.cell_x - x, self.cell_y - y
+        hi_x, hi_y = lo_x + self.cell_size, lo_y + self.cell_size
+
+        near = hypot(maximum(maximum(lo_x, -hi_x), 0), maximum(maximum(lo_y, -hi_y), 0))
+        far = hypot(maximum(abs(lo_x), abs(hi_x)), maximum(abs(lo_y), abs(hi_y)))
+
+        filled = self.starts[1:] > self.starts[:-1]
+        inside = filled & (near >= r_min) & (far <= r_max)
+        cut = filled & ~inside & (far >= r_min) & (near <= r_max)
+        return flatnonzero(inside), flatnonzero(cut)
+
+    ## Vertex ids of the cut cells that actually fall in the ring
+    def _edge_vertices(self, cells, x, y, r_min, r_max):
+        if not len(cells):
+            return empty(0, dtype = int64)
+        ids = self.order[concatenate([arange(self.starts[c], self.starts[c + 1]) for c in cells])]
+        d = hypot(self.sampler.x[ids] - x, self.sampler.y[ids] - y)
+        keep = d >= r_min
+        if r_max is not None:
+            keep &= d <= r_max
+        return ids[keep]
+
+    ## All vertex ids with r_min <= distance <= r_max
+    def annulus(self, x, y, r_min, r_max = None):
+        inside, cut = self._classify(x, y, r_min, r_max)
+        blocks = [self.order[self.starts[c]:self.starts[c + 1]] for c in inside]
+        return concatenate([*blocks, self._edge_vertices(cut, x, y, r_min, r_max)])
+
+    ## One vertex id from the ring, weighted as VertexSampler.sample would weight it
+    def sample(self, x, y, r_min, r_max, weighted, rng):
+        inside, cut = self._classify(x, y, r_min, r_max)
+        edge = self._edge_vertices(cut, x, y, r_min, r_max)
+
+        cum_w = self._cum_weights(weighted)
+        cell_w = cumsum(cum_w[self.starts[inside + 1]] - cum_w[self.starts[inside]])
+        edge_w = cumsum(self.sampler.vertex_weights(edge, weighted))
+
+        total_inside = cell_w[-1] if len(cell_w) else 0
+        total = total_inside + (edge_w[-1] if len(edge_w) else 0)
+        if total <= 0:
+            return None
+
+        u = rng.random() * total
+        if u < total_inside:
+            ## Pick the cell, then the vertex inside it from the running weights
+            j = searchsorted(cell_w, u, side = "right")
+            c = inside[j]
+            target = cum_w[self.starts[c]] + u - (cell_w[j - 1] if j > 0 else 0)
+            pos = searchsorted(cum_w, target, side = "right") - 1
+            return self.order[min(max(pos, self.starts[c]), self.starts[c + 1] - 1)]
+
+        return edge[min(searchsorted(edge_w, u - total_inside, side = "right"), len(edge) - 1)]
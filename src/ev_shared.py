@@ -0,0 +1,176 @@
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+## Attach to a block by name without leaving it registered with the resource
+## tracker, which would otherwise unlink it (and warn of a leak) when a process
+## with its own tracker exits. Python 3.13 takes track = False; before that the
+## registration made on attaching is withdrawn straight away. A worker sharing the
+## owner's tracker withdraws the owner's entry with it, so the owner registers its
+## blocks again before unlinking them (see SharedArrays.close).
+def _attach(block):
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name = block, track = False)
+    shm = SharedMemory(name = block)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+## Shared arrays ----
+## NumPy arrays published once into multiprocessing shared memory blocks, one block
+## per array. The handle (block names, dtypes and shapes) is small and pickles
+## cheaply, and a worker attaching with it gets arrays backed by the same pages,
+## with no copy. The publishing side owns the blocks and unlinks them on close,
+## other processes attach untracked and only close them.
+class SharedArrays:
+
+    def __init__(self, handle, owner = False):
+        self.handle = handle
+        self.owner = owner
+        self._blocks = {}
+        self.arrays = {}
+        for name, (block, dtype, shape) in handle.items():
+            shm = SharedMemory(name = block) if owner else _attach(block)
+            self._blocks[name] = shm
+            self.arrays[name] = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+    ## Copy arrays into new shared memory blocks
+    @classmethod
+    def publish(cls, arrays):
+        handle = {}
+        try:
+            for name, values in arrays.items():
+                values = np.ascontiguousarray(values)
+                if values.dtype.hasobject:
+                    raise ValueError("Cannot share object array " + name)
+                shm = SharedMemory(create = True, size = max(values.nbytes, 1))
+                np.ndarray(values.shape, dtype = values.dtype, buffer = shm.buf)[...] = values
+                handle[name] = (shm.name, values.dtype.str, values.shape)
+                shm.close()
+        except Exception:
+            cls(handle, owner = True).close()
+            raise
+        return cls(handle, owner = True)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    ## Views must be dropped before a block can be closed
+    def close(self):
+        self.arrays = {}
+        for shm in self._blocks.values():
+            shm.close()
+            if self.owner:
+                if sys.version_info < (3, 13):
+                    resource_tracker.register(shm._name, "shared_memory")
+                shm.unlink()
+        self._blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+## Road vertex arrays (the VertexSampler layout) of a projected road layer, as shared arrays
+def share_roads(road_data = None, cache_dir = None):
+    from ev_prepare import open_arrays, road_arrays
+
+    arrays = road_arrays(road_data) if cache_dir is None else open_arrays(cache_dir)
+    return SharedArrays.publish({k: arrays[k] for k in ('road_x', 'road_y', 'road_offsets', 'road_record', 'road_level', 'road_length')})
+
+## VertexSampler over shared road arrays, without copying them
+def shared_sampler(roads, crs, rng = None):
+    from ev_sampler import VertexSampler
+
+    return VertexSampler.from_arrays(
+        roads['road_x'], roads['road_y'], roads['road_offsets'],
+        roads['road_record'], roads['road_level'], roads['road_length'],
+        crs, rng = rng
+    )
+
+## Shared chargers ----
+## Station x, y (in the charger data CRS) and nm_chrg in shared arrays sized for
+## the base stations plus `capacity` chargers added during a run. Added chargers are
+## written into the free rows after the stations already there, so workers see them
+## without the table being shared again. header holds [version, rows]: the owner
+## makes version odd while it writes and even again once rows is updated, and a
+## reader that sees the same even version before and after reading rows has a
+## consistent count (rows never shrink, so earlier rows can be read at any time).
+class SharedChargers:
+
+    def __init__(self, shared, crs, n_base):
+        self.shared = shared
+        self.crs = crs
+        self.n_base = n_base
+
+    @classmethod
+    def publish(cls, evc_data, capacity):
+        n = len(evc_data)
+        size = n + capacity
+        x = np.zeros(size)
+        y = np.zeros(size)
+        nm_chrg = np.zeros(size, dtype = np.int64)
+        x[:n] = evc_data['geometry'].x.values
+        y[:n] = evc_data['geometry'].y.values
+        nm_chrg[:n] = evc_data['nm_chrg'].values
+        shared = SharedArrays.publish({'header': np.array([0, n], dtype = np.int64), 'x': x, 'y': y, 'nm_chrg': nm_chrg})
+        return cls(shared, evc_data.crs, n)
+
+    ## What a worker needs to attach
+    @property
+    def handle(self):
+        return self.shared.handle, self.crs, self.n_base
+
+    @classmethod
+    def attach(cls, handle):
+        arrays, crs, n_base = handle
+        return cls(SharedArrays(arrays), crs, n_base)
+
+    @property
+    def capacity(self):
+        return len(self.shared['x'])
+
+    ## Number of rows and the version they were read at
+    def rows(self):
+        header = self.shared['header']
+        while True:
+            version = int(header[0])
+            n = int(header[1])
+            if (version % 2 == 0) and (int(header[0]) == version):
+                return n, version
+
+    ## Append charger rows (same schema and CRS as the published data)
+    def append(self, rows):
+        header = self.shared['header']
+        n = int(header[1])
+        m = n + len(rows)
+        if m > self.capacity:
+            raise ValueError("Shared charger table is full ({} rows)".format(self.capacity))
+
+        header[0] += 1
+        self.shared['x'][n:m] = [g.x for g in rows['geometry']]
+        self.shared['y'][n:m] = [g.y for g in rows['geometry']]
+        self.shared['nm_chrg'][n:m] = rows['nm_chrg'].values
+        header[1] = m
+        header[0] += 1
+
+    ## Rows start:stop in the evc_data schema
+    def frame(self, start = 0, stop = None):
+        from geopandas import GeoDataFrame, points_from_xy
+
+        stop = self.rows()[0] if stop is None else stop
+        return GeoDataFrame({
+            "fll_ddr": None,
+            "nm_chrg": self.shared['nm_chrg'][start:stop],
+            "geometry": points_from_xy(self.shared['x'][start:stop], self.shared['y'][start:stop])
+        }, crs = self.crs)
+
+    ## Chargers added since the base stations, up to stop rows
+    def added(self, stop = None):
+        stop = self.rows()[0] if stop is None else stop
+        return None if stop <= self.n_base else self.frame(self.n_base, stop)
+
+    def close(self):
+        self.shared.close()
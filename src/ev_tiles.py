@@ -0,0 +1,497 @@
+import json
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from ev_metrics import get_metrics
+from ev_transform import position, transform
+
+## Tiled road and charger layout ----
+## Road vertices and stations cut into square tiles of side tile_size metres on a
+## fixed projected (EPSG:32613) grid, tile (ix, iy) covering
+## [ix * tile_size, (ix + 1) * tile_size) in x and likewise in y, so tiles built
+## from different layers (another state, say) line up. Each tile is split again
+## into SUB x SUB cells and its vertices are stored cell by cell. Each tile is one
+## ix_iy.npz of road vertices:
+##
+##   x, y          projected vertex coordinates
+##   road, record  road (row of the roads layer) and road record of each vertex
+##   level         road level of each vertex
+##   w, w_len      sampling weight of each vertex, 1 / (vertices on its road) and
+##                 road length / (vertices on its road), so drawing vertices by
+##                 weight is the road-then-vertex draw of VertexSampler.sample
+##
+## plus, where it holds any, a stations_ix_iy.npz of its stations (id, the row of
+## the charger layer, projected x, y, lon / lat in the layer CRS and nm_chrg).
+## index.npz holds every tile's key, weight totals (all levels and level 3 only),
+## per cell weight totals and row offsets and station count, and the middle vertex
+## of every road, which is all a sampler needs to pick a tile, or a cell, or to
+## assign roads to regions before opening any tile.
+LEVEL = 3
+SUB = 8
+TILE_FORMAT = 3
+
+def _tile_name(ix, iy):
+    return "{}_{}.npz".format(ix, iy)
+
+def _station_name(ix, iy):
+    return "stations_{}_{}.npz".format(ix, iy)
+
+## Write tiles of side tile_size from the arrays of a prepare() cache into
+## cache_dir / tiles_<tile_size>, skipping the build when it is already there
+def build_tiles(cache_dir, tile_size = 50000, force = False):
+    from ev_prepare import open_arrays
+
+    cache_dir = Path(cache_dir)
+    out = cache_dir / "tiles_{}".format(int(tile_size))
+    manifest = json.loads((cache_dir / "manifest.json").read_text())
+    manifest['tile_format'] = TILE_FORMAT
+    if (not force) and (out / "manifest.json").exists() and json.loads((out / "manifest.json").read_text()) == manifest:
+        return out
+    out.mkdir(parents = True, exist_ok = True)
+
+    a = open_arrays(cache_dir)
+    offsets = np.asarray(a['road_offsets'])
+    counts = np.diff(offsets)
+    road = np.repeat(np.arange(len(counts)), counts)
+    x, y = np.asarray(a['road_x']), np.asarray(a['road_y'])
+    level = np.asarray(a['road_level'])[road]
+    w = 1.0 / counts[road]
+    w_len = w * np.asarray(a['road_length'])[road]
+    record = np.asarray(a['road_record'])[road]
+    mid = np.minimum(offsets[:-1] + counts // 2, len(x) - 1)
+
+    ix = np.floor(x / tile_size).astype(np.int64)
+    iy = np.floor(y / tile_size).astype(np.int64)
+    cell_size = tile_size / SUB
+    cx = np.clip(np.floor((x - ix * tile_size) / cell_size).astype(np.int64), 0, SUB - 1)
+    cy = np.clip(np.floor((y - iy * tile_size) / cell_size).astype(np.int64), 0, SUB - 1)
+    cell = cy * SUB + cx
+
+    sx, sy = np.asarray(a['station_x']), np.asarray(a['station_y'])
+    s_ix = np.floor(sx / tile_size).astype(np.int64)
+    s_iy = np.floor(sy / tile_size).astype(np.int64)
+
+    ## Vertices by tile, then by cell within the tile
+    keys = np.unique(np.concatenate([np.column_stack([ix, iy]), np.column_stack([s_ix, s_iy])]), axis = 0)
+    order = np.lexsort((cell, iy, ix))
+    bounds = np.searchsorted(ix[order] * (1 << 32) + iy[order], keys[:, 0] * (1 << 32) + keys[:, 1], side = "left")
+    bounds = np.append(bounds, len(order))
+
+    totals = np.zeros((len(keys), 4))
+    cell_w = np.zeros((len(keys), SUB * SUB, 2))
+    cell_start = np.zeros((len(keys), SUB * SUB + 1), dtype = np.int64)
+    station_count = np.zeros(len(keys), dtype = np.int64)
+    for t, (kx, ky) in enumerate(keys):
+        v = order[bounds[t]:bounds[t + 1]]
+        lvl = level[v] == LEVEL
+        totals[t] = [w[v].sum(), w_len[v].sum(), w[v][lvl].sum(), w_len[v][lvl].sum()]
+        cell_w[t, :, 0] = np.bincount(cell[v], weights = w[v], minlength = SUB * SUB)
+        cell_w[t, :, 1] = np.bincount(cell[v], weights = w_len[v], minlength = SUB * SUB)
+        cell_start[t, 1:] = np.cumsum(np.bincount(cell[v], minlength = SUB * SUB))
+        np.savez(out / _tile_name(kx, ky), x = x[v], y = y[v], road = road[v], record = record[v], level = level[v], w = w[v], w_len = w_len[v])
+
+        s = np.flatnonzero((s_ix == kx) & (s_iy == ky))
+        station_count[t] = len(s)
+        if len(s):
+            np.savez(
+                out / _station_name(kx, ky), id = s, x = sx[s], y = sy[s], lon = np.asarray(a['station_lon'])[s],
+                lat = np.asarray(a['station_lat'])[s], nm_chrg = np.asarray(a['station_nm_chrg'])[s]
+            )
+
+    np.savez(
+        out / "index.npz", keys = keys, totals = totals, cell_w = cell_w, cell_start = cell_start, station_count = station_count,
+        road_mid_x = x[mid], road_mid_y = y[mid], origin = [x.min(), y.min()], tile_size = tile_size
+    )
+    (out / "manifest.json").write_text(json.dumps(manifest, indent = 1))
+    return out
+
+## Tile store ----
+## Opens road and station tiles on demand and keeps the most recently used ones in
+## memory, evicting the least recently used while the loaded tiles take more than
+## budget bytes (the tile just opened always stays).
+class TileStore:
+
+    def __init__(self, path, budget = 256 * 2 ** 20):
+        from pyproj import CRS
+
+        self.path = Path(path)
+        self.budget = budget
+        index = np.load(self.path / "index.npz")
+        self.keys = index['keys']
+        self.totals = index['totals']
+        self.cell_w = index['cell_w']
+        self.cell_start = index['cell_start']
+        self.station_count = index['station_count']
+        self.road_mid_x = index['road_mid_x']
+        self.road_mid_y = index['road_mid_y']
+        self.origin = tuple(index['origin'])
+        self.tile_size = float(index['tile_size'])
+        manifest = json.loads((self.path / "manifest.json").read_text())
+        self.crs = manifest['proj']
+        ## Parsed once, the station layer CRS is slow to parse from its name
+        self.station_crs = CRS.from_user_input(manifest['crs'])
+        self._loaded = OrderedDict()
+        self.nbytes = 0
+
+        ## Lower left corner of every tile, and of every cell of every tile
+        self.tile_x = self.keys[:, 0] * self.tile_size
+        self.tile_y = self.keys[:, 1] * self.tile_size
+        self.cell_size = self.tile_size / SUB
+        self.cell_x = self.tile_x[:, None] + (np.arange(SUB * SUB) % SUB) * self.cell_size
+        self.cell_y = self.tile_y[:, None] + (np.arange(SUB * SUB) // SUB) * self.cell_size
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _open(self, key, name):
+        metrics = get_metrics()
+        if key in self._loaded:
+            self._loaded.move_to_end(key)
+            return self._loaded[key]
+
+        with metrics.timer('tile_load'), np.load(self.path / name) as f:
+            arrays = {k: f[k] for k in f.files}
+        metrics.count('tile_loads')
+        self._loaded[key] = arrays
+        self.nbytes += sum(v.nbytes for v in arrays.values())
+
+        while (self.nbytes > self.budget) and (len(self._loaded) > 1):
+            _, old = self._loaded.popitem(last = False)
+            self.nbytes -= sum(v.nbytes for v in old.values())
+            metrics.count('tile_evictions')
+        metrics.gauge('tile_bytes', self.nbytes)
+        return arrays
+
+    ## Road arrays of tile t (a row of keys), opening it if it is not in memory
+    def tile(self, t):
+        return self._open(t, _tile_name(*self.keys[t]))
+
+    ## Station arrays of tile t, empty for a tile with no stations
+    def station_tile(self, t):
+        if not self.station_count[t]:
+            return None
+        return self._open(('stations', t), _station_name(*self.keys[t]))
+
+    ## Tiles whose box overlaps the box from (x0, y0) to (x1, y1)
+    def corridor(self, x0, y0, x1, y1):
+        return np.flatnonzero(
+            (self.tile_x <= x1) & (self.tile_x + self.tile_size >= x0) &
+            (self.tile_y <= y1) & (self.tile_y + self.tile_size >= y0)
+        )
+
+    ## Stations of the given tiles in the evc_data schema (geometry in the station
+    ## layer CRS), indexed and ordered by their row of the charger layer
+    def stations(self, tiles):
+        from geopandas import GeoDataFrame, points_from_xy
+
+        arrays = [a for a in (self.station_tile(t) for t in tiles) if a is not None]
+        cat = lambda k: np.concatenate([a[k] for a in arrays]) if arrays else np.empty(0)
+        ids = cat('id').astype(np.int64)
+        order = np.argsort(ids, kind = "stable")
+        return GeoDataFrame({
+            "fll_ddr": None,
+            "nm_chrg": cat('nm_chrg')[order],
+            "geometry": points_from_xy(cat('lon')[order], cat('lat')[order])
+        }, index = ids[order], crs = self.station_crs)
+
+## Vertex ids are tile << 32 | row within the tile
+_ROW = (1 << 32) - 1
+
+## Nearest and furthest distance from the origin to square boxes of side size with
+## lower left corners (lo_x, lo_y) relative to it
+def _box_dist(lo_x, lo_y, size):
+    hi_x, hi_y = lo_x + size, lo_y + size
+    near = np.hypot(np.maximum(np.maximum(lo_x, -hi_x), 0), np.maximum(np.maximum(lo_y, -hi_y), 0))
+    far = np.hypot(np.maximum(np.abs(lo_x), np.abs(hi_x)), np.maximum(np.abs(lo_y), np.abs(hi_y)))
+    return near, far
+
+class _TileColumn:
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def __getitem__(self, vertex):
+        return self.store.tile(int(vertex) >> 32)[self.name][int(vertex) & _ROW]
+
+## Tiled sampler ----
+## Draws start and end points with the distribution of VertexSampler (draw and
+## draw_annulus) while opening only the tiles a draw needs. A start point picks a
+## tile by its level 3 weight total and then a vertex in it. An end point picks a
+## cell the ring reaches by its weight total and then a vertex in that cell, and
+## is kept if the vertex lies in the ring, else drawn again (rejection sampling:
+## a kept vertex has the exact ring distribution, and only the cells cut by the
+## ring boundary can reject). Each try opens one tile. After max_tries rejections
+## the draw falls back to an exact pass over the cells the ring boundary cuts.
+## Strata are per road codes as for VertexSampler, and set_strata reads every tile
+## once, a tile at a time, to total each stratum's level 3 weight per tile.
+class TiledSampler:
+
+    max_tries = 32
+
+    def __init__(self, store, rng = None):
+        self.store = store
+        self.crs = store.crs
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.x = _TileColumn(store, 'x')
+        self.y = _TileColumn(store, 'y')
+        self.road = _TileColumn(store, 'road')
+        self.strata = None
+        self._stratum_w = None
+
+    def __len__(self):
+        return int(self.store.cell_start[:, -1].sum())
+
+    ## Lowest projected x and y of any vertex, and the middle vertex of every road
+    @property
+    def origin(self):
+        return self.store.origin
+
+    def road_midpoints(self):
+        return self.store.road_mid_x, self.store.road_mid_y
+
+    ## Per road stratum codes for draws restricted to one stratum (None to clear)
+    def set_strata(self, codes):
+        self.strata = None if codes is None else np.asarray(codes)
+        self._stratum_w = None
+        if self.strata is None:
+            return
+        n = int(self.strata.max()) + 1
+        stratum_w = np.zeros((len(self.store), n, 2))
+        for t in range(len(self.store)):
+            arrays = self.store.tile(t)
+            keep = arrays['level'] == LEVEL
+            h = self.strata[arrays['road'][keep]]
+            stratum_w[t, :, 0] = np.bincount(h, weights = arrays['w'][keep], minlength = n)
+            stratum_w[t, :, 1] = np.bincount(h, weights = arrays['w_len'][keep], minlength = n)
+        self._stratum_w = stratum_w
+
+    ## Per tile weights of a sample() draw, as the level 3 totals or a stratum's
+    def _tile_weights(self, level, weighted, stratum):
+        if level not in (None, LEVEL):
+            raise ValueError("Tile totals are kept for all levels and level {} only".format(LEVEL))
+        if stratum is not None:
+            if level != LEVEL:
+                raise ValueError("Stratified draws are kept for level {} only".format(LEVEL))
+            return self._stratum_w[:, stratum, int(weighted)]
+        return self.store.totals[:, (2 if level == LEVEL else 0) + int(weighted)]
+
+    ## Chance of a sample() draw landing in the stratum, up to a constant factor
+    def pool_weight(self, level = None, weighted = False, stratum = None):
+        return float(self._tile_weights(level, weighted, stratum).sum())
+
+    ## Vertex id of a draw u in [0, 1) over the weights w of rows start: of tile t
+    def _pick(self, t, w, u, start = 0):
+        cum = np.cumsum(w)
+        row = min(int(np.searchsorted(cum, u * cum[-1], side = "right")), len(w) - 1)
+        return (int(t) << 32) | (int(start) + row)
+
+    def point(self, vertex, crs):
+        arrays = self.store.tile(int(vertex) >> 32)
+        row = int(vertex) & _ROW
+        x, y = transform(float(arrays['x'][row]), float(arrays['y'][row]), self.crs, crs)
+        return position(x, y, crs, road_row_num = arrays['record'][row], vertex = vertex)
+
+    def sample(self, level = None, weighted = False, rng = None, stratum = None):
+        rng = self.rng if rng is None else rng
+        cum = np.cumsum(self._tile_weights(level, weighted, stratum))
+        t = min(int(np.searchsorted(cum, rng.random() * cum[-1], side = "right")), len(cum) - 1)
+
+        arrays = self.store.tile(t)
+        w = arrays['w_len' if weighted else 'w']
+        if level == LEVEL:
+            w = w * (arrays['level'] == LEVEL)
+        if stratum is not None:
+            w = w * (self.strata[arrays['road']] == stratum)
+        return self._pick(t, w, rng.random())
+
+    def draw(self, crs, level = None, weighted = False, rng = None, stratum = None):
+        return self.point(self.sample(level = level, weighted = weighted, rng = rng, stratum = stratum), crs)
+
+    def sample_annulus(self, x, y, r_min, r_max = None, weighted = False, rng = None):
+        rng = self.rng if rng is None else rng
+        store = self.store
+        key = 'w_len' if weighted else 'w'
+        r_max = np.inf if r_max is None else r_max
+
+        ## Cells with weight that the ring reaches
+        near, far = _box_dist(store.cell_x - x, store.cell_y - y, store.cell_size)
+        cell_w = store.cell_w[:, :, int(weighted)]
+        cells = np.flatnonzero((far >= r_min) & (near <= r_max) & (cell_w > 0))
+        if not len(cells):
+            return None
+        cum = np.cumsum(cell_w.ravel()[cells])
+
+        for _ in range(self.max_tries):
+            c = cells[min(int(np.searchsorted(cum, rng.random() * cum[-1], side = "right")), len(cells) - 1)]
+            t, k = divmod(int(c), SUB * SUB)
+            a, b = store.cell_start[t, k], store.cell_start[t, k + 1]
+            arrays = store.tile(t)
+            vertex = self._pick(t, arrays[key][a:b], rng.random(), start = a)
+            d = np.hypot(arrays['x'][vertex & _ROW] - x, arrays['y'][vertex & _ROW] - y)
+            if r_min <= d <= r_max:
+                return vertex
+            get_metrics().count('annulus_rejections')
+        return self._exact_annulus(x, y, r_min, r_max, weighted, rng)
+
+    ## Annulus draw with no rejection: cells wholly inside the ring by their totals,
+    ## and the ring vertices of the cells its boundary cuts
+    def _exact_annulus(self, x, y, r_min, r_max, weighted, rng):
+        store = self.store
+        key = 'w_len' if weighted else 'w'
+        near, far = _box_dist(store.cell_x - x, store.cell_y - y, store.cell_size)
+        cell_w = store.cell_w[:, :, int(weighted)]
+        whole = (near >= r_min) & (far <= r_max)
+        inside = np.flatnonzero(whole & (cell_w > 0))
+        cut = np.flatnonzero(~whole & (far >= r_min) & (near <= r_max) & (cell_w > 0))
+
+        edge_ids, edge_w = [], []
+        for c in cut:
+            t, k = divmod(int(c), SUB * SUB)
+            a, b = store.cell_start[t, k], store.cell_start[t, k + 1]
+            arrays = store.tile(t)
+            d = np.hypot(arrays['x'][a:b] - x, arrays['y'][a:b] - y)
+            rows = a + np.flatnonzero((d >= r_min) & (d <= r_max))
+            edge_ids.append((t << 32) | rows)
+            edge_w.append(arrays[key][rows])
+        edge_ids = np.concatenate(edge_ids) if edge_ids else np.empty(0, dtype = np.int64)
+        edge_w = np.cumsum(np.concatenate(edge_w)) if edge_w else np.empty(0)
+
+        inside_w = np.cumsum(cell_w.ravel()[inside])
+        total_inside = inside_w[-1] if len(inside_w) else 0
+        total = total_inside + (edge_w[-1] if len(edge_w) else 0)
+        if total <= 0:
+            return None
+
+        u = rng.random() * total
+        if u < total_inside:
+            j = int(np.searchsorted(inside_w, u, side = "right"))
+            t, k = divmod(int(inside[j]), SUB * SUB)
+            a, b = store.cell_start[t, k], store.cell_start[t, k + 1]
+            return self._pick(t, store.tile(t)[key][a:b], rng.random(), start = a)
+        return int(edge_ids[min(int(np.searchsorted(edge_w, u - total_inside, side = "right")), len(edge_ids) - 1)])
+
+    def draw_annulus(self, x, y, crs, r_min, r_max = None, weighted = False, rng = None):
+        vertex = self.sample_annulus(x, y, r_min, r_max, weighted = weighted, rng = rng)
+        return None if vertex is None else self.point(vertex, crs)
+
+## Tiled charger index ----
+## Nearest charger lookups over the station tiles a trip's corridor touches rather
+## than every station. focus() indexes the stations of the tiles within buffer
+## metres of a route's bounding box, plus every charger added so far, in a
+## ChargerIndex. A nearest station found closer than the edge of the indexed box is
+## the nearest overall, otherwise the box grows to take in every tile that could
+## hold a closer one and the lookup is repeated, so answers match an index over
+## every station. Station tiles go through the store's budget like road tiles.
+class TiledChargers:
+
+    def __init__(self, store, buffer = 50000, rebuild_size = 256):
+        from ev_transform import PROJ, transformer
+
+        self.store = store
+        self.buffer = buffer
+        self.rebuild_size = rebuild_size
+        self.crs = store.station_crs
+        self._to_proj = transformer(self.crs, PROJ)
+        self._added = []
+        self._box = None
+        self._index = None
+
+        ## Extent of the tiles holding stations, past which the box need not grow
+        has = store.station_count > 0
+        self._extent = (
+            store.tile_x[has].min(), store.tile_y[has].min(),
+            store.tile_x[has].max() + store.tile_size, store.tile_y[has].max() + store.tile_size
+        ) if has.any() else (0, 0, 0, 0)
+
+    def __len__(self):
+        return int(self.store.station_count.sum()) + sum(len(a) for a in self._added)
+
+    ## Station frames and added charger rows (plain DataFrames from simulate_trip)
+    ## as one GeoDataFrame in the station layer CRS
+    def _frame(self, frames):
+        from geopandas import GeoDataFrame
+        from pandas import concat
+
+        return GeoDataFrame(concat(frames).reset_index(drop = True), geometry = 'geometry', crs = self.crs)
+
+    ## Index the stations of the tiles overlapping the box (x0, y0, x1, y1)
+    def _load(self, box):
+        from ev_index import ChargerIndex
+
+        self._box = box
+        stations = self.store.stations(self.store.corridor(*box))
+        get_metrics().gauge('corridor_stations', len(stations))
+        stations = self._frame([stations, *self._added])
+        self._index = ChargerIndex(stations, rebuild_size = self.rebuild_size) if len(stations) else None
+
+    ## Stations around a route given by vertex lon / lat arrays in crs
+    def focus(self, lon, lat, crs):
+        from ev_transform import PROJ
+
+        x, y = transform(np.asarray(lon), np.asarray(lat), crs, PROJ)
+        b = self.buffer
+        self._load((np.min(x) - b, np.min(y) - b, np.max(x) + b, np.max(y) + b))
+
+    ## All station rows sharing the location of the nearest station to a point in
+    ## the station layer CRS
+    def nearest(self, point):
+        if len(self) == 0:
+            raise ValueError("No stations in the tiles and no chargers added")
+        px, py = self._to_proj.transform(point.x, point.y)
+        if self._box is None:
+            self._load((px - self.buffer, py - self.buffer, px + self.buffer, py + self.buffer))
+
+        while True:
+            x0, y0, x1, y1 = self._box
+            ids, dist = self._index.query(point, k = 1) if self._index is not None else ([], [np.inf])
+            margin = min(px - x0, py - y0, x1 - px, y1 - py)
+            covered = (x0 <= self._extent[0]) and (y0 <= self._extent[1]) and (x1 >= self._extent[2]) and (y1 >= self._extent[3])
+            if (dist[0] <= margin) or covered:
+                return self._index.at(ids[0])
+
+            ## A closer station can only be within dist of the point (padded a metre so
+            ## rounding cannot leave the grown box a hair short of it)
+            get_metrics().count('corridor_misses')
+            reach = np.hypot(max(px - self._extent[0], self._extent[2] - px), max(py - self._extent[1], self._extent[3] - py))
+            r = min(max(dist[0], self.buffer), reach) + 1
+            self._load((min(x0, px - r), min(y0, py - r), max(x1, px + r), max(y1, py + r)))
+
+    ## Add new charger rows (same schema and CRS as the station layer)
+    def insert(self, rows):
+        from ev_index import ChargerIndex
+
+        rows = rows.reset_index(drop = True)
+        self._added.append(rows)
+        if self._index is None:
+            self._index = ChargerIndex(self._frame([rows]), rebuild_size = self.rebuild_size)
+        else:
+            self._index.insert(rows)
+
+    ## Drop every added charger after the first n stations (n at least the tile
+    ## stations), reloading the current box without them
+    def truncate(self, n):
+        from pandas import concat
+
+        n_base = int(self.store.station_count.sum())
+        if n < n_base:
+            raise ValueError("Cannot drop stations of the tiles")
+        if n >= len(self):
+            return
+        rows = concat(self._added).reset_index(drop = True).iloc[:n - n_base]
+        self._added = [rows] if len(rows) else []
+        if self._box is not None:
+            self._load(self._box)
+        else:
+            self._index = None
+
+    ## Every station, read a tile at a time, followed by the added chargers
+    @property
+    def data(self):
+        return self._frame([self.store.stations(np.flatnonzero(self.store.station_count)), *self._added])
+
+## Tiled sampler over the tiles of a prepared cache, building them if needed
+def open_tiled_sampler(cache_dir, tile_size = 50000, budget = 256 * 2 ** 20, rng = None):
+    return TiledSampler(TileStore(build_tiles(cache_dir, tile_size), budget), rng = rng)
@@ -0,0 +1,58 @@
+from numpy import asarray
+from pyproj import Transformer
+
+## Projected CRS used for distances throughout (UTM zone 13N, metres)
+PROJ = "EPSG:32613"
+WGS84 = "EPSG:4326"
+
+## Coordinate transforms ----
+## Building a pyproj Transformer costs far more than using one, and going through
+## GeoDataFrame.to_crs builds one (plus a frame) for every single point. Transformers
+## are cached here per (source, target) pair and applied to raw floats or arrays.
+## CRSs are keyed on their string form, which for pyproj CRS objects is the user
+## input they were made from, so "GCS_WGS84" and "EPSG:4326" are cached separately.
+_transformers = {}
+
+def transformer(src, dst):
+    key = (str(src), str(dst))
+    if key not in _transformers:
+        _transformers[key] = Transformer.from_crs(src, dst, always_xy = True)
+    return _transformers[key]
+
+## x, y from src to dst, as floats for float input and arrays for array input
+def transform(x, y, src, dst):
+    if str(src) == str(dst):
+        return x, y
+    return transformer(src, dst).transform(x, y)
+
+## Batched conversion between the projected CRS and longitude / latitude
+def to_proj(lon, lat, crs = WGS84):
+    return transform(asarray(lon, dtype = float), asarray(lat, dtype = float), crs, PROJ)
+
+def from_proj(x, y, crs = WGS84):
+    return transform(asarray(x, dtype = float), asarray(y, dtype = float), PROJ, crs)
+
+## Sampled or formatted position ----
+## Same keys as the dicts sample_point returns, but the coordinates are kept as
+## floats under 'xy' (in 'crs') and the one row 'point' GeoDataFrame is only built
+## if something asks for it.
+class Position(dict):
+
+    def __missing__(self, key):
+        if key != 'point':
+            raise KeyError(key)
+        from shapely.geometry import Point
+        from geopandas import GeoDataFrame
+
+        self['point'] = GeoDataFrame({'geometry': [Point(*self['xy'])]}, crs = self['crs'])
+        return self['point']
+
+def position(x, y, crs, **fields):
+    return Position(fields, xy = (float(x), float(y)), crs = crs)
+
+## Coordinates of any position dict in the CRS specified
+def position_xy(pos, crs):
+    if 'xy' in pos:
+        return transform(*pos['xy'], pos['crs'], crs)
+    point = pos['point'].geometry.iloc[0]
+    return transform(point.x, point.y, pos['point'].crs, crs)